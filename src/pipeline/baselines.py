@@ -93,14 +93,29 @@ class FeatureRanker(Baseline):
         This output has this structure to mimic the behavior of
         sklearn.model.predic_proba()
         """ 
-        copy_df = pd.DataFrame(X[self.features])
         # Elementwise multiplication flips the sign of each feature when desired.
-        # tuple comparison ensures we compare features with the first feature being
-        # most significant
-        copy_df['ranking_col'] = [tuple(self.flip_sign * row.values) for _, row in copy_df.iterrows()]
-        copy_df['scores'] = copy_df['ranking_col'].rank(pct=True, method='average')
-
-        rv = np.array([np.empty(len(copy_df.index)), copy_df['scores']]).T
+        values = X[self.features].to_numpy(dtype=np.float64) * self.flip_sign
+        n = len(values)
+
+        # Sort rows lexicographically, with the first feature being most
+        # significant; np.lexsort sorts by its last key first
+        order = np.lexsort(values.T[::-1])
+        sorted_values = values[order]
+
+        # Rows with equal values on all features form a group of ties, which
+        # all get the average of their (1-based) positions in the sort
+        new_group = np.ones(n, dtype=bool)
+        new_group[1:] = np.any(sorted_values[1:] != sorted_values[:-1], axis=1)
+        starts = np.flatnonzero(new_group)
+        stops = np.append(starts[1:], n)
+        group_ranks = (starts + 1 + stops) / 2
+
+        ranks = np.empty(n)
+        ranks[order] = group_ranks[np.cumsum(new_group) - 1]
+        # Percentile scores, as rank(pct=True, method='average')
+        scores = ranks / n
+
+        rv = np.array([np.empty(n), scores]).T
         return rv
 
 
@@ -22,12 +22,17 @@ def insert_cohort(db_conn, as_of_dates, config):
     """Create the cohort table for the model, writes it to database.
     The output table has two columns: joid, as_of_date.
 
+    All as_of_dates are inserted with a single set-based query, or with one
+    query per chunk of config['cohort']['dates_per_query'] dates if given.
+
     Args:
         db_conn (sqlachemy database connection)
         as_of_dates (list of str): list of cohort reference dates
         config (dict): config dictionary including years_back and included_tables for the cohort
     """
     interval_back =  config['cohort']['interval_back']
+    as_of_dates = list(as_of_dates)
+    dates_per_query = config['cohort'].get('dates_per_query') or max(len(as_of_dates), 1)
     tables_excluded = ['jocojcdheencounter', 'jocodcmexoverdosessuicides', 'jocojcmexoverdosessuicides']
     tables_excluded_sql = '(' + ', '.join(f"'{t}'" for t in tables_excluded) + ')'
 
@@ -40,10 +45,11 @@ def insert_cohort(db_conn, as_of_dates, config):
     doco_tables = ', '.join([f"'{t}'" for t in table_county_dict["doco_tables"]])
     joco_tables = ', '.join([f"'{t}'" for t in table_county_dict["joco_tables"]])
 
-    for as_of_date in as_of_dates:
+    for i in range(0, len(as_of_dates), dates_per_query):
+        dates_chunk = as_of_dates[i:i + dates_per_query]
 
         formatted_query = query.format(
-            as_of_date = as_of_date,
+            as_of_dates = ', '.join([f"'{d}'" for d in dates_chunk]),
             interval_back = interval_back,
             doco_tables = doco_tables,
             joco_tables = joco_tables,
@@ -1,16 +1,38 @@
 import re
+import json
 import yaml
+import bisect
 import pandas as pd
-from utils.helpers import get_database_connection
+from time import time
+from joblib import Parallel, delayed
+from utils.helpers import get_database_connection, get_database_pool_size
 from pipeline import time_splitter
+from pipeline.matrix_cache import hash_object, date_str, get_content_per_date
 from utils.constants import (
     SQL_NUMERICAL_CATEGORICAL_FEATURES,
     SQL_AGGREGATE_FEATURES,
+    SQL_WINDOW_AGGREGATE_FEATURES,
     SQL_CREATE_FEATURES,
+    SQL_INSERT_FEATURES,
+    SQL_FEATURE_QUERY,
+    SQL_WINDOW_FEATURE_QUERY,
     CONFIG_PATH
 )
 
 
+# Aggregates that window functions compute incrementally, and the intervals
+# for which a window over days equals the aggregate's between filter
+WINDOW_AGG_FUNCS = ['SUM', 'COUNT', 'AVG']
+WINDOW_INTERVAL_PATTERN = r'^\d+\s+(day|week|month|year)s?$'
+
+# Features the local engine (see local_features.py) can compute: numerical
+# features of the form [as_of_date -] MAX/MIN(expression) [filter (where ...)],
+# and aggregates with these functions over intervals of whole days
+LOCAL_AGG_FUNCS = ['SUM', 'COUNT', 'AVG', 'MAX', 'MIN']
+LOCAL_NUMERICAL_PATTERN = r'^\s*(as_of_date(?:::date)?\s*-\s*)?(max|min)\s*\((.*)\)\s*$'
+LOCAL_FILTER_PATTERN = r'^\s*filter\s*\(\s*where\s+(.*)\)\s*$'
+
+
 def get_numcat_feature_cols(config, table_name, type):
     """Creates the SELECT script of SQL query for numerical / categorical feature columns.
     Both column types use the same SQL template, hence this combined function.
@@ -56,29 +78,24 @@ def get_numcat_feature_cols(config, table_name, type):
     return ', \n'.join(feature_cols)
 
 
-def get_agg_feature_cols(config, table_name):
-    """Creates the SELECT script of SQL query for aggregate feature columns.
+def get_agg_features(config, table_name):
+    """Lists the aggregate features of a table, one per aggregate function and
+    interval of each aggregate feature specification.
 
     Args:
         config (dict): config dictionary
         table_name (str): table name the features are drawn from
 
     Returns:
-        str: aggregate feature query
+        list of dicts with feature_name, agg_func, agg_arg, interval and add_filter
     """
     conf = config['features'][table_name]
-    knowledge_date = conf['knowledge_date']
     table_prefix = conf['table_prefix']
-    impute_agg = conf['impute_agg']
 
     features = conf['features']
     agg_features = features['agg']
 
-    with open(SQL_AGGREGATE_FEATURES, 'r') as f:
-        agg_query = f.read()
-
-    # Create SELECT script for each column
-    feature_cols = []
+    feature_specs = []
     for col_prefix, feature_params in agg_features.items():
 
         agg_func = feature_params['agg_func'] # e.g. SUM, AVG
@@ -96,18 +113,51 @@ def get_agg_feature_cols(config, table_name):
                     re.findall('\d+', interval)[0] + re.search('[a-zA-Z]', interval)[0]
                 ])
 
-                query = agg_query.format(
-                    agg_func=fn,
-                    agg_arg=agg_arg,
-                    interval=interval,
-                    add_filter=add_filter,
-                    knowledge_date=knowledge_date,
-                    feature_name=feature_name,
-                    impute_agg=impute_agg
-                )
+                feature_specs.append({
+                    'feature_name': feature_name,
+                    'agg_func': fn,
+                    'agg_arg': agg_arg,
+                    'interval': interval,
+                    'add_filter': add_filter
+                })
+
+    return feature_specs
 
-                feature_cols.append(query)
 
+def get_agg_feature_query(config, table_name, feature):
+    """Creates the SELECT script of a single aggregate feature column, as
+    listed by get_agg_features().
+    """
+    conf = config['features'][table_name]
+
+    with open(SQL_AGGREGATE_FEATURES, 'r') as f:
+        agg_query = f.read()
+
+    return agg_query.format(
+        agg_func=feature['agg_func'],
+        agg_arg=feature['agg_arg'],
+        interval=feature['interval'],
+        add_filter=feature['add_filter'],
+        knowledge_date=conf['knowledge_date'],
+        feature_name=feature['feature_name'],
+        impute_agg=conf['impute_agg']
+    )
+
+
+def get_agg_feature_cols(config, table_name):
+    """Creates the SELECT script of SQL query for aggregate feature columns.
+
+    Args:
+        config (dict): config dictionary
+        table_name (str): table name the features are drawn from
+
+    Returns:
+        str: aggregate feature query
+    """
+    feature_cols = [
+        get_agg_feature_query(config, table_name, feature)
+        for feature in get_agg_features(config, table_name)
+    ]
     return ', \n'.join(feature_cols)
 
 
@@ -148,15 +198,137 @@ def get_feature_cols(config, table_name):
     return cat_feature_cols, aggnum_feature_cols
 
 
-def create_feature_table(db_conn, config, as_of_dates, table_name, template_query):
-    """Creates features table drawn from a single table of origin.
+def is_window_feature(feature):
+    """Whether an aggregate feature (see get_agg_features()) can be computed
+    as a window over the events: its aggregate function is in
+    WINDOW_AGG_FUNCS, its interval is a whole number of days, and its argument
+    and filter are row expressions (see is_row_expression()), since they are
+    evaluated on the events, without the cohort.
+    """
+    return (
+        feature['agg_func'].upper() in WINDOW_AGG_FUNCS
+        and re.match(WINDOW_INTERVAL_PATTERN, feature['interval'].strip(), flags=re.IGNORECASE) is not None
+        and is_row_expression(feature['agg_arg'])
+        and is_row_expression(feature['add_filter'] or '')
+    )
+
+
+def get_window_feature_query(config, table_name, as_of_dates):
+    """Creates the query of the numerical / aggregate features of a table that
+    computes its aggregate features with window functions.
+
+    The feature query of feature_query.sql joins every cohort row to the
+    person's entire history and filters it once per feature. Here the events
+    of the cohort are instead sorted once per person, and each aggregate
+    feature is a window over the days [as_of_date - interval, as_of_date),
+    which Postgres slides along the events incrementally. Only aggregates
+    for which this is exact, see is_window_feature(), are windowed; the
+    numerical features and the other aggregates use the join.
+
+    Args:
+        config (dict): config dictionary
+        table_name (str): table name the features are drawn from
+        as_of_dates (list): list of as of dates
+
+    Returns:
+        str: feature query, None if the table has no windowed aggregate features
+    """
+    conf = config['features'][table_name]
+    features = conf['features']
+    if 'agg' not in features:
+        return None
+
+    agg_features = get_agg_features(config, table_name)
+    window_features = [f for f in agg_features if is_window_feature(f)]
+    if not window_features:
+        return None
+
+    # Features computed by joining the cohort to the events
+    joined_cols = []
+    output_cols = []
+    if 'numerical' in features:
+        joined_cols.append(get_numcat_feature_cols(config, table_name, 'numerical'))
+        output_cols += ['j.' + '_'.join([conf['table_prefix'], col_prefix]) for col_prefix in features['numerical']]
+
+    with open(SQL_WINDOW_AGGREGATE_FEATURES, 'r') as f:
+        window_agg_query = f.read()
+
+    # One event column per aggregate argument and filter, one window per interval
+    agg_columns = {}
+    window_names = {}
+    window_feature_cols = []
+    for feature in agg_features:
+        if not is_window_feature(feature):
+            joined_cols.append(get_agg_feature_query(config, table_name, feature))
+            output_cols.append('j.' + feature['feature_name'])
+            continue
+
+        agg_column = agg_columns.setdefault((feature['agg_arg'], feature['add_filter']), f'agg_arg_{len(agg_columns)}')
+        window_name = window_names.setdefault(feature['interval'], f'w_{len(window_names)}')
+        window_feature_cols.append(window_agg_query.format(
+            agg_func=feature['agg_func'],
+            agg_column=agg_column,
+            window_name=window_name,
+            impute_agg=conf['impute_agg'],
+            feature_name=feature['feature_name']
+        ))
+        output_cols.append('w.' + feature['feature_name'])
+
+    if joined_cols:
+        joined_feature_cols = ', \n' + ', \n'.join(joined_cols)
+        joined_condition = f"c.joid = t.joid and t.{conf['knowledge_date']} < c.as_of_date"
+    else:
+        joined_feature_cols = ''
+        joined_condition = 'false'
+
+    # The argument is only evaluated where the filter holds, as in an aggregate's filter clause
+    event_columns = [
+        f'case when true {add_filter} then {agg_arg} end as {agg_column}'
+        for (agg_arg, add_filter), agg_column in agg_columns.items()
+    ]
+    windows = [
+        f"{window_name} as (partition by joid order by event_date range between interval '{interval}' preceding and interval '1 day' preceding)"
+        for interval, window_name in window_names.items()
+    ]
+
+    with open(SQL_WINDOW_FEATURE_QUERY, 'r') as f:
+        window_query = f.read()
+
+    return window_query.format(
+        as_of_dates=', '.join([f"'{x}'" for x in as_of_dates]),
+        joined_feature_cols=joined_feature_cols,
+        joined_condition=joined_condition,
+        knowledge_date=conf['knowledge_date'],
+        from_arg=conf['from_arg'],
+        event_columns=', '.join(event_columns),
+        cohort_columns=', '.join(['null'] * len(event_columns)),
+        window_feature_cols=', \n'.join(window_feature_cols),
+        windows=', \n'.join(windows),
+        feature_cols=', '.join(output_cols)
+    )
+
+
+def feature_query_template():
+    """Returns the template of the feature query joining the cohort to the events."""
+    with open(SQL_FEATURE_QUERY, 'r') as f:
+        return f.read()
+
+
+def get_feature_table_queries(config, as_of_dates, table_name, template_query):
+    """Creates the SQL queries that create the features tables drawn from a
+    single table of origin.
+
+    Unless config['feature_aggregation'] is 'join', aggregate features are
+    computed with window functions where possible (see get_window_feature_query()).
 
     Args:
-        db_conn (sqlalchemy.engine.base.Connection): database connection
         config (dict): dict holding information about the features
         as_of_dates (list): list of as of dates
         table_name (str): table name that the features are drawn from
-        create_query (str): template SQL to create the features table
+        template_query (str): template SQL to create (or insert into) the features table
+
+    Returns:
+        dict: feature table name -> query creating it
     """
     conf = config['features'][table_name]
     knowledge_date = conf['knowledge_date']
@@ -164,70 +336,484 @@ def create_feature_table(db_conn, config, as_of_dates, table_name, template_quer
 
     cat_feature_cols, aggnum_feature_cols = get_feature_cols(config, table_name)
 
-    # If this table has a categorical specification, execute the SQL query
+    feature_cols = {}
+    # If this table has a categorical specification, create a _cat table
     if cat_feature_cols is not None:
-        formatted_query = template_query.format(
-            as_of_dates=', '.join([f"'{x}'" for x in as_of_dates]),
-            feature_cols=cat_feature_cols,
-            knowledge_date=knowledge_date,
-            from_arg=from_arg,
-            feature_table_name=table_name + '_cat'
-        )
-        db_conn.execute(formatted_query)
-        db_conn.execute('COMMIT')
+        feature_cols[table_name + '_cat'] = cat_feature_cols
 
-    # If this table has an aggregate or numerical specification, execute the SQL query
+    # If this table has an aggregate or numerical specification, create a _num table
     if aggnum_feature_cols is not None:
-        formatted_query = template_query.format(
+        feature_cols[table_name + '_num'] = aggnum_feature_cols
+
+    feature_queries = {
+        feature_table_name: feature_query_template().format(
             as_of_dates=', '.join([f"'{x}'" for x in as_of_dates]),
-            feature_cols=aggnum_feature_cols,
+            feature_cols=cols,
             knowledge_date=knowledge_date,
-            from_arg=from_arg,
-            feature_table_name=table_name + '_num'
+            from_arg=from_arg
+        )
+        for feature_table_name, cols in feature_cols.items()
+    }
+
+    if config.get('feature_aggregation', 'window') == 'window' and table_name + '_num' in feature_queries:
+        window_query = get_window_feature_query(config, table_name, as_of_dates)
+        if window_query is not None:
+            feature_queries[table_name + '_num'] = window_query
+
+    return {
+        feature_table_name: template_query.format(
+            feature_table_name=feature_table_name,
+            feature_query=feature_query
         )
+        for feature_table_name, feature_query in feature_queries.items()
+    }
+
+
+def is_row_expression(expression):
+    """Whether a SQL expression can be evaluated on the rows of a source table
+    alone: its parentheses are balanced, and it does not refer to the cohort.
+    """
+    depth = 0
+    in_quotes = False
+    for char in expression:
+        if char == "'":
+            in_quotes = not in_quotes
+        elif not in_quotes and char == '(':
+            depth += 1
+        elif not in_quotes and char == ')':
+            depth -= 1
+            if depth < 0:
+                return False
+    refers_to_cohort = re.search(r'\bas_of_date\b|\bc\.', expression, flags=re.IGNORECASE) is not None
+    return depth == 0 and not in_quotes and not refers_to_cohort
+
+
+def parse_impute_value(impute_val):
+    """Returns an impute value of the config as a float (nan for NULL), or
+    None if it is not a number."""
+    if str(impute_val).strip().upper() == 'NULL':
+        return float('nan')
+    try:
+        return float(impute_val)
+    except ValueError:
+        return None
+
+
+def get_local_feature_specs(config, table_name):
+    """Interprets the numerical and aggregate features of a table for the local
+    feature engine. Every feature becomes an aggregate of a row expression
+    (evaluated by the database while the rows are streamed out) over a window
+    of days before the as of date.
+
+    Args:
+        config (dict): config dictionary
+        table_name (str): table name the features are drawn from
+
+    Returns:
+        list of dicts with feature_name, agg_func, value (row expression),
+        interval (None for the whole history), days_since (whether the
+        feature is the as of date minus the aggregate, in days) and impute,
+        in the order of the columns of the _num table; None if the local
+        engine cannot compute some of the features
+    """
+    conf = config['features'][table_name]
+    features = conf['features']
+    table_prefix = conf['table_prefix']
+
+    specs = []
+    for col_prefix, feature_params in features.get('numerical', {}).items():
+        match = re.match(LOCAL_NUMERICAL_PATTERN, feature_params['arg'], flags=re.IGNORECASE | re.DOTALL)
+        filter = feature_params.get('filter', '')
+        filter_match = re.match(LOCAL_FILTER_PATTERN, filter, flags=re.IGNORECASE | re.DOTALL)
+        condition = filter_match.group(1) if filter_match else 'true'
+        impute = parse_impute_value(feature_params['impute_val'])
+
+        if match is None or (filter and filter_match is None) or impute is None:
+            return None
+        days_since, agg_func, expression = match.groups()
+        if not (is_row_expression(expression) and is_row_expression(condition)):
+            return None
+
+        if days_since:
+            value = f"(case when {condition} then ({expression})::date end) - date '1970-01-01'"
+        else:
+            value = f'case when {condition} then ({expression}) end'
+        specs.append({
+            'feature_name': '_'.join([table_prefix, col_prefix]),
+            'agg_func': agg_func.upper(),
+            'value': value,
+            'interval': None,
+            'days_since': days_since is not None,
+            'impute': impute
+        })
+
+    if 'agg' in features:
+        impute = parse_impute_value(conf['impute_agg'])
+        for feature in get_agg_features(config, table_name):
+            agg_func = feature['agg_func'].upper()
+            supported = (
+                agg_func in LOCAL_AGG_FUNCS
+                and re.match(WINDOW_INTERVAL_PATTERN, feature['interval'].strip(), flags=re.IGNORECASE)
+                and is_row_expression(feature['agg_arg'])
+                and is_row_expression(feature['add_filter'])
+                and impute is not None
+            )
+            if not supported:
+                return None
+
+            # The argument is only evaluated where the filter holds, as in an aggregate's filter clause
+            if agg_func == 'COUNT':
+                value = f"case when true {feature['add_filter']} then case when ({feature['agg_arg']}) is not null then 1 end end"
+            else:
+                value = f"case when true {feature['add_filter']} then ({feature['agg_arg']}) end"
+            specs.append({
+                'feature_name': feature['feature_name'],
+                'agg_func': agg_func,
+                'value': value,
+                'interval': feature['interval'].strip(),
+                'days_since': False,
+                'impute': impute
+            })
+
+    return specs
+
+
+def get_local_feature_tables(config):
+    """Returns the _num feature tables computed by the local engine, i.e. all
+    those it can compute if config['feature_engine'] is 'local', and none
+    otherwise.
+
+    Returns:
+        dict: feature table name -> output of get_local_feature_specs()
+    """
+    if config.get('feature_engine', 'sql') != 'local':
+        return {}
+
+    local_tables = {}
+    for table_name, conf in config['features'].items():
+        if 'numerical' not in conf['features'] and 'agg' not in conf['features']:
+            continue
+        specs = get_local_feature_specs(config, table_name)
+        if specs is not None:
+            local_tables[table_name + '_num'] = specs
+    return local_tables
+
+
+def create_feature_table(db_conn, config, as_of_dates, table_name, template_query):
+    """Creates features table drawn from a single table of origin.
+
+    Args:
+        db_conn (sqlalchemy.engine.base.Connection): database connection
+        config (dict): dict holding information about the features
+        as_of_dates (list): list of as of dates
+        table_name (str): table name that the features are drawn from
+        create_query (str): template SQL to create the features table
+    """
+    queries = get_feature_table_queries(config, as_of_dates, table_name, template_query)
+    for formatted_query in queries.values():
         db_conn.execute(formatted_query)
         db_conn.execute('COMMIT')
 
 
+def get_feature_n_jobs(config, nr_queries):
+    """Number of feature queries run concurrently. Uses config['feature_n_jobs']
+    if given, and config['nr_cores'] otherwise, capped by the number of queries
+    and by the connections the pool can hand out besides the caller's own.
+    """
+    n_jobs = int(config.get('feature_n_jobs', config.get('nr_cores', 1)))
+    pool_size, max_overflow = get_database_pool_size()
+    return max(1, min(n_jobs, nr_queries, pool_size + max_overflow - 1))
+
+
+def execute_timed(name, query, psql_role):
+    """Executes a query on its own pooled connection, as the given role. The
+    role is reset before the connection goes back to the pool, so that later
+    users of the connection do not inherit it.
+
+    Returns:
+        tuple: name, seconds the query took
+    """
+    start = time()
+    db_conn = get_database_connection()
+    try:
+        # The index queries do not set the role themselves
+        db_conn.execute(f'set role {psql_role};')
+        db_conn.execute(query)
+        db_conn.execute('COMMIT')
+    finally:
+        try:
+            db_conn.execute('ROLLBACK')
+            db_conn.execute('reset role;')
+            db_conn.execute('COMMIT')
+        finally:
+            db_conn.close()
+    seconds = time() - start
+    print(f'{name} took {seconds:.1f}s')
+    return name, seconds
+
+
+def execute_concurrently(queries, psql_role, n_jobs):
+    """Executes independent queries concurrently, each on its own pooled
+    connection. The threads only wait on the database server, so n_jobs
+    queries run on the server at a time.
+
+    Args:
+        queries (dict): name -> query
+        psql_role (str): role to execute the queries as
+        n_jobs (int): maximum number of queries running at once
+
+    Returns:
+        dict: name -> seconds the query took
+    """
+    timings = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(execute_timed)(name, query, psql_role) for name, query in queries.items()
+    )
+    return dict(timings)
+
+
+def get_feature_spec_hash(config, table_name, feature_table_name):
+    """Hash of everything a feature table is computed from except its dates
+    and data: its feature query, without as_of_dates, and without the create
+    or insert statement around it and the role it runs as.
+    """
+    queries = get_feature_table_queries(config, [], table_name, '{feature_query}')
+    return hash_object({'query': queries[feature_table_name]})
+
+
+def get_feature_table_comments(db_conn, schema='features'):
+    """Returns the comments of the tables in the features schema: the spec
+    hash of every table and the signatures of its as of dates (see
+    create_features()).
+
+    Returns:
+        dict: feature table name -> {'spec': spec hash, 'dates': as_of_date -> signature},
+            with spec None for tables without a comment of this form
+    """
+    query = f"""
+        select c.relname as table_name, obj_description(c.oid, 'pg_class') as comment
+        from pg_class c
+        join pg_namespace n on n.oid = c.relnamespace
+        where n.nspname = '{schema}' and c.relkind = 'r';
+        """
+    df = pd.read_sql(query, db_conn)
+    comments = {}
+    for name, comment in zip(df['table_name'], df['comment']):
+        try:
+            comments[name] = json.loads(comment)
+        except (TypeError, ValueError):
+            comments[name] = None
+        if not isinstance(comments[name], dict):
+            comments[name] = {'spec': None, 'dates': {}}
+    return comments
+
+
+def get_source_signatures(db_conn, conf, as_of_dates):
+    """Signature of the events a feature table's rows of every as of date are
+    computed from, i.e. the rows of its source table known before that date:
+    their number and the sum of the hashes of their text. Late-arriving or
+    corrected events change the signatures of every later as of date.
+
+    Args:
+        db_conn (sqlalchemy.engine.base.Connection): database connection
+        conf (dict): config['features'] entry of the source table
+        as_of_dates (list): list of as of dates
+
+    Returns:
+        dict: as_of_date (see date_str()) -> [rows, hash]
+    """
+    query = f"""
+        select t.{conf['knowledge_date']}::date as knowledge_day, count(*) as n,
+            sum(hashtext(t::text)::bigint)::varchar as content_hash
+        from {conf['from_arg']} t
+        where t.{conf['knowledge_date']} is not null
+        group by 1
+        order by 1;
+        """
+    df = pd.read_sql(query, db_conn)
+    days = [date_str(d) for d in df['knowledge_day']]
+    rows, hashes = [0], [0]
+    for n, content_hash in zip(df['n'], df['content_hash']):
+        rows.append(rows[-1] + int(n))
+        hashes.append(hashes[-1] + int(content_hash))
+    signatures = {}
+    for d in as_of_dates:
+        # events of the days strictly before the as of date
+        i = bisect.bisect_left(days, date_str(d))
+        signatures[date_str(d)] = [rows[i], str(hashes[i])]
+    return signatures
+
+
+def get_date_signatures(cohort_content, source_signatures, as_of_dates):
+    """Signature of the rows of a feature table for every as of date: the
+    number and hash of the cohort's rows of that date (see
+    matrix_cache.get_content_per_date()), and the source's signature.
+
+    Args:
+        cohort_content (tuple): the cohort's (rows_per_date, hash_per_date)
+        source_signatures (dict): output of get_source_signatures()
+        as_of_dates (list): list of as of dates
+
+    Returns:
+        dict: as_of_date (see date_str()) -> signature
+    """
+    rows_per_date, hash_per_date = cohort_content
+    return {
+        date_str(d): hash_object({
+            'cohort': [rows_per_date.get(date_str(d), 0), hash_per_date.get(date_str(d))],
+            'source': source_signatures[date_str(d)],
+        })
+        for d in as_of_dates
+    }
+
+
+def get_stale_dates(stored_signatures, signatures, as_of_dates):
+    """Returns the as of dates whose features are missing or no longer valid,
+    i.e. whose signature differs from the one stored when their rows were
+    computed: the cohort of the date or the events before it changed.
+
+    Args:
+        stored_signatures (dict): as_of_date -> signature stored with the feature table
+        signatures (dict): as_of_date -> current signature (see get_date_signatures())
+        as_of_dates (list): list of as of dates
+
+    Returns:
+        list: stale as of dates, in the order given
+    """
+    return [d for d in as_of_dates if stored_signatures.get(date_str(d)) != signatures[date_str(d)]]
+
+
+def get_comment_query(feature_table_name, spec_hash, date_signatures):
+    """Query commenting a feature table with its spec hash and date signatures."""
+    comment = json.dumps({'spec': spec_hash, 'dates': date_signatures}, sort_keys=True)
+    return f"\ncomment on table features.{feature_table_name} is '{comment}';"
+
+
+def get_index_queries(table_names):
+    """Creates the queries that index the given feature tables.
+
+    Returns:
+        dict: name -> query
+    """
+    index_queries = {}
+    for table_name in table_names:
+        index_queries[f'index features.{table_name} (joid)'] = f"""create index idx_joid_{table_name} on features.{table_name} (joid);"""
+        index_queries[f'index features.{table_name} (as_of_date)'] = f"""create index idx_aod_{table_name} on features.{table_name} (as_of_date);"""
+        index_queries[f'index features.{table_name} (joid, as_of_date)'] = f"""create index idx_joid_aod_{table_name} on features.{table_name} (joid, as_of_date);"""
+    return index_queries
+
+
 def create_features(db_conn, config, as_of_dates, psql_role):
     """Creates features for all tables in the config file.
 
+    The feature tables are independent of each other, so their create table
+    queries run concurrently, get_feature_n_jobs() at a time, each on its own
+    connection from the pool. Once all tables exist their indices are created
+    concurrently in the same way.
+
+    Every table is commented with the hash of its specification (see
+    get_feature_spec_hash()). If config['incremental_features'] is set, the
+    comment also holds the signature of every as of date, which covers the
+    cohort of the date and the source events before it (see
+    get_date_signatures()), and the features schema is kept: tables whose
+    specification is unchanged only get the as of dates that are missing or
+    whose signature changed, e.g. after events were backfilled or the cohort
+    was recreated, and only new or changed tables are created from scratch.
+
+    Tables computed by the local feature engine (see get_local_feature_tables())
+    are not created, they are computed when the master matrix is built.
+
     Args:
         db_conn (sqlalchemy.engine.base.Connection): database connection
-        config (dict): dict holding information about the features
+        config (dict): dict holding information about the features, and
+            optionally feature_n_jobs, the number of queries run at once
         as_of_dates (list): list of as of dates
         table_name (str): table name that the features are drawn from
     """
     conf = config['features']
     table_names = conf.keys()
-
-    # Drop and create empty features schema
-    query = '''
-        set role {psql_role};
-        drop schema if exists features cascade;
-        create schema features;
-    '''.format(psql_role=psql_role)
+    incremental = int(config.get('incremental_features', 0))
+
+    # Drop and create empty features schema, unless refreshing it incrementally
+    if incremental:
+        query = '''
+            set role {psql_role};
+            create schema if not exists features;
+        '''.format(psql_role=psql_role)
+    else:
+        query = '''
+            set role {psql_role};
+            drop schema if exists features cascade;
+            create schema features;
+        '''.format(psql_role=psql_role)
     db_conn.execute(query)
     db_conn.execute('COMMIT')
 
     # Create feature tables
     with open(SQL_CREATE_FEATURES, 'r') as f:
         template_query = f.read()
-    template_query = template_query.format(psql_role=psql_role)
+    template_query = template_query.replace('{psql_role}', psql_role)
+    with open(SQL_INSERT_FEATURES, 'r') as f:
+        insert_template_query = f.read()
+    insert_template_query = insert_template_query.replace('{psql_role}', psql_role)
+
+    existing_comments = get_feature_table_comments(db_conn) if incremental else {}
+    cohort_content = get_content_per_date(db_conn, 'modeling.cohort') if incremental else None
+
+    local_tables = get_local_feature_tables(config)
+    queries = {}
+    new_tables = []
     for table_name in table_names:
-        create_feature_table(db_conn, config, as_of_dates, table_name, template_query)
-
-    # Create indices for feature tables
-    feats_table_names_q = "select table_name from information_schema.tables where table_schema = 'features';"
-    feats_table_names = pd.read_sql(feats_table_names_q, db_conn)
-    for i, table_name in enumerate(feats_table_names['table_name']):
-        joid_idx_q = f"""create index idx_joid_t{i} on features.{table_name} (joid);"""
-        aod_idx_q = f"""create index idx_aod_t{i} on features.{table_name} (as_of_date);"""
-        joid_aod_idx_q = f"""create index idx_joid_aod_t{i} on features.{table_name} (joid, as_of_date);"""
-        db_conn.execute(joid_idx_q)
-        db_conn.execute(aod_idx_q)
-        db_conn.execute(joid_aod_idx_q)
-        db_conn.execute('COMMIT')
+        create_queries = get_feature_table_queries(config, as_of_dates, table_name, template_query)
+        if all(name in local_tables for name in create_queries):
+            continue
+        # Date signatures are only needed to refresh tables incrementally
+        signatures = {}
+        if incremental:
+            source_signatures = get_source_signatures(db_conn, conf[table_name], as_of_dates)
+            signatures = get_date_signatures(cohort_content, source_signatures, as_of_dates)
+        for feature_table_name, create_query in create_queries.items():
+            if feature_table_name in local_tables:
+                continue
+            spec_hash = get_feature_spec_hash(config, table_name, feature_table_name)
+            existing = existing_comments.get(feature_table_name, {'spec': None, 'dates': {}})
+
+            if existing.get('spec') != spec_hash:
+                drop_query = f'drop table if exists features.{feature_table_name};\n'
+                comment_query = get_comment_query(feature_table_name, spec_hash, signatures)
+                queries[f'create features.{feature_table_name}'] = drop_query + create_query + comment_query
+                new_tables.append(feature_table_name)
+                continue
+
+            stale_dates = get_stale_dates(existing.get('dates', {}), signatures, as_of_dates)
+            if stale_dates:
+                stale_dates_str = ', '.join([f"'{x}'" for x in stale_dates])
+                delete_query = f'delete from features.{feature_table_name} where as_of_date in ({stale_dates_str});\n'
+                insert_query = get_feature_table_queries(config, stale_dates, table_name, insert_template_query)[feature_table_name]
+                comment_query = get_comment_query(feature_table_name, spec_hash, {**existing.get('dates', {}), **signatures})
+                queries[f'insert {len(stale_dates)} dates into features.{feature_table_name}'] = delete_query + insert_query + comment_query
+
+    # Drop feature tables that are no longer in the config
+    feature_table_names = set(
+        name for table_name in table_names
+        for name in get_feature_table_queries(config, [], table_name, template_query)
+        if name not in local_tables
+    )
+    for feature_table_name in existing_comments:
+        if feature_table_name not in feature_table_names:
+            db_conn.execute(f'drop table if exists features.{feature_table_name};')
+            db_conn.execute('COMMIT')
+
+    start = time()
+    n_jobs = get_feature_n_jobs(config, len(queries))
+    print(f'Creating {len(new_tables)} and updating {len(queries) - len(new_tables)} feature tables using {n_jobs} connections')
+    execute_concurrently(queries, psql_role, n_jobs)
+    print(f'Created feature tables in {time() - start:.1f}s')
+
+    # Create indices for the new feature tables, inserted rows are indexed already
+    index_queries = get_index_queries(new_tables)
+    start = time()
+    execute_concurrently(index_queries, psql_role, get_feature_n_jobs(config, len(index_queries)))
+    print(f'Created feature table indices in {time() - start:.1f}s')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+SPLITS = ['train', 'validate']
+COLUMNS_FILENAME = 'columns.json'
+# Components of a CSR matrix, stored as one array each
+CSR_COMPONENTS = ['data', 'indices', 'indptr']
+
+
+def is_sparse_frame(X: pd.DataFrame) -> bool:
+    """Whether a matrix is a dataframe of sparse columns, as written by
+    matrix.write_small_mats() with config['sparse_matrices']."""
+    return len(X.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in X.dtypes)
+
+
+def sparse_frame(X: sparse.spmatrix, index: pd.MultiIndex, columns: list[str]) -> pd.DataFrame:
+    """Dataframe of sparse columns over a scipy sparse matrix."""
+    return pd.DataFrame.sparse.from_spmatrix(X, index=index, columns=columns)
+
+
+def to_csr(X: pd.DataFrame) -> sparse.csr_matrix:
+    """CSR matrix of a dataframe of sparse columns."""
+    return X.sparse.to_coo().tocsr()
+
+
+def get_index_arrays(index: pd.MultiIndex) -> tuple[np.ndarray, np.ndarray]:
+    """joid (int64) and as_of_date (datetime64[D]) arrays of a matrix's index."""
+    joids = np.asarray(index.get_level_values('joid'), dtype=np.int64)
+    as_of_dates = pd.to_datetime(pd.Series(index.get_level_values('as_of_date'))).values.astype('datetime64[D]')
+    return joids, as_of_dates
+
+
+def make_index(joids: np.ndarray, as_of_dates: np.ndarray) -> pd.MultiIndex:
+    """(joid, as_of_date) index, with as_of_dates as datetime.date like the
+    labels tables."""
+    return pd.MultiIndex.from_arrays([joids, as_of_dates.astype(object)], names=['joid', 'as_of_date'])
+
+
+def write_sparse_matrices(X_train: pd.DataFrame, X_val: pd.DataFrame, f):
+    """Write a fold's training and validation matrices of sparse columns to
+    an open file, as a .npz of their CSR components, indices and columns.
+    """
+    arrays = {'columns': np.array(X_train.columns, dtype=str)}
+    for split, X in zip(SPLITS, [X_train, X_val]):
+        X_csr = to_csr(X)
+        for component in CSR_COMPONENTS:
+            arrays[f'{split}_{component}'] = getattr(X_csr, component)
+        arrays[f'{split}_shape'] = np.array(X_csr.shape)
+        arrays[f'{split}_joid'], arrays[f'{split}_as_of_date'] = get_index_arrays(X.index)
+    np.savez(f, **arrays)
+
+
+def load_sparse_matrices(path: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Read the matrices written by write_sparse_matrices().
+
+    Returns (X_train, X_val), as dataframes of sparse columns.
+    """
+    matrices = []
+    with np.load(path) as arrays:
+        columns = list(arrays['columns'])
+        for split in SPLITS:
+            X_csr = sparse.csr_matrix(
+                tuple(arrays[f'{split}_{component}'] for component in CSR_COMPONENTS),
+                shape=tuple(arrays[f'{split}_shape'])
+            )
+            index = make_index(arrays[f'{split}_joid'], arrays[f'{split}_as_of_date'])
+            matrices.append(sparse_frame(X_csr, index, columns))
+    return tuple(matrices)
+
+
+def write_fold_arrays(X_train: pd.DataFrame, X_val: pd.DataFrame, y_train, y_val, path: str):
+    """Write a fold's matrices and labels to disk as plain .npy files, so that
+    worker processes can memory-map them instead of receiving a pickled copy.
+    Feature matrices are stored as float32, along with their (joid,
+    as_of_date) index; labels must share the index of their matrix, and are
+    a series or a dataframe with a column per label. Matrices of sparse
+    columns (see is_sparse_frame()) are stored as the components of a CSR
+    matrix.
+
+    Args:
+    ---
+    X_train, X_val: training and validation matrices, as in run_pipeline
+    y_train, y_val: training and validation labels, as in run_pipeline
+    path: directory to write the fold to
+    """
+    os.makedirs(path, exist_ok=True)
+    is_sparse = is_sparse_frame(X_train)
+    shapes = {}
+    for split, X, y in zip(SPLITS, [X_train, X_val], [y_train, y_val]):
+        if not X.index.equals(y.index):
+            raise Exception(f'The {split} matrix and labels do not share the same index.')
+        if is_sparse:
+            X_csr = to_csr(X).astype(np.float32)
+            for component in CSR_COMPONENTS:
+                np.save(os.path.join(path, f'{split}_X_{component}.npy'), getattr(X_csr, component))
+            shapes[split] = list(X_csr.shape)
+        else:
+            np.save(os.path.join(path, f'{split}_X.npy'), np.ascontiguousarray(X.to_numpy(dtype=np.float32)))
+        np.save(os.path.join(path, f'{split}_y.npy'), y.to_numpy())
+        joids, as_of_dates = get_index_arrays(X.index)
+        np.save(os.path.join(path, f'{split}_joid.npy'), joids)
+        np.save(os.path.join(path, f'{split}_as_of_date.npy'), as_of_dates)
+
+    with open(os.path.join(path, COLUMNS_FILENAME), 'w') as f:
+        labels = {'labels': list(y_train.columns)} if isinstance(y_train, pd.DataFrame) else {'label': y_train.name}
+        json.dump({'features': list(X_train.columns), **labels, 'sparse_shapes': shapes}, f)
+
+
+def load_fold_arrays(path: str, mmap_mode: str = 'r') -> tuple[tuple, tuple]:
+    """Attach to a fold written by write_fold_arrays(). The matrices are
+    dataframes over the memory-mapped float32 arrays, so processes reading the
+    same fold share the operating system's page cache rather than holding
+    their own copies.
+
+    Returns ((X_train, X_val), (y_train, y_val)), like the entries of
+    run_pipeline's matrices_dict and labels_dict. Sparse matrices are
+    dataframes of sparse columns, copied out of the memory-mapped CSR
+    components.
+    """
+    with open(os.path.join(path, COLUMNS_FILENAME), 'r') as f:
+        columns = json.load(f)
+
+    matrices, labels = [], []
+    for split in SPLITS:
+        joids = np.load(os.path.join(path, f'{split}_joid.npy'))
+        as_of_dates = np.load(os.path.join(path, f'{split}_as_of_date.npy'))
+        index = make_index(joids, as_of_dates)
+
+        y = np.load(os.path.join(path, f'{split}_y.npy'))  # labels are small, read them into memory
+        if columns.get('sparse_shapes'):
+            X_csr = sparse.csr_matrix(
+                tuple(np.load(os.path.join(path, f'{split}_X_{component}.npy'), mmap_mode=mmap_mode) for component in CSR_COMPONENTS),
+                shape=tuple(columns['sparse_shapes'][split])
+            )
+            matrices.append(sparse_frame(X_csr, index, columns['features']))
+        else:
+            X = np.load(os.path.join(path, f'{split}_X.npy'), mmap_mode=mmap_mode)
+            matrices.append(pd.DataFrame(X, index=index, columns=columns['features'], copy=False))
+        if 'labels' in columns:
+            labels.append(pd.DataFrame(y, index=index, columns=columns['labels']))
+        else:
+            labels.append(pd.Series(y, index=index, name=columns['label']))
+
+    return tuple(matrices), tuple(labels)
@@ -0,0 +1,231 @@
+import numpy as np
+from scipy import sparse
+from pipeline.matrix_store import MasterMatrix
+
+
+# Numerical column imputed with its training mean; see FoldEncoder
+IMPUTED_COLUMNS = ['dem_age']
+
+
+def merge_moments(a: tuple, b: tuple) -> tuple:
+    """Merge two (count, mean, M2) moment triples, where M2 is the sum of
+    squared deviations from the mean (Chan et al.'s parallel algorithm).
+    Works elementwise on arrays, one entry per column.
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    safe_n = np.where(n > 0, n, 1)
+    mean = mean_a + delta * n_b / safe_n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / safe_n
+    return n, mean, m2
+
+
+class DateStatistics():
+    """
+    Sufficient statistics of the master matrix, computed once per as_of_date,
+    from which the encoder and scaler of any fold are composed without
+    touching the fold's rows again.
+
+    For every as_of_date this stores the number of rows, the counts of every
+    category (and of nulls) of each categorical column, and the count, mean
+    and sum of squared deviations (M2) of the non-null values of each
+    numerical column, along with its number of nulls.
+
+    Attributes
+    ----------
+    master (MasterMatrix): master matrix the statistics are computed from
+    n_rows (dict): as_of_date -> number of rows
+    cat_counts (dict): as_of_date -> {column: counts}, where counts[0] is the
+        number of nulls and counts[i + 1] the count of category i
+    num_moments (dict): as_of_date -> {column: (count, mean, M2, n_null)}
+
+    Methods
+    -------
+    add_dates(dates): compute the statistics for dates not seen yet
+    category_counts(dates, column): category counts over several dates
+    moments(dates, column): (count, mean, M2, n_null) over several dates
+    """
+
+    def __init__(self, master: MasterMatrix, dates=None):
+        self.master = master
+        self.n_rows = {}
+        self.cat_counts = {}
+        self.num_moments = {}
+        self.add_dates(master.as_of_dates if dates is None else dates)
+
+    def add_dates(self, dates):
+        """Compute the statistics of any dates that were not computed yet."""
+        for d in dates:
+            if d in self.n_rows or d not in self.master.date_ranges:
+                continue
+            start, stop = self.master.date_ranges[d]
+            self.n_rows[d] = stop - start
+
+            self.cat_counts[d] = {}
+            for col in self.master.cat_columns:
+                codes = self.master.column(col)[start:stop]
+                n_categories = len(self.master.categories[col])
+                self.cat_counts[d][col] = np.bincount(codes + 1, minlength=n_categories + 1)
+
+            self.num_moments[d] = {}
+            for col in self.master.num_columns:
+                values = np.asarray(self.master.column(col)[start:stop], dtype=np.float64)
+                not_null = ~np.isnan(values)
+                values = values[not_null]
+                n = len(values)
+                mean = values.mean() if n > 0 else 0.0
+                m2 = ((values - mean) ** 2).sum() if n > 0 else 0.0
+                self.num_moments[d][col] = (n, mean, m2, len(not_null) - n)
+
+    def category_counts(self, dates, column: str) -> np.ndarray:
+        return np.sum([self.cat_counts[d][column] for d in dates], axis=0)
+
+    def moments(self, dates, column: str) -> tuple:
+        n, mean, m2, n_null = 0, 0.0, 0.0, 0
+        for d in dates:
+            n_d, mean_d, m2_d, n_null_d = self.num_moments[d][column]
+            n, mean, m2 = merge_moments((n, mean, m2), (n_d, mean_d, m2_d))
+            n_null += n_null_d
+        return n, mean, m2, n_null
+
+
+class FoldEncoder():
+    """
+    One-hot encoder, mean imputer (for IMPUTED_COLUMNS) and standard scaler of
+    a single fold, composed from per-date statistics in O(#dates) instead of
+    being fit on the fold's rows. It gives the same result as fitting
+    OneHotEncoder(handle_unknown='ignore') and StandardScaler on the training
+    rows: categories are those seen in training (nulls last), unseen
+    validation categories encode to all zeros, and constant features keep a
+    scale of 1.
+
+    Attributes
+    ----------
+    cat_columns (list): categorical feature columns to one-hot encode
+    num_columns (list): numerical feature columns
+    categories (dict): column -> training categories, with None for nulls
+    impute_values (dict): column -> training mean used to impute nulls
+    mean_ (np.array): per-feature mean of the encoded training matrix
+    scale_ (np.array): per-feature standard deviation of the encoded training matrix
+
+    Methods
+    -------
+    get_feature_names_out(): names of the encoded features
+    transform(master, dates): encoded and scaled matrix for the given dates
+    transform_sparse(master, dates): the same as a CSR matrix, with one-hot
+        columns scaled but not centered so that they stay sparse
+    """
+
+    def __init__(self, stats: DateStatistics, train_dates, cat_columns: list[str], num_columns: list[str]):
+        master = stats.master
+        train_dates = [d for d in sorted(set(train_dates)) if d in stats.n_rows]
+        n_train = sum(stats.n_rows[d] for d in train_dates)
+
+        self.cat_columns = list(cat_columns)
+        self.num_columns = list(num_columns)
+        self.categories = {}
+        self.impute_values = {}
+        self._lookups = {}
+
+        means, variances, counts = [], [], []
+
+        # One-hot columns: the mean of an indicator is the share of rows in its category
+        for col in self.cat_columns:
+            col_counts = stats.category_counts(train_dates, col)
+            seen = np.flatnonzero(col_counts[1:]) + 1
+            if col_counts[0] > 0:
+                seen = np.append(seen, 0)  # nulls sort last, like OneHotEncoder
+            lookup = np.full(len(col_counts), -1, dtype=np.int64)
+            lookup[seen] = np.arange(len(seen))
+
+            self._lookups[col] = lookup
+            self.categories[col] = [master.categories[col][i - 1] if i > 0 else None for i in seen]
+
+            share = col_counts[seen] / n_train
+            means.append(share)
+            variances.append(share * (1 - share))
+            counts.append(np.full(len(seen), n_train))
+
+        # Numerical columns: merge the per-date moments, treating imputed nulls
+        # as a group of rows all equal to the training mean
+        for col in self.num_columns:
+            n, mean, m2, n_null = stats.moments(train_dates, col)
+            if col in IMPUTED_COLUMNS:
+                impute_value = mean if n > 0 else np.nan
+                self.impute_values[col] = impute_value
+                n, mean, m2 = merge_moments((n, mean, m2), (n_null, impute_value, 0.0))
+            means.append([mean])
+            variances.append([m2 / n if n > 0 else 0.0])
+            counts.append([n])
+
+        self.mean_ = np.concatenate(means).astype(np.float64)
+        var = np.maximum(np.concatenate(variances).astype(np.float64), 0)
+        n_samples = np.concatenate(counts).astype(np.float64)
+
+        # Constant features keep a scale of 1 (same criterion as StandardScaler)
+        eps = np.finfo(np.float64).eps
+        constant = var <= n_samples * eps * var + (n_samples * self.mean_ * eps) ** 2
+        self.scale_ = np.where(constant, 1.0, np.sqrt(var))
+
+    def get_feature_names_out(self) -> list[str]:
+        onehot_columns = [
+            f'{col}_{category}' for col in self.cat_columns for category in self.categories[col]
+        ]
+        return onehot_columns + self.num_columns
+
+    def transform(self, master: MasterMatrix, dates, dtype=np.float32) -> np.ndarray:
+        """Encode, impute and scale the rows of the given as_of_dates. The
+        one-hot columns come first, followed by the numerical columns.
+        """
+        n_onehot = sum(len(self.categories[col]) for col in self.cat_columns)
+        onehot = np.zeros((len(master.row_positions(dates)), n_onehot), dtype=np.float64)
+        offset = 0
+        for col in self.cat_columns:
+            positions = self._lookups[col][master.gather(col, dates) + 1]
+            rows = np.flatnonzero(positions >= 0)
+            onehot[rows, offset + positions[rows]] = 1
+            offset += len(self.categories[col])
+
+        numerical = master.read_block(dates, self.num_columns)
+        for col, impute_value in self.impute_values.items():
+            j = self.num_columns.index(col)
+            numerical[np.isnan(numerical[:, j]), j] = impute_value
+
+        X = np.hstack([onehot, numerical])
+        del onehot, numerical
+        X -= self.mean_
+        X /= self.scale_
+        return X.astype(dtype, copy=False)
+
+    def transform_sparse(self, master: MasterMatrix, dates, dtype=np.float32) -> sparse.csr_matrix:
+        """Encode, impute and scale the rows of the given as_of_dates into a
+        CSR matrix. One-hot columns are scaled but not centered, as
+        StandardScaler(with_mean=False) would, so only the ones of every row
+        are stored; numerical columns are centered and scaled as in
+        transform(). The columns are in the order of transform().
+        """
+        n_rows = len(master.row_positions(dates))
+        n_onehot = sum(len(self.categories[col]) for col in self.cat_columns)
+        rows, columns = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        offset = 0
+        for col in self.cat_columns:
+            positions = self._lookups[col][master.gather(col, dates) + 1]
+            col_rows = np.flatnonzero(positions >= 0)
+            rows.append(col_rows)
+            columns.append(offset + positions[col_rows])
+            offset += len(self.categories[col])
+        rows, columns = np.concatenate(rows), np.concatenate(columns)
+        onehot = sparse.csr_matrix(
+            ((1 / self.scale_[columns]).astype(dtype), (rows, columns)), shape=(n_rows, n_onehot)
+        )
+
+        numerical = master.read_block(dates, self.num_columns)
+        for col, impute_value in self.impute_values.items():
+            j = self.num_columns.index(col)
+            numerical[np.isnan(numerical[:, j]), j] = impute_value
+        numerical -= self.mean_[n_onehot:]
+        numerical /= self.scale_[n_onehot:]
+
+        return sparse.hstack([onehot, sparse.csr_matrix(numerical.astype(dtype, copy=False))], format='csr')
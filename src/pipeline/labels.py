@@ -1,10 +1,15 @@
+import re
 import yaml
 from os.path import join
 from utils.helpers import get_database_connection, get_label_tablename
-from utils.constants import CONFIGS_PATH, SQL_CREATE_LABELS_PATH, SQL_LABELS_PATH
+from utils.constants import CONFIGS_PATH, SQL_CREATE_LABELS_PATH, SQL_LABELS_PATH, SQL_LABELS_ALL_DATES_PATH
 from pipeline import time_splitter
 
 
+DATE_PREDICATE = "'{as_of_date}'::date"
+FUTURE_END_PREDICATE = "< ('{as_of_date}'::date + interval '{months_future} months')"
+
+
 def create_empty_labels(db_conn, config, psql_role):
     """Create empty labels table on the database.
 
@@ -22,6 +27,99 @@ def create_empty_labels(db_conn, config, psql_role):
     db_conn.execute("COMMIT")
 
 
+def vectorize_cte_expression(cte_expression):
+    """Rewrite a label cte_expression, written for a single as_of_date, so it
+    computes the labels of all as_of_dates at once. Every CTE of the form
+
+        name as (select joid, true as label from <table> [alias] where ...)
+
+    is joined to the as_of_dates CTE of insert_labels_all_dates.sql and
+    returns (joid, as_of_date, label), with '{as_of_date}'::date replaced by
+    d.as_of_date in its window predicate.
+
+    Inputs:
+        cte_expression (str): cte_expression of a label definition, see config.yaml
+
+    Returns (str) the rewritten expression, or None if it is not of that form.
+    """
+    n_ctes = len(re.findall(r'\bfrom\b', cte_expression, flags=re.IGNORECASE))
+    cte_expression, n_selects = re.subn(
+        r'select\s+joid\s*,\s*true\s+as\s+label\b',
+        'select joid, d.as_of_date as as_of_date, true as label',
+        cte_expression,
+        flags=re.IGNORECASE
+    )
+    cte_expression, n_froms = re.subn(
+        r'(\bfrom\s+[\w.]+(?:\s+(?:as\s+)?(?!where\b)\w+)?)(\s+where\b)',
+        r'\1 cross join as_of_dates d\2',
+        cte_expression,
+        flags=re.IGNORECASE
+    )
+    cte_expression = cte_expression.replace(DATE_PREDICATE, 'd.as_of_date')
+
+    if not (n_ctes == n_selects == n_froms) or '{as_of_date}' in cte_expression:
+        return None
+    return cte_expression
+
+
+def set_label_period(cte_expression, label_period):
+    """Rewrite a label cte_expression for the period over which its outcomes
+    are aggregated: with label_period 'any', its window ends today instead of
+    months_future months after the as_of_date.
+
+    Inputs:
+        cte_expression (str): cte_expression of a label definition, see config.yaml
+        label_period (str): 'validation_period' or 'any', see create_split_labels
+
+    Returns (str) the rewritten expression.
+    """
+    if label_period == 'any':
+        return cte_expression.replace(FUTURE_END_PREDICATE, '< current_date')
+    return cte_expression
+
+
+def insert_labels_all_dates(db_conn, as_of_dates, label_tablename, county, cte_queries, combination_queries, dates_per_query=None):
+    """Insert the labels of all as_of_dates, and all label names, with a single
+    set-based query (or one per chunk of dates_per_query dates), instead of
+    one query per as_of_date.
+
+    Inputs:
+        db_conn (sqlalchemy.engine.base.Connection): database connection
+        as_of_dates (list of str): dates of reference for cohort
+        label_tablename (str): table to insert into, in the modeling schema
+        county (str): quoted counties of the cohort, e.g. "'doco', 'joco'"
+        cte_queries (list of str): formatted output of vectorize_cte_expression
+        combination_queries (dict): label name -> combination query of its CTEs
+        dates_per_query (int): number of as_of_dates per query, all if None
+    """
+    as_of_dates = list(as_of_dates)
+    dates_per_query = dates_per_query or max(len(as_of_dates), 1)
+
+    labels_query = '\nunion\n'.join([
+        f"select joid, as_of_date, label, '{label_name}' as label_name from (\n{combination_query}\n) l{i}"
+        for i, (label_name, combination_query) in enumerate(combination_queries.items())
+    ])
+    label_names = ', '.join([f"'{label_name}'" for label_name in combination_queries])
+
+    with open(SQL_LABELS_ALL_DATES_PATH, 'r') as f:
+        query = f.read()
+
+    for i in range(0, len(as_of_dates), dates_per_query):
+        dates_chunk = as_of_dates[i:i + dates_per_query]
+
+        formatted_query = query.format(
+            label_tablename=label_tablename,
+            as_of_dates=', '.join([f"'{d}'" for d in dates_chunk]),
+            cte_query=', '.join(cte_queries),
+            labels_query=labels_query,
+            label_names=label_names,
+            county=county
+        )
+
+        db_conn.execute(formatted_query)
+        db_conn.execute("COMMIT")
+
+
 def insert_labels(db_conn, as_of_dates, config):
     """Insert the labels data on the database.
 
@@ -34,6 +132,9 @@ def insert_labels(db_conn, as_of_dates, config):
                 the label is set (e.g. commit suicide/overdose within the next 6 months)
             - selected_labels: labels we want to join
             - definitions: definition of the labels, see config.yaml
+            - set_based: whether to insert all dates with one set-based query (default);
+                falls back to one query per date if a cte_expression cannot be vectorized
+            - dates_per_query: optional number of dates per set-based query
 
     Returns (str) label names.
     """
@@ -61,6 +162,21 @@ def insert_labels(db_conn, as_of_dates, config):
     cte_query = 'with ' + ', '.join(cte_queries)
     combination_query = ' union '.join(combination_queries)
 
+    if config.get('set_based', True):
+        vectorized_queries = [vectorize_cte_expression(q) for q in cte_queries]
+        if None not in vectorized_queries:
+            insert_labels_all_dates(
+                db_conn,
+                as_of_dates,
+                label_tablename,
+                county,
+                [q.format(label_name=label_name, months_future=months_future) for q in vectorized_queries],
+                {label_name: combination_query},
+                config.get('dates_per_query')
+            )
+            return label_names
+        print('Label cte_expressions cannot be vectorized, inserting labels one as_of_date at a time')
+
     with open(SQL_LABELS_PATH, 'r') as f:
         query = f.read()
 
@@ -99,6 +215,8 @@ def create_split_labels(db_conn, as_of_dates, config, psql_role, label_period =
                 the label is set (e.g. commit suicide/overdose within the next 6 months)
             - selected_labels: labels we want to join
             - definitions: definition of the labels, see config.yaml
+            - set_based: whether to insert all dates and definitions with one
+                set-based query (default), as in insert_labels
         label_period (str) the period over which to aggragate label outcomes.
             - 'validation_period' will look only over the validation period used for the model
             - 'any' will look over all future dates after the as_of_date
@@ -126,8 +244,32 @@ def create_split_labels(db_conn, as_of_dates, config, psql_role, label_period =
     db_conn.execute('COMMIT')
 
     # Get config information
+    county = config['county']
     config = config['labels']
     months_future = str(config['months_future'])
+    county = "'doco', 'joco'" if county == 'both' else "'" + county + "'"
+
+    if config.get('set_based', True):
+        cte_queries = []
+        combination_queries = {}
+        for _, spec in config['definitions'].items():
+            vectorized_query = vectorize_cte_expression(set_label_period(spec['cte_expression'], label_period))
+            if vectorized_query is None or spec['label_name'] in combination_queries:
+                break
+            cte_queries.append(vectorized_query.format(label_name=spec['label_name'], months_future=months_future))
+            combination_queries[spec['label_name']] = spec['combination_query']
+        else:
+            insert_labels_all_dates(
+                db_conn,
+                as_of_dates,
+                label_tablename,
+                county,
+                cte_queries,
+                combination_queries,
+                config.get('dates_per_query')
+            )
+            return
+        print('Label cte_expressions cannot be vectorized, inserting split labels one as_of_date at a time')
 
     with open(SQL_LABELS_PATH, 'r') as f:
         query = f.read()
@@ -152,6 +294,7 @@ def create_split_labels(db_conn, as_of_dates, config, psql_role, label_period =
                 cte_query_update = cte_query_update.replace(date_part, '< current_date')
 
             formatted_query = query.format(
+                county=county,
                 label_tablename=label_tablename,
                 label_name=label_name,
                 as_of_date=as_of_date,
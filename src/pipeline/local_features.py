@@ -0,0 +1,250 @@
+import re
+import datetime
+import numpy as np
+import pandas as pd
+from time import time
+from dateutil.relativedelta import relativedelta
+from utils.helpers import get_database_engine, read_sql
+from pipeline.matrix_cache import get_table_base_name
+
+
+# Events and as of dates are compared as a single sorted key, joid * DAYS_SPAN
+# + days since 1970-01-01 + DAYS_OFFSET, which covers dates from year -768
+DAYS_OFFSET = 1000000
+DAYS_SPAN = 2 * DAYS_OFFSET
+EPOCH = datetime.date(1970, 1, 1)
+
+INTERVAL_UNITS = {'day': 'days', 'week': 'weeks', 'month': 'months', 'year': 'years'}
+
+
+def interval_offset(interval: str) -> relativedelta:
+    """Offset of an interval of whole days, weeks, months or years (e.g.
+    '3 months'), with the calendar arithmetic of Postgres' date - interval:
+    2019-03-31 - interval '1 month' is 2019-02-28.
+    """
+    match = re.match(r'^(\d+)\s+(day|week|month|year)s?$', interval.strip(), flags=re.IGNORECASE)
+    if match is None:
+        raise Exception(f'The local feature engine does not support interval {interval}.')
+    return relativedelta(**{INTERVAL_UNITS[match.group(2).lower()]: int(match.group(1))})
+
+
+def to_days(dates) -> np.ndarray:
+    """Days since 1970-01-01 of an iterable of dates, as int64."""
+    return np.array([(pd.Timestamp(d).date() - EPOCH).days for d in dates], dtype=np.int64)
+
+
+def window_start_days(as_of_days, interval) -> dict:
+    """First day of the window of every as of date: as_of_date - interval, or
+    the start of time for the whole history (interval None).
+
+    Args:
+    ---
+    as_of_days: as of dates, in days since 1970-01-01
+    interval: interval of whole days, weeks, months or years, or None
+
+    Returns a dictionary mapping the as of date to the start, both in days.
+    """
+    starts = {}
+    for as_of_day in np.unique(as_of_days):
+        if interval is None:
+            start = -DAYS_OFFSET
+        else:
+            as_of_date = EPOCH + datetime.timedelta(days=int(as_of_day))
+            start = max((as_of_date - interval_offset(interval) - EPOCH).days, -DAYS_OFFSET)
+        starts[int(as_of_day)] = start
+    return starts
+
+
+def window_reduce(ufunc, values: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """ufunc.reduce (e.g. np.fmax) of values[lo:hi] for every pair of bounds,
+    nan for empty windows."""
+    result = np.full(len(lo), np.nan)
+    nonempty = lo < hi
+    if not nonempty.any():
+        return result
+    padded = np.append(values, np.nan)  # hi can be len(values)
+    bounds = np.column_stack([lo[nonempty], hi[nonempty]]).ravel()
+    result[nonempty] = ufunc.reduceat(padded, bounds)[::2]
+    return result
+
+
+def compute_features(event_joids, event_days, event_values, cohort_joids, cohort_days, specs) -> np.ndarray:
+    """Compute features of cohort rows from the events of their people.
+
+    Every feature is its aggregate of its value column over the events of the
+    person in the days [window start, as of date), imputed where that is null
+    (no non-null values, except for COUNT).
+
+    Args:
+    ---
+    event_joids, event_days: joid and day (days since 1970-01-01) of every event
+    event_values: 2d array with one column of values (nan for null) per spec
+    cohort_joids, cohort_days: joid and as of date (in days) of every cohort row
+    specs: feature specifications, see features.get_local_feature_specs()
+
+    Returns a 2d float64 array with a row per cohort row and a column per spec.
+    """
+    order = np.lexsort((event_days, event_joids))
+    keys = event_joids[order] * DAYS_SPAN + event_days[order] + DAYS_OFFSET
+    event_values = event_values[order]
+    cohort_keys = cohort_joids * DAYS_SPAN + DAYS_OFFSET
+
+    # Events strictly before the as of date
+    hi = np.searchsorted(keys, cohort_keys + cohort_days, side='left')
+
+    features = np.empty((len(cohort_joids), len(specs)))
+    window_lo = {}
+    for i, spec in enumerate(specs):
+        if spec['interval'] not in window_lo:
+            starts = window_start_days(cohort_days, spec['interval'])
+            start_days = np.array([starts[d] for d in cohort_days], dtype=np.int64)
+            window_lo[spec['interval']] = np.searchsorted(keys, cohort_keys + start_days, side='left')
+        lo = window_lo[spec['interval']]
+
+        values = event_values[:, i]
+        not_null = ~np.isnan(values)
+        counts = np.concatenate([[0], np.cumsum(not_null)])
+        n = counts[hi] - counts[lo]
+
+        agg_func = spec['agg_func']
+        if agg_func in ['SUM', 'AVG']:
+            sums = np.concatenate([[0.0], np.cumsum(np.where(not_null, values, 0.0))])
+            feature = sums[hi] - sums[lo]
+            if agg_func == 'AVG':
+                feature = feature / np.maximum(n, 1)
+            feature[n == 0] = np.nan
+        elif agg_func == 'COUNT':
+            feature = n.astype(np.float64)
+        elif agg_func == 'MAX':
+            feature = window_reduce(np.fmax, values, lo, hi)
+        elif agg_func == 'MIN':
+            feature = window_reduce(np.fmin, values, lo, hi)
+        else:
+            raise Exception(f'The local feature engine does not support {agg_func}.')
+
+        if spec['days_since']:
+            feature = cohort_days - feature
+        features[:, i] = np.where(np.isnan(feature), spec['impute'], feature)
+
+    return features
+
+
+def get_events_query(conf: dict, specs: list, as_of_dates) -> str:
+    """Query streaming the events of a source table in joid order: the joid,
+    the day of the knowledge date, and the value of every spec, restricted to
+    the people of the cohort and to events before the last as of date.
+    """
+    as_of_dates_str = ', '.join([f"'{d}'" for d in as_of_dates])
+    values = ', '.join([f"({spec['value']})::double precision as value_{i}" for i, spec in enumerate(specs)])
+    return f"""
+        select t.joid, t.{conf['knowledge_date']}::date - date '1970-01-01' as event_day, {values}
+        from {conf['from_arg']} t
+        where t.joid in (select joid from modeling.cohort where as_of_date in ({as_of_dates_str}))
+            and t.{conf['knowledge_date']} < (select max(as_of_date) from modeling.cohort where as_of_date in ({as_of_dates_str}))
+        order by t.joid;
+        """
+
+
+def iter_event_chunks(cursor, chunk_rows: int):
+    """Read the rows of an executed events query (see get_events_query()) in
+    chunks of about chunk_rows rows, never splitting the events of a person.
+
+    Yields (events, stop_joid): a dataframe with every event of the people
+    with joid < stop_joid not yet yielded, and None for the last chunk.
+    """
+    columns = [d[0] for d in cursor.description]
+    pending = None
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        if not rows:
+            yield chunk, None
+            return
+        last_joid = chunk['joid'].iloc[-1]
+        is_last = (chunk['joid'] == last_joid).to_numpy()
+        pending = chunk[is_last]
+        yield chunk[~is_last], last_joid
+
+
+def compute_feature_table(cursor, cohort: pd.DataFrame, specs: list, chunk_rows: int = 1000000) -> pd.DataFrame:
+    """Compute a feature table from an executed events query, one chunk of
+    people at a time.
+
+    Args:
+    ---
+    cursor: cursor of an executed events query (see get_events_query())
+    cohort: cohort rows, with columns joid and as_of_date
+    specs: feature specifications, see features.get_local_feature_specs()
+    chunk_rows: number of events read at a time
+
+    Returns a dataframe with the features of every cohort row, indexed by
+    (joid, as_of_date) in the order of cohort.
+    """
+    cohort_joids = cohort['joid'].to_numpy(dtype=np.int64)
+    cohort_days = to_days(cohort['as_of_date'])
+    order = np.argsort(cohort_joids, kind='stable')
+    sorted_joids = cohort_joids[order]
+
+    features = np.empty((len(cohort), len(specs)))
+    start = 0
+    for events, stop_joid in iter_event_chunks(cursor, chunk_rows):
+        stop = len(sorted_joids) if stop_joid is None else np.searchsorted(sorted_joids, stop_joid, side='left')
+        rows = order[start:stop]
+        event_values = events[[f'value_{i}' for i in range(len(specs))]].to_numpy(dtype=np.float64, na_value=np.nan)
+        features[rows] = compute_features(
+            events['joid'].to_numpy(dtype=np.int64),
+            events['event_day'].to_numpy(dtype=np.int64),
+            event_values,
+            cohort_joids[rows],
+            cohort_days[rows],
+            specs
+        )
+        start = stop
+
+    index = pd.MultiIndex.from_arrays([cohort['joid'], cohort['as_of_date']], names=['joid', 'as_of_date'])
+    return pd.DataFrame(features, index=index, columns=[spec['feature_name'] for spec in specs])
+
+
+def compute_local_features(db_conn, config: dict, local_tables: dict, as_of_dates) -> pd.DataFrame:
+    """Compute the feature tables of the local engine for the cohort rows of
+    the given as of dates. The source tables are streamed out of the database
+    with server-side cursors; all aggregation happens locally.
+
+    Args:
+    ---
+    db_conn: database connection
+    config: config.yaml dictionary; local_feature_chunk_rows sets the number
+        of events read at a time
+    local_tables: output of features.get_local_feature_tables()
+    as_of_dates: as of dates
+
+    Returns a dataframe with the features of every table, indexed by (joid, as_of_date).
+    """
+    as_of_dates_str = ', '.join([f"'{d}'" for d in as_of_dates])
+    cohort = read_sql(
+        f'select joid, as_of_date from modeling.cohort where as_of_date in ({as_of_dates_str});', db_conn
+    )
+    chunk_rows = int(config.get('local_feature_chunk_rows', 1000000))
+
+    dfs = []
+    for table_name, specs in local_tables.items():
+        start = time()
+        conf = config['features'][get_table_base_name(table_name)]
+        conn = get_database_engine().raw_connection()
+        try:
+            cursor = conn.cursor(name=f'local_features_{table_name}')
+            cursor.itersize = chunk_rows
+            cursor.execute(get_events_query(conf, specs, as_of_dates))
+            dfs.append(compute_feature_table(cursor, cohort, specs, chunk_rows))
+            cursor.close()
+            conn.rollback()
+        finally:
+            conn.close()
+        print(f'computed {table_name} locally in {time() - start:.1f}s')
+
+    if not dfs:
+        index = pd.MultiIndex.from_arrays([cohort['joid'], cohort['as_of_date']], names=['joid', 'as_of_date'])
+        return pd.DataFrame(index=index)
+    return pd.concat(dfs, axis=1)
@@ -4,24 +4,39 @@ import numpy as np
 import os
 import pandas as pd
 import pickle as p
-import zlib
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
+import shutil
+from joblib import Parallel, delayed
 from time import time
-from utils.helpers import get_database_connection, get_column_names
+from utils.helpers import get_database_connection, get_database_engine, get_column_names, read_sql
 from pipeline.time_splitter import get_time_split, get_train_and_val_dates
+from pipeline.matrix_store import MasterMatrix, MasterStoreWriter
+from pipeline.fold_encoding import DateStatistics, FoldEncoder
+from pipeline.fold_arrays import sparse_frame, write_sparse_matrices, load_sparse_matrices
+from pipeline.matrix_cache import get_source_fingerprints, get_local_source_fingerprints, master_fingerprint, fold_fingerprint, get_table_base_name, COHORT_KEY
+from pipeline.features import get_local_feature_tables, get_source_signatures
+from pipeline.local_features import compute_local_features
 from utils.constants import (
-    MASTER_MATRIX_DIR, MASTER_MATRIX_PATH,
+    MASTER_MATRIX_DIR, MASTER_STORE_DIR,
     SMALL_MATRICES_DIR
 )
 
-print('master_df path: ', MASTER_MATRIX_PATH)
-print('master df exists: ', os.path.exists(MASTER_MATRIX_PATH))
+# Suffix of the file names of sparse small matrices (see write_small_mats())
+SPARSE_MATRIX_SUFFIX = '.npz'
+
+# Postgres types of the feature columns the master store can store as integers
+INTEGER_TYPES = ['smallint', 'integer', 'bigint']
+
+print('master store path: ', MASTER_STORE_DIR)
+print('master store exists: ', os.path.exists(MASTER_STORE_DIR))
 
 
 def delete_matrices_from_disk():
-    """Delete the master_df and small matrices from disk."""
-    # Remove master_df
-    os.remove(MASTER_MATRIX_PATH)
+    """Delete the master store and small matrices from disk. Not needed when
+    features are rebuilt, since matrices are keyed on their sources (see
+    matrix_cache.py); useful to free disk space from stale matrices."""
+    # Remove master store
+    if os.path.exists(MASTER_STORE_DIR):
+        shutil.rmtree(MASTER_STORE_DIR)
     # remove small mats
     for filename in os.listdir(SMALL_MATRICES_DIR):
         path = os.path.join(SMALL_MATRICES_DIR, filename)
@@ -54,45 +69,91 @@ def get_cat_and_num_table_names(table_names: list[str]) -> tuple[list[str], list
     return cat_tables, num_tables
 
 
-def standardize_data(X_train: pd.DataFrame, X_val: pd.DataFrame, dtype=np.float32):
-    """Scale train and validation features to be standard normal variables
-    (mean of 0 and standard deviation of 1).
-    """
-    scaler = StandardScaler()
-    col_names = X_train.columns
-    train_idx = X_train.index
-    X_train = pd.DataFrame(scaler.fit_transform(X_train), columns=col_names, index=train_idx, dtype=dtype)
-    val_idx = X_val.index
-    X_val = pd.DataFrame(scaler.transform(X_val), columns=col_names, index=val_idx, dtype=dtype)
-    return X_train, X_val
-
-
-def get_features_matrix(db_conn, feats_schema: str, tables: list[str], mod_schema: str, all_dates_str: str):
-    """Get features dataframe for all dates in all_dates_str.
+def get_features_query(feats_schema: str, table_columns: dict, mod_schema: str, all_dates_str: str) -> str:
+    """Query joining the cohort rows of all dates in all_dates_str with the
+    given columns of every feature table, in (as_of_date, joid) order.
 
     Args:
     ----
     feats_schema: features' schema name
-    tables: names of tables to get features from
+    table_columns: feature table name -> names of its feature columns
     mod_schema: modeling schema name
     all_dates_str: sql-compatible array of dates, as a string
     """
+    select_cols = ''.join([
+        f', t{i}.{col}' for i, columns in enumerate(table_columns.values()) for col in columns
+    ])
     join_q = ' '.join([f"""
         join {feats_schema}.{table} t{i}
-        using (joid, as_of_date)""" for i, table in enumerate(tables)])
-    query = f"""
-        select *
-        from (select joid, as_of_date from {mod_schema}.cohort) c {join_q}
-        where as_of_date in {all_dates_str};
+        on t{i}.joid = c.joid and t{i}.as_of_date = c.as_of_date""" for i, table in enumerate(table_columns)])
+    return f"""
+        select c.joid, c.as_of_date{select_cols}
+        from (select joid, as_of_date from {mod_schema}.cohort where as_of_date in {all_dates_str}) c {join_q}
+        order by c.as_of_date, c.joid;
         """
 
-    return pd.read_sql(query, db_conn, index_col=['joid', 'as_of_date'])
 
+def plan_num_dtypes(source_fingerprints: dict, num_tables: list[str], local_tables: dict) -> dict:
+    """dtypes numerical features are streamed into the master store as.
+    Integer columns (e.g. counts) and the whole-number features of the local
+    engine are streamed as float64, so that the master store can downcast
+    them to int16 or int32 once their range is known (see
+    matrix_store.downcast_dtype()); all other features are stored as float32.
+
+    Args:
+    ----
+    source_fingerprints: as returned by matrix_cache.get_source_fingerprints()
+    num_tables: names of the numerical feature tables in the database
+    local_tables: output of features.get_local_feature_tables()
 
-def get_one_hot_encoder():
-    """ Use our desired one_hot_encoder settings.
+    Returns a dictionary of column name -> dtype.
     """
-    return OneHotEncoder(drop=None, handle_unknown='ignore', sparse=False)
+    num_dtypes = {}
+    for tn in num_tables:
+        for col, data_type in source_fingerprints[tn]['columns']:
+            if col in ['joid', 'as_of_date']:
+                continue
+            num_dtypes[col] = np.float64 if data_type in INTEGER_TYPES else np.float32
+    for specs in local_tables.values():
+        for spec in specs:
+            whole_numbers = spec['agg_func'] == 'COUNT' or spec['days_since']
+            num_dtypes[spec['feature_name']] = np.float64 if whole_numbers else np.float32
+    return num_dtypes
+
+
+def stream_features_matrix(query: str, writer: MasterStoreWriter, chunk_rows: int, local_df: pd.DataFrame = None):
+    """Read the rows of a features query (see get_features_query()) through a
+    server-side cursor, chunk_rows rows at a time, and append every chunk to
+    the master store as it arrives, so the whole matrix is never in memory.
+
+    Args:
+    ----
+    query: features query, in (as_of_date, joid) order
+    writer: master store writer the chunks are appended to
+    chunk_rows: number of rows read at a time
+    local_df: features computed by the local engine, indexed by (joid,
+        as_of_date), joined to every chunk
+    """
+    conn = get_database_engine().raw_connection()
+    try:
+        cursor = conn.cursor(name='master_matrix')
+        cursor.itersize = chunk_rows
+        cursor.execute(query)
+        columns = None
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            columns = columns or [d[0] for d in cursor.description]
+            chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True, index=['joid', 'as_of_date'])
+            if local_df is not None:
+                chunk = chunk.join(local_df)
+            writer.append(chunk)
+            print(f'  appended {writer.n_rows} rows to the master store')
+        cursor.close()
+        conn.rollback()
+    finally:
+        conn.close()
 
 
 def get_all_dates_master(train_dates: list[list], validate_dates: list) -> tuple[list, list, list]:
@@ -111,85 +172,128 @@ def make_str_array(iterable) -> str:
     return '(' + ', '.join([f"'{item}'" for item in iterable]) + ')'
 
 
-def get_master_df(db_conn, train_dates: list[list[datetime.date]], validate_dates: list[datetime.date]) -> dict:
-    """ Writes (if necessary) and returns a dataframe's with all joid and
+def get_master_df(db_conn, config: dict, train_dates: list[list[datetime.date]], validate_dates: list[datetime.date]) -> dict:
+    """ Writes (if necessary) and returns the master matrix with all joid and
     as_of_dates that will be required to create the smaller training and
-    validation matrices / dataframes.
+    validation matrices / dataframes. The master matrix is stored on disk as a
+    columnar store (see matrix_store.py) and returned as a memory-mapped
+    MasterMatrix, so only the dates and columns a fold needs are ever read.
+
+    The store is keyed on a fingerprint of the feature tables and cohort it is
+    built from (see matrix_cache.py); it is rebuilt when the fingerprint changes.
 
     Args:
     ----
     db_conn: database connection
+    config: config.yaml dictionary
     train_dates: training dates to include in master df
     validate_dates: validate dates to include in master df
 
-    Returns a dictionary with keys master_df, num_columns, and cat_columns.
+    Returns a dictionary with keys master_matrix, num_columns, cat_columns,
+    and source_fingerprints.
     """
     for tds, validate_date in zip(train_dates, validate_dates):
         assert max(tds) < validate_date
 
-    # If master_df already present, load it
-    if os.path.exists(MASTER_MATRIX_PATH):
-      print('loading master_df')
-      with open(MASTER_MATRIX_PATH, 'rb') as f:
-          # Loads a dict, with keys 'master_df', 'num_columns', and 'cat_columns'
-          matrices_dict = p.load(f)
-      return matrices_dict
-
-    # Master df does not exist already, compute it, store it and return it
-    print('computing master_df')
     # TODO: Streamline loading settings; remove hardcoded strings (eventually)
     feats_schema = 'features'
     mod_schema = 'modeling'
     _, _, all_dates = get_all_dates_master(train_dates, validate_dates)
     all_dates_str = make_str_array(all_dates)
 
-    # Get feature table names
-    table_names = get_feature_table_names(db_conn, feats_schema)
+    # Get feature table names and describe the tables the matrices are built from.
+    # The tables of the local feature engine are computed here, not read from the database
+    local_tables = get_local_feature_tables(config)
+    table_names = [tn for tn in get_feature_table_names(db_conn, feats_schema) if tn not in local_tables]
     cat_tables, num_tables = get_cat_and_num_table_names(table_names) # categorical and numerical feature table names
+    source_fingerprints = get_source_fingerprints(db_conn, config, table_names, feats_schema, mod_schema)
+    local_sources = set(get_table_base_name(tn) for tn in local_tables)
+    source_signatures = {
+        base_name: get_source_signatures(db_conn, config['features'][base_name], all_dates)
+        for base_name in local_sources
+    }
+    source_fingerprints.update(get_local_source_fingerprints(
+        config, local_tables, source_fingerprints[COHORT_KEY], source_signatures
+    ))
+    fingerprint = master_fingerprint(source_fingerprints, all_dates)
+
+    # If the master store is already present and built from the same sources, memory-map it
+    if os.path.exists(MASTER_STORE_DIR):
+        matrices_dict = open_master_matrix()
+        if matrices_dict['master_matrix'].fingerprint == fingerprint:
+            print('loading master store')
+            matrices_dict['source_fingerprints'] = source_fingerprints
+            return matrices_dict
+        print('master store is stale, removing it')
+        del matrices_dict
+        shutil.rmtree(MASTER_STORE_DIR)
 
-    # Load dataframes for categorical and numerical features
-    num_df = get_features_matrix(db_conn, feats_schema, num_tables, mod_schema, all_dates_str)
-    # TODO: Handle this imputation check somewhere
-    # assert(sum(num_df.isna().any()) < 2)  # At most 1 numerical col with nulls (dem_age). If there are more should remake the features and  labels tables
+    # Master df does not exist already, compute it, store it and return it
+    print('computing master_df')
 
-    cat_df = get_features_matrix(db_conn, feats_schema, cat_tables, mod_schema, all_dates_str)
+    # Feature columns of every table; local features are computed before streaming the rest
+    table_columns = {
+        tn: [col for col, _ in source_fingerprints[tn]['columns'] if col not in ['joid', 'as_of_date']]
+        for tn in cat_tables + num_tables
+    }
+    num_dtypes = plan_num_dtypes(source_fingerprints, num_tables, local_tables)
+    local_df = None
+    if local_tables:
+        local_df = compute_local_features(db_conn, config, local_tables, all_dates)
+        local_df = local_df.astype({col: num_dtypes[col] for col in local_df.columns})
 
     # Ensure there are no repeated feature names
-    num_columns = list(num_df.columns)
-    cat_columns = list(cat_df.columns)
+    num_columns = [col for tn in num_tables for col in table_columns[tn]] + ([] if local_df is None else list(local_df.columns))
+    cat_columns = [col for tn in cat_tables for col in table_columns[tn]]
     if len(set(num_columns + cat_columns)) != len(num_columns + cat_columns):
         repeated_cols = set(num_columns) & set(cat_columns)
         raise Exception(f'{repeated_cols} are both numerical and categorical feature(s).')
 
-    # Features dataframe
-    feats_df = cat_df.join(num_df)
+    # Make master matrix directory if it does not exist
+    if not os.path.exists(MASTER_MATRIX_DIR):
+        os.makedirs(MASTER_MATRIX_DIR)
 
-    to_write = {
-        'master_df': feats_df,
-        'num_columns': num_columns,
-        'cat_columns': cat_columns,
-    }
+    # Stream the features into the master store, then downcast them to compact dtypes
+    start = time()
+    writer = MasterStoreWriter(num_columns, cat_columns, MASTER_STORE_DIR, fingerprint, num_dtype=num_dtypes, downcast=True)
+    query = get_features_query(feats_schema, table_columns, mod_schema, all_dates_str)
+    stream_features_matrix(query, writer, int(config.get('master_chunk_rows', 500000)), local_df)
+    writer.close()
+    del local_df
+    print(f'wrote the master store ({writer.n_rows} rows) in {time() - start:.1f}s')
 
-    # Make master df directory if it does not exist
-    if not os.path.exists(MASTER_MATRIX_DIR):
-        os.mkdirs(MASTER_MATRIX_DIR)
+    matrices_dict = open_master_matrix()
+    matrices_dict['source_fingerprints'] = source_fingerprints
+    return matrices_dict
 
-    with open(MASTER_MATRIX_PATH, 'xb') as f:
-        p.dump(to_write, f)
 
-    return to_write
+def open_master_matrix(path=MASTER_STORE_DIR) -> dict:
+    """Memory-map the master store on disk.
 
+    Returns a dictionary with keys master_matrix, num_columns, and cat_columns.
+    """
+    master = MasterMatrix(path)
+    return {
+        'master_matrix': master,
+        'num_columns': master.num_columns,
+        'cat_columns': master.cat_columns,
+    }
 
-def mat_name_hash(fold_spec, county) -> str:
-    """Use adler32 to get a hash used to name the training and validation
-    smaller matrices / dataframes.
+
+def mat_name_hash(config, fold_spec, county, source_fingerprints) -> str:
+    """Content-addressed name of the training and validation smaller matrices
+    / dataframes: a sha256 of the fold, the county, the encoding settings and
+    the fingerprints of the feature tables the matrices are built from (see
+    matrix_cache.fold_fingerprint()).
 
     Args:
     ---
+    config: config.yaml dictionary
     fold_spec: one of the fold outputs from time_splitter::get_time_split
+    county: county string
+    source_fingerprints: as returned by get_master_df()['source_fingerprints']
     """
-    data_to_hash = (str(fold_spec) + str(county)).encode('utf-8')
-    return str(zlib.adler32(data_to_hash) & 0xffffffff)
+    return fold_fingerprint(source_fingerprints, config, fold_spec, county)
 
 
 def get_county_columns(config, county):
@@ -197,6 +301,7 @@ def get_county_columns(config, county):
     county. """
     # TODO: Implement
     db_conn = get_database_connection()
+    local_tables = get_local_feature_tables(config)
     table_names = []
     for table_name in config['features']:
         if config['features'][table_name]['county'] in [county, 'both']:
@@ -206,7 +311,11 @@ def get_county_columns(config, county):
     for table_name in table_names:
         for actual_table_name in [table_name + end for end in ['_num', '_cat']]:
             # actual_table_name is the name of the table in the features schema
-            column_names += list(get_column_names(db_conn, actual_table_name, schema='features'))
+            if actual_table_name in local_tables:
+                column_names += [spec['feature_name'] for spec in local_tables[actual_table_name]]
+            else:
+                column_names += list(get_column_names(db_conn, actual_table_name, schema='features'))
+    db_conn.close()
 
     return set(column_names) - columns_to_exclude
 
@@ -231,7 +340,7 @@ def load_labels(db_conn, county, folds_spec, label_tablename):
             and county in({county_str});
         '''
 
-        df_label = pd.read_sql(query, db_conn, index_col=['joid', 'as_of_date'])
+        df_label = read_sql(query, db_conn, index_col=['joid', 'as_of_date'])
 
         train_slice = (slice(None), train_dates)
         val_slice = (slice(None), [validate_date])
@@ -243,23 +352,38 @@ def load_labels(db_conn, county, folds_spec, label_tablename):
     return labels_dict
 
 
-def write_small_mats(config, df, num_columns, cat_columns, fold_spec, county, county_columns):
+def write_small_mats(config, master, num_columns, cat_columns, fold_spec, county, county_columns, matrix_name, date_stats=None):
     """Compute (if necessary) smaller training and validation matrices and save
     to disk. Will write a tuple of train and validation matrix / datframe, in
-    that order.
+    that order. Only the fold's dates and the county's columns are read from
+    the memory-mapped master matrix.
+
+    Categorical features are one-hot encoded, age is imputed with its training
+    mean and all features are standardized. The encoder and scaler are
+    composed from per-as_of_date statistics (see fold_encoding.py), which are
+    shared by all folds, rather than refit on the fold's training rows.
+
+    With config['sparse_matrices'], the one-hot columns are scaled but not
+    centered, so they stay sparse: the matrices are CSR matrices, stored as a
+    .npz file (see fold_arrays.write_sparse_matrices()) and loaded as
+    dataframes of sparse columns. Otherwise they are dense float32
+    dataframes, pickled.
 
     Args:
     ---
     config: loaded config.yaml
-    df: master_df as returned by get_master_df()['master_df']
+    master: MasterMatrix as returned by get_master_df()['master_matrix']
     num_columns: names of numerical feature columns
     cat_columns: names of categorical feature columns
     fold_spec: single fold, from time_splitter::get_time_split()
     county: county string
     county_columns: columns relevant to the selected county
+    matrix_name: file name of the matrices, from mat_name_hash()
+    date_stats: DateStatistics of the master matrix; computed for the fold's
+        dates if not given
     """
     # Check if matrices already exist
-    matrices_path = os.path.join(SMALL_MATRICES_DIR, mat_name_hash(fold_spec, county))
+    matrices_path = os.path.join(SMALL_MATRICES_DIR, matrix_name)
     if os.path.exists(matrices_path):
         print(f'matrix for fold {fold_spec} and county {county} already exists. Loading...')
         return
@@ -267,22 +391,6 @@ def write_small_mats(config, df, num_columns, cat_columns, fold_spec, county, co
     print('Writing small train / val matrices')
 
     train_dates, validate_date = fold_spec
-    # TODO: instead of these slices, consider using df.index.get_level_values_of('as_of_date').isin(train_dates)
-    train_slice = (slice(None), list(train_dates))
-    none_slice = (slice(None), slice(None))  # silly but necessary for the multi-index
-    validate_slice = (slice(None), [validate_date])
-    train_df = pd.DataFrame(df.loc[train_slice, :])
-    validate_df = pd.DataFrame(df.loc[validate_slice, :])
-
-    # Check that the dataframes are not empty; this error is usually caused by requesting missing dates
-    error_message = """It is likely that a train or validation date that does not appear in
-        master_features was requested. Check the as_of_dates in features and cohort."""
-    if len(train_df.index) == 0:
-        raise Exception(error_message)
-    if len(validate_df.index) == 0:
-        raise Exception(error_message)
-
-    train_idx, validate_idx = train_df.index, validate_df.index
 
     # If county is not both then drop irrelevant feature columns
     # NOTE: due to the next few lines, the matrices columns orders vary accross different small mat pairs.
@@ -291,66 +399,131 @@ def write_small_mats(config, df, num_columns, cat_columns, fold_spec, county, co
         num_columns = list(set(num_columns) & county_columns)
         cat_columns = list(set(cat_columns) & county_columns)
 
-    # Impute numerical features
-    # NOTE: this only imputes age
-    # TODO: Add a check for imputation of other numerical features if more are to be added
-    train_mean_age = train_df['dem_age'].mean()
-    train_df.loc[none_slice, ['dem_age']] = train_df['dem_age'].fillna(train_mean_age)
-    validate_df.loc[none_slice, ['dem_age']] = validate_df['dem_age'].fillna(train_mean_age)
-
-    # Fit one hot encoder to categorical training features and transform
-    # categorical features for train and validate
-    encoder = get_one_hot_encoder()
-    encoder.fit(train_df[cat_columns])
-    onehot_cat_columns = encoder.get_feature_names_out(cat_columns)
-    train_cat_df = pd.DataFrame(encoder.transform(train_df[cat_columns]), columns=onehot_cat_columns, index=train_idx, dtype=np.float32)
-    validate_cat_df = pd.DataFrame(encoder.transform(validate_df[cat_columns]), columns=onehot_cat_columns, index=validate_idx, dtype=np.float32)
+    # Gather the fold's rows from the master matrix as contiguous blocks, using
+    # the precomputed row ranges of each as_of_date
+    train_idx = master.read_index(train_dates)
+    validate_idx = master.read_index([validate_date])
 
-    train_df = train_cat_df.join(train_df[num_columns])
-    validate_df = validate_cat_df.join(validate_df[num_columns])
+    # Check that the matrices are not empty; this error is usually caused by requesting missing dates
+    error_message = """It is likely that a train or validation date that does not appear in
+        master_features was requested. Check the as_of_dates in features and cohort."""
+    if len(train_idx) == 0:
+        raise Exception(error_message)
+    if len(validate_idx) == 0:
+        raise Exception(error_message)
 
-    # Standardize features
-    train_df, validate_df = standardize_data(train_df, validate_df)
+    # Compose the one hot encoder, age imputation and scaler of the training
+    # dates from their per-date statistics, then transform train and validate
+    # NOTE: this only imputes age
+    # TODO: Add a check for imputation of other numerical features if more are to be added
+    if date_stats is None:
+        date_stats = DateStatistics(master, train_dates)
+    else:
+        date_stats.add_dates(train_dates)
+    encoder = FoldEncoder(date_stats, train_dates, cat_columns, num_columns)
+    col_names = encoder.get_feature_names_out()
+    if int(config.get('sparse_matrices', 0)):
+        train_df = sparse_frame(encoder.transform_sparse(master, train_dates), train_idx, col_names)
+        validate_df = sparse_frame(encoder.transform_sparse(master, [validate_date]), validate_idx, col_names)
+    else:
+        X_train = encoder.transform(master, train_dates)
+        X_validate = encoder.transform(master, [validate_date])
+        train_df = pd.DataFrame(X_train, columns=col_names, index=train_idx, copy=False)
+        validate_df = pd.DataFrame(X_validate, columns=col_names, index=validate_idx, copy=False)
 
     # create small mats' directory if it does not exist
     if not os.path.exists(SMALL_MATRICES_DIR):
-        os.mkdirs(SMALL_MATRICES_DIR)
+        os.makedirs(SMALL_MATRICES_DIR)
 
-    # Write files
-    filename = mat_name_hash(fold_spec, county)
-    path = os.path.join(SMALL_MATRICES_DIR, filename)
+    # Write files; write to a temporary file first and rename it into place so
+    # a crashed (parallel) writer never leaves a half-written matrix behind
+    path = os.path.join(SMALL_MATRICES_DIR, matrix_name)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
     to_write = train_df, validate_df
-    with open(path, 'wb') as f:
-        p.dump(to_write, f)
+    try:
+        with open(tmp_path, 'wb') as f:
+            if matrix_name.endswith(SPARSE_MATRIX_SUFFIX):
+                write_sparse_matrices(*to_write, f)
+            else:
+                p.dump(to_write, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_matrix_n_jobs(config: dict, nr_folds: int) -> int:
+    """Number of worker processes used to write the small matrices. Uses
+    config['matrix_n_jobs'] if given, capped by config['nr_cores'] and the
+    number of folds.
+    """
+    nr_cores = int(config.get('nr_cores', 1))
+    n_jobs = int(config.get('matrix_n_jobs', nr_cores))
+    return max(1, min(n_jobs, nr_cores, nr_folds))
 
 
-def write_matrices_from_master_df(config: dict, df: pd.DataFrame, num_columns: list[str], cat_columns: list[str], fold_specs: list, county: str):
-    """ Use the master dataframe to write the train and validation dataframes
-    to disk for each combination of fold and county.
+def write_matrices_from_master_df(config: dict, master: MasterMatrix, num_columns: list[str], cat_columns: list[str], fold_specs: list, county: str, source_fingerprints: dict) -> dict:
+    """ Use the master matrix to write the train and validation dataframes
+    to disk for each combination of fold and county. Folds are written
+    concurrently by get_matrix_n_jobs() worker processes, each memory-mapping
+    the same read-only master matrix.
 
     Args:
     ---
     config: config.yaml dictionary
-    df: master_df from get_master_df()
+    master: master matrix from get_master_df()
     num_columns: numerical feature column names
     cat_columns: categorical feature column names
     fold_specs: single fold form output of time_splitter::get_time_split()
     county: county
+    source_fingerprints: as returned by get_master_df()['source_fingerprints']
+
+    Returns a dictionary mapping (fold_spec, county) to the matrices' file name.
     """
     # TODO: Can add a further sanity check asserting all train / validate dates are in the index of master_df
     county_columns = get_county_columns(config, county) if county != 'both' else []
-    for i, fold_spec in enumerate(fold_specs):
-        print(f'Writing small mat for {county} fold {i} of {len(fold_specs)}')
-        write_small_mats(config, df, num_columns, cat_columns, fold_spec, county, county_columns)
 
+    # Per-date statistics are computed once and shared by all (overlapping) folds
+    all_train_dates = set(itertools.chain.from_iterable(train_dates for train_dates, _ in fold_specs))
+    date_stats = DateStatistics(master, all_train_dates)
+
+    suffix = SPARSE_MATRIX_SUFFIX if int(config.get('sparse_matrices', 0)) else ''
+    matrix_names = {
+        (fold_spec, county): mat_name_hash(config, fold_spec, county, source_fingerprints) + suffix
+        for fold_spec in fold_specs
+    }
 
-def check_all_small_mats(fold_specs, county):
+    n_jobs = get_matrix_n_jobs(config, len(fold_specs))
+    print(f'Writing {len(fold_specs)} small mats for {county} using {n_jobs} processes')
+    if n_jobs > 1:
+        Parallel(n_jobs=n_jobs)(
+            delayed(write_small_mats)(
+                config, master, num_columns, cat_columns, fold_spec, county, county_columns,
+                matrix_names[(fold_spec, county)], date_stats
+            ) for fold_spec in fold_specs
+        )
+    else:
+        for i, fold_spec in enumerate(fold_specs):
+            print(f'Writing small mat for {county} fold {i} of {len(fold_specs)}')
+            write_small_mats(
+                config, master, num_columns, cat_columns, fold_spec, county, county_columns,
+                matrix_names[(fold_spec, county)], date_stats
+            )
+
+    return matrix_names
+
+
+def check_all_small_mats(matrix_names):
     """Sanity checking function to ensure that all small matrices were saved to
-    disk. """
+    disk.
+
+    Args:
+    ---
+    matrix_names: (fold_spec, county) -> file name, from write_matrix_driver()
+    """
     res = []
     # Test matrices were saved
-    for fold_spec in fold_specs:
-        filename = mat_name_hash(fold_spec, county)
+    for (fold_spec, county), filename in matrix_names.items():
         path = os.path.join(SMALL_MATRICES_DIR, filename)
         res.append((fold_spec, county, os.path.exists(path)))
     return res
@@ -366,6 +539,9 @@ def write_matrix_driver(db_conn, config, make_master_df_only=False, cherry_picke
     make_master_df_only: for testing/ ase purposes will only write the master_df
         to disk and then error out
     cherry_picked_folds: for testing purposes, use only a few cherry picked folds
+
+    Returns a dictionary mapping (fold_spec, county) to the matrices' file
+    name, to be passed to load_matrices().
     """
     print('start')
     start = time()
@@ -374,12 +550,12 @@ def write_matrix_driver(db_conn, config, make_master_df_only=False, cherry_picke
         fold_specs = cherry_picked_folds
 
     train_dates, validate_dates = get_train_and_val_dates(fold_specs)
-    matrices_dict = get_master_df(db_conn, train_dates, validate_dates)
+    matrices_dict = get_master_df(db_conn, config, train_dates, validate_dates)
     print(f'loaded master df in {(time() - start)/60:.2} mins')
     if make_master_df_only:
         raise Exception('Done creating master_df; intentionally erroring to exit code.')
 
-    master_df = matrices_dict['master_df']
+    master = matrices_dict['master_matrix']
     num_columns = matrices_dict['num_columns']
     cat_columns = matrices_dict['cat_columns']
 
@@ -387,18 +563,31 @@ def write_matrix_driver(db_conn, config, make_master_df_only=False, cherry_picke
     print('Using counties ', county)
 
     # Write the small training and validation matrices
-    write_matrices_from_master_df(config, master_df, num_columns, cat_columns, fold_specs, county)
+    matrix_names = write_matrices_from_master_df(
+        config, master, num_columns, cat_columns, fold_specs, county,
+        matrices_dict['source_fingerprints']
+    )
     print(f'created / loaded small mats in {(time() - start)/60:.2} mins')
+    return matrix_names
 
 
-def load_matrices(county, fold_specs):
+def load_matrices(county, fold_specs, matrix_names):
     """Load matrices for all fold_specs and the singular given county
     ('joco', 'doco', or 'both').
+
+    Args:
+    ---
+    county: county string
+    fold_specs: output of time_splitter::get_time_split()
+    matrix_names: (fold_spec, county) -> file name, from write_matrix_driver()
     """
     matrices = {}
     for fold_spec in fold_specs:
-        filename = mat_name_hash(fold_spec, county)
+        filename = matrix_names[(fold_spec, county)]
         path = os.path.join(SMALL_MATRICES_DIR, filename)
+        if filename.endswith(SPARSE_MATRIX_SUFFIX):
+            matrices[(fold_spec, county)] = load_sparse_matrices(path)
+            continue
         with open(path, 'rb') as f:
             matrices[(fold_spec, county)] = p.load(f)
     return matrices
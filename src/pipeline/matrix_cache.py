@@ -0,0 +1,223 @@
+import hashlib
+import json
+import pandas as pd
+from pipeline.fold_encoding import IMPUTED_COLUMNS
+
+
+# Settings used to encode the small matrices. Change (or bump the version)
+# whenever the encoding changes, so that cached matrices are recomputed.
+ENCODING_SETTINGS = {
+    'version': 1,
+    'one_hot': {'handle_unknown': 'ignore', 'nulls': 'own category'},
+    'imputation': {'mean': IMPUTED_COLUMNS},
+    'scaler': 'standard',
+    'dtype': 'float32',
+}
+
+# Encoding of the sparse small matrices, see FoldEncoder.transform_sparse()
+SPARSE_ENCODING_SETTINGS = {'one_hot': 'scaled, not centered', 'format': 'csr'}
+
+COHORT_KEY = 'cohort'
+
+# Entries of a table fingerprint with a value per as_of_date
+PER_DATE_KEYS = ['rows_per_date', 'hash_per_date', 'source_per_date']
+
+# Version of the local feature engine (see local_features.py). Bump it whenever
+# its output changes, so that matrices built from its features are recomputed.
+LOCAL_ENGINE_VERSION = 1
+
+
+def hash_object(obj) -> str:
+    """sha256 of the canonical json representation of obj."""
+    data = json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def date_str(d) -> str:
+    """Canonical string of a date (datetime.date, timestamp or string)."""
+    return str(pd.Timestamp(d).date())
+
+
+def get_table_base_name(table_name: str) -> str:
+    """Name of the config['features'] entry a feature table was created from,
+    i.e. the table name without its _num / _cat ending.
+    """
+    return table_name.rsplit('_', 1)[0]
+
+
+def get_content_per_date(db_conn, table: str) -> tuple[dict, dict]:
+    """Number of rows and hash of the contents of every as_of_date of a table.
+
+    The hash is the sum of the hashes of the text of the rows, so it does not
+    depend on their order, and it changes with any value of any row, e.g. when
+    a feature table is rebuilt from corrected source data or a changed query.
+
+    Returns (rows_per_date, hash_per_date), both keyed by date_str().
+    """
+    query = f"""
+        select as_of_date, count(*) as n, sum(hashtext(t::text)::bigint)::varchar as content_hash
+        from {table} t
+        group by as_of_date;
+        """
+    df = pd.read_sql(query, db_conn)
+    dates = [date_str(d) for d in df['as_of_date']]
+    return dict(zip(dates, df['n'].astype(int))), dict(zip(dates, df['content_hash']))
+
+
+def get_source_fingerprints(db_conn, config: dict, table_names: list[str], feats_schema: str = 'features', mod_schema: str = 'modeling') -> dict:
+    """Describe the sources of the matrices, so that cached matrices can be
+    reused exactly when their sources did not change.
+
+    Every feature table is described by the config specification it was
+    created from, its columns and their types, and its number of rows and the
+    hash of its contents per as_of_date (see get_content_per_date()). The
+    cohort is described by its config and its rows and hash per as_of_date.
+
+    Args:
+    ---
+    db_conn: database connection
+    config: config.yaml dictionary
+    table_names: feature table names, as in get_feature_table_names()
+    feats_schema: features' schema name
+    mod_schema: modeling schema name
+
+    Returns a dictionary with one entry per feature table, plus the cohort.
+    """
+    table_names_str = '(' + ', '.join([f"'{tn}'" for tn in table_names]) + ')'
+    columns_q = f"""
+        select table_name, column_name, data_type
+        from information_schema.columns
+        where table_schema = '{feats_schema}'
+            and table_name in {table_names_str}
+        order by table_name, ordinal_position;
+        """
+    columns_df = pd.read_sql(columns_q, db_conn)
+
+    fingerprints = {}
+    for table_name in table_names:
+        table_columns = columns_df[columns_df['table_name'] == table_name]
+        rows_per_date, hash_per_date = get_content_per_date(db_conn, f'{feats_schema}.{table_name}')
+        fingerprints[table_name] = {
+            'spec': config['features'].get(get_table_base_name(table_name)),
+            'columns': [list(c) for c in zip(table_columns['column_name'], table_columns['data_type'])],
+            'rows_per_date': rows_per_date,
+            'hash_per_date': hash_per_date,
+        }
+
+    rows_per_date, hash_per_date = get_content_per_date(db_conn, f'{mod_schema}.cohort')
+    fingerprints[COHORT_KEY] = {
+        'spec': config.get('cohort'),
+        'rows_per_date': rows_per_date,
+        'hash_per_date': hash_per_date,
+    }
+    return fingerprints
+
+
+def get_local_source_fingerprints(config: dict, local_tables: dict, cohort_fingerprint: dict, source_signatures: dict) -> dict:
+    """Describe the feature tables computed by the local engine, which are not
+    stored in the database: by their config specification, the engine's
+    version, the signature per as_of_date of the events of their source table
+    known before it, and the cohort's rows and hash per as_of_date (they have a
+    row per cohort row).
+
+    Args:
+    ---
+    config: config.yaml dictionary
+    local_tables: output of features.get_local_feature_tables()
+    cohort_fingerprint: the cohort's fingerprint, as in get_source_fingerprints()
+    source_signatures: config['features'] entry name -> output of
+        features.get_source_signatures() for the as_of_dates of the matrices
+
+    Returns a dictionary with one entry per local feature table.
+    """
+    fingerprints = {}
+    for table_name, specs in local_tables.items():
+        base_name = get_table_base_name(table_name)
+        fingerprints[table_name] = {
+            'spec': config['features'][base_name],
+            'engine': {'local': LOCAL_ENGINE_VERSION},
+            'columns': [spec['feature_name'] for spec in specs],
+            'source_per_date': source_signatures[base_name],
+            'rows_per_date': cohort_fingerprint['rows_per_date'],
+            'hash_per_date': cohort_fingerprint['hash_per_date'],
+        }
+    return fingerprints
+
+
+def restrict_to_dates(fingerprint: dict, dates) -> dict:
+    """Copy of a table fingerprint with only the row counts, hashes and
+    source signatures of the given dates."""
+    dates = set(date_str(d) for d in dates)
+    restricted = dict(fingerprint)
+    for key in PER_DATE_KEYS:
+        if key in fingerprint:
+            restricted[key] = {d: v for d, v in fingerprint[key].items() if d in dates}
+    return restricted
+
+
+def master_fingerprint(source_fingerprints: dict, dates) -> str:
+    """Key of the master matrix: all feature tables and the cohort, restricted
+    to the as_of_dates of the master matrix.
+    """
+    dates = sorted(set(date_str(d) for d in dates))
+    return hash_object({
+        'dates': dates,
+        'sources': {name: restrict_to_dates(fp, dates) for name, fp in source_fingerprints.items()},
+    })
+
+
+def get_county_table_names(config: dict, table_names, county: str) -> list[str]:
+    """Feature tables whose columns are used in the matrices of a county (see
+    matrix.get_county_columns()).
+    """
+    if county == 'both':
+        return sorted(table_names)
+    return sorted(
+        tn for tn in table_names
+        if get_table_base_name(tn) in config['features']
+        and config['features'][get_table_base_name(tn)]['county'] in [county, 'both']
+    )
+
+
+def fold_fingerprint(source_fingerprints: dict, config: dict, fold_spec, county: str) -> str:
+    """Content-addressed key of the small matrices of a fold and county.
+
+    It covers the fold, the county, the encoding settings, and the
+    fingerprints of only the feature tables used by the county (and of the
+    cohort), restricted to the fold's as_of_dates. Rebuilding unrelated
+    feature tables, or adding dates outside of the fold, keeps the key.
+    """
+    train_dates, validate_date = fold_spec
+    dates = sorted(set(date_str(d) for d in list(train_dates) + [validate_date]))
+    table_names = [name for name in source_fingerprints if name != COHORT_KEY]
+    sources = {
+        name: restrict_to_dates(source_fingerprints[name], dates)
+        for name in get_county_table_names(config, table_names, county) + [COHORT_KEY]
+    }
+    encoding = ENCODING_SETTINGS
+    if int(config.get('sparse_matrices', 0)):
+        encoding = dict(ENCODING_SETTINGS, sparse=SPARSE_ENCODING_SETTINGS)
+    return hash_object({
+        'train_dates': sorted(date_str(d) for d in train_dates),
+        'validate_date': date_str(validate_date),
+        'county': county,
+        'encoding': encoding,
+        'sources': sources,
+    })
+
+
+def matrices_config_key(config: dict, fold_specs) -> str:
+    """Key of the matrices of a config, for sharing them between the configs
+    run in one process (see run.run_pipelines()): the config entries the
+    master store and small matrices are built from, and the folds. Unlike
+    fold_fingerprint() it does not look at the feature tables, so it is only
+    valid while they are not rebuilt.
+    """
+    return hash_object({
+        'features': config.get('features'),
+        'cohort': config.get('cohort'),
+        'feature_engine': config.get('feature_engine'),
+        'county': config['county'],
+        'sparse_matrices': int(config.get('sparse_matrices', 0)),
+        'folds': [[sorted(date_str(d) for d in train_dates), date_str(validate_date)] for train_dates, validate_date in fold_specs],
+    })
@@ -0,0 +1,422 @@
+import datetime
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from utils.constants import MASTER_STORE_DIR
+
+
+SCHEMA_FILENAME = 'schema.json'
+INDEX_DIR = 'index'
+COLUMNS_DIR = 'columns'
+
+
+def to_datetime64(dates) -> np.ndarray:
+    """Convert an iterable of dates (datetime.date, strings or timestamps) to
+    a numpy datetime64[D] array, the format in which as_of_dates are stored.
+    """
+    return pd.to_datetime(pd.Series(list(dates))).values.astype('datetime64[D]')
+
+
+# Size of the header of every .npy file written by MasterStoreWriter, fixed so
+# that the header can be rewritten in place once the number of rows is known
+NPY_HEADER_BYTES = 128
+
+
+def npy_header(dtype, n_rows: int) -> bytes:
+    """Header of a version 1.0 .npy file holding a 1d array, padded to
+    NPY_HEADER_BYTES bytes."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (n_rows,)})
+    preamble_bytes = len(np.lib.format.magic(1, 0)) + 2
+    header = header.ljust(NPY_HEADER_BYTES - preamble_bytes - 1) + '\n'
+    if len(header) + preamble_bytes != NPY_HEADER_BYTES:
+        raise Exception(f'The .npy header of {n_rows} rows of {dtype} does not fit in {NPY_HEADER_BYTES} bytes.')
+    return np.lib.format.magic(1, 0) + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+def code_dtype(n_categories: int) -> np.dtype:
+    """Smallest integer dtype of the codes of a categorical column (-1 for
+    null, 0 to n_categories - 1 otherwise)."""
+    for dtype in [np.int8, np.int16]:
+        if n_categories <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int32)
+
+
+def downcast_dtype(values: np.ndarray) -> np.dtype:
+    """Smallest dtype that holds the values of a numerical column: int16 or
+    int32 (int64 if neither is enough) if they are whole numbers without
+    nulls, and float32 otherwise, unless float32 would round whole numbers
+    (above 2 ** 24), in which case they are left as they are.
+    """
+    finite = np.isfinite(values)
+    integral = finite.all() and (len(values) == 0 or (np.mod(values, 1) == 0).all())
+    max_abs = np.abs(values[finite]).max() if finite.any() else 0
+    if integral:
+        for dtype in [np.int16, np.int32, np.int64]:
+            if max_abs <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    if max_abs > 2 ** 24 and (np.mod(values[finite], 1) == 0).all():
+        return values.dtype
+    return np.dtype(np.float32)
+
+
+class MasterStoreWriter():
+    """
+    A class used to write the master store (see MasterMatrix) one chunk of
+    rows at a time, so the master matrix never has to fit in memory. Every
+    column is a .npy file whose rows are appended as chunks arrive; its
+    header is rewritten once the number of rows is known.
+
+    Chunks must be given in (as_of_date, joid) order, the order of the store.
+    Numerical columns are cast to num_dtype as they are appended (by default,
+    the dtype of the column in the first chunk). Categorical columns are
+    stored as int32 codes (-1 for null); codes are assigned as values are
+    first seen, and renumbered on close() so that categories are sorted.
+
+    With downcast, close() also plans compact dtypes once the values of every
+    column are known: categorical codes become the smallest integer type
+    that holds them (see code_dtype()) and numerical columns appended as
+    float64 are downcast (see downcast_dtype()), so whole-number aggregates
+    like counts become int16 or int32. The dtype of every column is recorded
+    in the schema file.
+
+    The store is written to a temporary directory and renamed into place on
+    close(), so a crashed run never leaves a half-written store behind.
+
+    Attributes
+    ----------
+    path (str): directory of the store
+    num_columns (list): names of numerical feature columns
+    cat_columns (list): names of categorical feature columns
+    fingerprint (str): key of the sources the store is built from
+    num_dtype: dtype numerical columns are appended as, None for their own;
+        either a single dtype or a dictionary of column name -> dtype
+    downcast (bool): whether close() downcasts columns to compact dtypes
+    n_rows (int): number of rows written so far
+
+    Methods
+    -------
+    append(chunk): write the rows of a chunk
+    close(): finish the store and move it into place
+    """
+
+    def __init__(self, num_columns: list[str], cat_columns: list[str], path: str = MASTER_STORE_DIR, fingerprint: str = None, num_dtype=None, downcast: bool = False):
+        if os.path.exists(path):
+            raise Exception(f'Master store {path} already exists.')
+        self.path = path
+        self.num_columns = list(num_columns)
+        self.cat_columns = list(cat_columns)
+        self.fingerprint = fingerprint
+        self.num_dtype = num_dtype
+        self.downcast = downcast
+        self.n_rows = 0
+
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(os.path.join(self.tmp_path, INDEX_DIR))
+        os.makedirs(os.path.join(self.tmp_path, COLUMNS_DIR))
+
+        self._files = {}  # file path -> (open file, dtype)
+        self._codes = {col: {} for col in self.cat_columns}  # value -> code, in order of appearance
+        self._as_of_dates = set()
+        self._last_key = None
+
+    def _column_dtype(self, col: str):
+        """dtype a numerical column is appended as, None for its own."""
+        if isinstance(self.num_dtype, dict):
+            return self.num_dtype.get(col)
+        return self.num_dtype
+
+    def _column_path(self, col: str) -> str:
+        return os.path.join(self.tmp_path, COLUMNS_DIR, col + '.npy')
+
+    def _rewrite(self, col: str, values: np.ndarray):
+        """Replace the file of a column (after close() wrote its header)."""
+        np.save(self._column_path(col) + '.new.npy', values)
+        os.replace(self._column_path(col) + '.new.npy', self._column_path(col))
+
+    def _write(self, file_path: str, values: np.ndarray):
+        if file_path not in self._files:
+            f = open(file_path, 'wb')
+            f.write(npy_header(values.dtype, 0))
+            self._files[file_path] = (f, values.dtype)
+        f, dtype = self._files[file_path]
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    def append(self, chunk: pd.DataFrame):
+        """Write the rows of a features dataframe with index (joid,
+        as_of_date) and (at least) the store's columns, in (as_of_date,
+        joid) order and after the rows already written."""
+        joids = np.asarray(chunk.index.get_level_values('joid'), dtype=np.int64)
+        as_of_dates = to_datetime64(chunk.index.get_level_values('as_of_date'))
+        if len(chunk) == 0:
+            return
+
+        # Rows must be strictly increasing in (as_of_date, joid), within and across chunks
+        if self._last_key is not None:
+            dates, ids = np.append(self._last_key[0], as_of_dates), np.append(self._last_key[1], joids)
+        else:
+            dates, ids = as_of_dates, joids
+        increasing = (dates[1:] > dates[:-1]) | ((dates[1:] == dates[:-1]) & (ids[1:] > ids[:-1]))
+        if not increasing.all():
+            raise Exception('Rows of the master store must be appended in (as_of_date, joid) order.')
+        self._last_key = (as_of_dates[-1], joids[-1])
+        self._as_of_dates.update(np.unique(as_of_dates).tolist())
+
+        self._write(os.path.join(self.tmp_path, INDEX_DIR, 'joid.npy'), joids)
+        self._write(os.path.join(self.tmp_path, INDEX_DIR, 'as_of_date.npy'), as_of_dates)
+
+        for col in self.cat_columns:
+            # Codes of this chunk's values, then their codes in the whole store
+            codes, uniques = pd.factorize(np.asarray(chunk[col].values, dtype=object))
+            store_codes = np.array(
+                [self._codes[col].setdefault(value, len(self._codes[col])) for value in uniques] + [-1],
+                dtype=np.int32
+            )
+            self._write(self._column_path(col), store_codes[codes])
+
+        for col in self.num_columns:
+            values = np.asarray(chunk[col].values)
+            if self._column_dtype(col) is not None:
+                values = pd.to_numeric(chunk[col]).to_numpy(dtype=self._column_dtype(col), na_value=np.nan)
+            elif values.dtype == object:
+                values = values.astype(np.float64)
+            self._write(self._column_path(col), values)
+
+        self.n_rows += len(chunk)
+
+    def close(self):
+        """Write the headers and schema of the store, and move it into place."""
+        # Columns without rows are still stored, as empty arrays
+        for file_path, dtype in [(os.path.join(INDEX_DIR, 'joid.npy'), np.int64), (os.path.join(INDEX_DIR, 'as_of_date.npy'), 'datetime64[D]')] \
+                + [(os.path.join(COLUMNS_DIR, col + '.npy'), np.int32) for col in self.cat_columns] \
+                + [(os.path.join(COLUMNS_DIR, col + '.npy'), self._column_dtype(col) or np.float64) for col in self.num_columns]:
+            file_path = os.path.join(self.tmp_path, file_path)
+            if file_path not in self._files:
+                self._write(file_path, np.empty(0, dtype=dtype))
+        for f, dtype in self._files.values():
+            f.seek(0)
+            f.write(npy_header(dtype, self.n_rows))
+            f.close()
+
+        # Renumber categorical codes so that categories are sorted, as pd.Categorical sorts them
+        categories = {}
+        dtypes = {}
+        for col in self.cat_columns:
+            seen = list(self._codes[col])
+            categories[col] = pd.Categorical(seen).categories.tolist()
+            dtypes[col] = code_dtype(len(seen)) if self.downcast else np.dtype(np.int32)
+            if seen != categories[col] or dtypes[col] != np.int32:
+                sorted_codes = np.append(pd.Index(categories[col]).get_indexer(seen), -1).astype(dtypes[col])
+                self._rewrite(col, sorted_codes[np.load(self._column_path(col), mmap_mode='r')])
+
+        for col in self.num_columns:
+            values = np.load(self._column_path(col), mmap_mode='r')
+            dtypes[col] = values.dtype
+            if self.downcast and values.dtype == np.float64:
+                dtypes[col] = downcast_dtype(values)
+                if dtypes[col] != values.dtype:
+                    self._rewrite(col, values.astype(dtypes[col]))
+            del values
+
+        schema = {
+            'num_columns': self.num_columns,
+            'cat_columns': self.cat_columns,
+            'categories': categories,
+            'n_rows': int(self.n_rows),
+            'as_of_dates': [str(d) for d in sorted(self._as_of_dates)],
+            'fingerprint': self.fingerprint,
+            'dtypes': {col: dtypes[col].name for col in self.cat_columns + self.num_columns},
+        }
+        with open(os.path.join(self.tmp_path, SCHEMA_FILENAME), 'w') as f:
+            json.dump(schema, f)
+
+        os.rename(self.tmp_path, self.path)
+
+
+def write_master_store(feats_df: pd.DataFrame, num_columns: list[str], cat_columns: list[str], path: str = MASTER_STORE_DIR, fingerprint: str = None):
+    """Write the master features dataframe to disk as a columnar store: one
+    .npy file per feature column plus the (joid, as_of_date) index. Rows are
+    sorted by (as_of_date, joid) so every as_of_date is a contiguous block.
+
+    Categorical columns are stored as int32 codes (-1 for null) and their
+    categories are kept in the schema file. Numerical columns keep their dtype.
+    See MasterStoreWriter for writing a store one chunk at a time.
+
+    Args:
+    ---
+    feats_df: features dataframe with index (joid, as_of_date)
+    num_columns: names of numerical feature columns
+    cat_columns: names of categorical feature columns
+    path: directory to write the store to
+    fingerprint: key of the sources the store was built from (see
+        matrix_cache.master_fingerprint()), kept in the schema file
+    """
+    joids = np.asarray(feats_df.index.get_level_values('joid'), dtype=np.int64)
+    as_of_dates = to_datetime64(feats_df.index.get_level_values('as_of_date'))
+    order = np.lexsort((joids, as_of_dates))
+
+    writer = MasterStoreWriter(num_columns, cat_columns, path, fingerprint)
+    writer.append(feats_df.iloc[order])
+    writer.close()
+
+
+class MasterMatrix():
+    """
+    Read-only, memory-mapped view of the master features matrix written by
+    write_master_store(). Columns are only mapped into memory when requested,
+    so reading a fold touches just the dates and columns it needs.
+
+    Attributes
+    ----------
+    path (str): directory of the store
+    num_columns (list): names of numerical feature columns
+    cat_columns (list): names of categorical feature columns
+    categories (dict): categorical column name -> list of categories
+    fingerprint (str): key of the sources the store was built from, if any
+    dtypes (dict): column name -> dtype it is stored as, if recorded
+    joid (np.memmap): joid of every row
+    as_of_date (np.memmap): as_of_date (datetime64[D]) of every row
+    date_ranges (dict): as_of_date -> (start, stop) positional row range;
+        rows are sorted by as_of_date so every date is one contiguous block
+
+    Methods
+    -------
+    column(name): memory-mapped array for a single feature column
+    row_ranges(dates): contiguous (start, stop) row ranges for the given as_of_dates
+    row_positions(dates): positional indices of the rows for the given as_of_dates
+    gather(name, dates): values of a single column for the given as_of_dates
+    read_block(dates, columns, dtype): 2d array with the requested dates and columns
+    read_index(dates): (joid, as_of_date) index for the given as_of_dates
+    read(dates, columns): dataframe with the requested dates and columns
+    """
+
+    def __init__(self, path=MASTER_STORE_DIR):
+        self.path = path
+        with open(os.path.join(path, SCHEMA_FILENAME), 'r') as f:
+            schema = json.load(f)
+
+        self.num_columns = schema['num_columns']
+        self.cat_columns = schema['cat_columns']
+        self.categories = schema['categories']
+        self.as_of_dates = [datetime.date.fromisoformat(d) for d in schema['as_of_dates']]
+        self.fingerprint = schema.get('fingerprint')
+        self.dtypes = schema.get('dtypes', {})
+
+        self.joid = np.load(os.path.join(path, INDEX_DIR, 'joid.npy'), mmap_mode='r')
+        self.as_of_date = np.load(os.path.join(path, INDEX_DIR, 'as_of_date.npy'), mmap_mode='r')
+        self._columns = {}
+
+        # Precompute the positional row range of every as_of_date once
+        store_dates = to_datetime64(self.as_of_dates)
+        starts = np.searchsorted(self.as_of_date, store_dates, side='left')
+        stops = np.searchsorted(self.as_of_date, store_dates, side='right')
+        self.date_ranges = {
+            d: (int(start), int(stop)) for d, start, stop in zip(self.as_of_dates, starts, stops)
+        }
+
+    def __len__(self):
+        return len(self.joid)
+
+    def __getstate__(self):
+        # Only pickle the path, so that worker processes memory-map the same
+        # files instead of receiving a copy of the data
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def column(self, name: str) -> np.ndarray:
+        """Return the memory-mapped values of a feature column. Categorical
+        columns are returned as int32 codes (-1 for null).
+        """
+        if name not in self._columns:
+            if name not in self.num_columns and name not in self.cat_columns:
+                raise Exception(f'{name} is not a column of the master matrix.')
+            self._columns[name] = np.load(os.path.join(self.path, COLUMNS_DIR, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def decode(self, name: str, codes: np.ndarray) -> np.ndarray:
+        """Map categorical codes back to an object array of their values, with
+        None in place of nulls (as returned by the database).
+        """
+        lookup = np.array(self.categories[name] + [None], dtype=object)
+        return lookup[codes]
+
+    def row_ranges(self, dates) -> list[tuple[int, int]]:
+        """Contiguous (start, stop) row ranges for the given as_of_dates, in
+        store order. Dates missing from the store have no rows.
+        """
+        dates = sorted(set(to_datetime64(dates).astype(object)))
+        ranges = [self.date_ranges[d] for d in dates if d in self.date_ranges]
+        return [(start, stop) for start, stop in ranges if stop > start]
+
+    def row_positions(self, dates) -> np.ndarray:
+        """Positional indices of the rows whose as_of_date is in dates."""
+        ranges = self.row_ranges(dates)
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def gather(self, name: str, dates) -> np.ndarray:
+        """Values of a single column for the given as_of_dates, gathered from
+        contiguous slices of the memory-mapped column.
+        """
+        values = self.column(name)
+        ranges = self.row_ranges(dates)
+        if not ranges:
+            return np.empty(0, dtype=values.dtype)
+        return np.concatenate([values[start:stop] for start, stop in ranges])
+
+    def read_block(self, dates, columns: list[str], dtype=np.float64) -> np.ndarray:
+        """Read the requested columns for the requested as_of_dates into a
+        single (n_rows, n_columns) array. Categorical columns are returned as
+        their codes.
+        """
+        ranges = self.row_ranges(dates)
+        n_rows = sum(stop - start for start, stop in ranges)
+        block = np.empty((n_rows, len(columns)), dtype=dtype)
+        for j, col in enumerate(columns):
+            values = self.column(col)
+            offset = 0
+            for start, stop in ranges:
+                block[offset:offset + stop - start, j] = values[start:stop]
+                offset += stop - start
+        return block
+
+    def read_index(self, dates) -> pd.MultiIndex:
+        """(joid, as_of_date) index of the rows for the given as_of_dates."""
+        joids = np.concatenate([np.empty(0, dtype=np.int64)] + [
+            self.joid[start:stop] for start, stop in self.row_ranges(dates)
+        ])
+        as_of_dates = np.concatenate([np.empty(0, dtype='datetime64[D]')] + [
+            self.as_of_date[start:stop] for start, stop in self.row_ranges(dates)
+        ])
+        return pd.MultiIndex.from_arrays(
+            [joids, as_of_dates.astype(object)],
+            names=['joid', 'as_of_date']
+        )
+
+    def read(self, dates, columns: list[str]) -> pd.DataFrame:
+        """Read the requested columns for the requested as_of_dates.
+
+        Args:
+        ---
+        dates: as_of_dates to read
+        columns: feature column names to read
+
+        Returns a dataframe with index (joid, as_of_date) and one column per
+        requested feature.
+        """
+        index = self.read_index(dates)
+        data = {}
+        for col in columns:
+            values = self.gather(col, dates)
+            if col in self.categories:
+                values = pd.Series(self.decode(col, values), index=index, dtype=object)
+            data[col] = values
+
+        return pd.DataFrame(data, index=index, columns=list(columns))
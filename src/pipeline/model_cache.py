@@ -0,0 +1,77 @@
+import hashlib
+import os
+import shutil
+import uuid
+import numpy as np
+import sklearn
+from joblib import load
+from pipeline.fold_arrays import get_index_arrays
+from pipeline.matrix_cache import hash_object
+from utils.constants import MODEL_CACHE_DIR
+
+
+def labels_fingerprint(y_train, y_val) -> str:
+    """sha256 of a fold's training and validation labels: their (joid,
+    as_of_date) index and values. Since the matrices a model is trained on
+    are restricted to the rows with labels, this also covers those rows.
+    """
+    digest = hashlib.sha256()
+    for y in [y_train, y_val]:
+        joids, as_of_dates = get_index_arrays(y.index)
+        for values in [joids, as_of_dates.astype(np.int64), y.to_numpy(dtype=np.float64, na_value=np.nan)]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def model_cache_key(model_class: str, params: dict, matrix_key: str, label_key: str) -> str:
+    """Key of a trained model: its class (as in config['models']), its
+    parameters (in any order), the fingerprint of the fold's matrices (their
+    file name, see matrix.write_matrix_driver()) and of its labels (see
+    labels_fingerprint()).
+    The sklearn version is included, since models are not portable across
+    versions.
+    """
+    return hash_object({
+        'model_class': model_class,
+        'params': params,
+        'matrices': matrix_key,
+        'labels': label_key,
+        'sklearn': sklearn.__version__,
+    })
+
+
+def get_cached_model_path(key: str, path: str = MODEL_CACHE_DIR) -> str:
+    return os.path.join(path, key + '.joblib')
+
+
+def load_cached_model(key: str, path: str = MODEL_CACHE_DIR):
+    """Trained model cached under key, or None if there is none."""
+    cached_path = get_cached_model_path(key, path)
+    if not os.path.exists(cached_path):
+        return None
+    return load(cached_path)
+
+
+def link_file(source: str, destination: str):
+    """Make destination the same file as source, with a hard link (or a
+    copy, across file systems). The link is renamed into place, so
+    concurrent writers of the same destination never see a partial file."""
+    tmp_path = f'{destination}.tmp-{uuid.uuid4().hex}'
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def cache_model(key: str, artifact_path: str, path: str = MODEL_CACHE_DIR):
+    """Cache the model saved at artifact_path (see
+    PredictionModel.save_pickled_model()) under key."""
+    os.makedirs(path, exist_ok=True)
+    link_file(artifact_path, get_cached_model_path(key, path))
+
+
+def link_cached_model(key: str, artifact_path: str, path: str = MODEL_CACHE_DIR):
+    """Save the model cached under key as the artifact of another model."""
+    link_file(get_cached_model_path(key, path), artifact_path)
@@ -1,9 +1,20 @@
 import os
 import json
 import pandas as pd
+from time import time
 import ohio.ext.pandas
 from joblib import dump
-from utils.constants import CSV_PATH
+from pipeline.prediction_store import PredictionStore
+from pipeline.result_sink import PREDICTIONS_TABLE, EVALUATIONS_TABLE, FEATURE_IMPORTANCE_TABLE, PREDICTION_STORE
+from pipeline.baselines import Baseline
+from pipeline.fold_arrays import is_sparse_frame, to_csr
+from pipeline.scheduler import model_n_jobs
+from utils.helpers import read_sql
+
+
+# Models that are fit on several labels at once natively, and whose
+# predict_proba returns a list with the probabilities of every label
+MULTI_OUTPUT_MODEL_TYPES = ['DecisionTreeClassifier', 'RandomForestClassifier', 'ExtraTreesClassifier']
 
 
 class ModelSet():
@@ -66,6 +77,10 @@ class PredictionModel():
     k (int): value of k for precision / recall
     validation_date (str): string indicating the validation date
     train_date (str): string indicating the last train date
+    train_seconds (float): seconds the model took to fit, None if it was not trained
+    n_train_rows (int): number of training rows
+    n_features (int): number of features
+    n_jobs (int): number of cores the model was fit on
     params (dict): dictionary for the sklearn model parameters
     model (sklearn model): sklearn model class
     model_type (string): model type string (e.g., LogisticRegression)
@@ -77,11 +92,12 @@ class PredictionModel():
     Methods
     -------
     train(X_train, y_train): fits the model on the training data
-    score(X, validation_date): computes the model score, sets validation date
+    score(X, validation_date, output): computes the model score (of one output of a multi-output model), sets validation date
     precision_at_k(y, k=115): computes precision at top k
     recall_at_k(y, k=115): computes recall at top k
     save_model(db_conn): inserts model set id and last train date into results.models
-    save_pickled_model(path): saves model as sklearn pickle to disk
+    get_pickled_model_path(path): path of the pickled model in directory path
+    save_pickled_model(path): saves model as sklearn pickle to disk, returns its path
     save_predictions(db_conn): inserts model predictions into results.test_predictions
     save_evaluations(db_conn): inserts model evaluations into results.evaluations_predictions
     save_feature_importance(db_conn, feature_names): inserts feature importance scores into results.feature_importance
@@ -94,6 +110,10 @@ class PredictionModel():
         self.precision = None
         self.model_id = None
         self.validation_date = None
+        self.train_seconds = None
+        self.n_train_rows = None
+        self.n_features = None
+        self.n_jobs = None
         self.train_date = train_date
         self.county = model_set.county
         self.params = model_set.params
@@ -102,21 +122,39 @@ class PredictionModel():
         self.model_set_id = model_set.model_set_id
         self.experiment_id = model_set.experiment_id
 
+    def model_input(self, X: pd.DataFrame):
+        """The matrix given to the model: sklearn models get matrices of
+        sparse columns as CSR matrices; baselines, which select columns by
+        name, get the dataframe."""
+        if is_sparse_frame(X) and not isinstance(self.model, Baseline):
+            return to_csr(X)
+        return X
+
     def train(self, X_train, y_train):
         """Trains the model
 
         Args:
-            X_train (np.ndarray): Training matrix
+            X_train (pd.DataFrame): Training matrix
             y_train (np.ndarray): Test matrix
         """
-        self.model.fit(X_train, y_train)
-
-    def score(self, X: pd.DataFrame, validation_date):
-        # Get scores for label = 1
+        start = time()
+        self.model.fit(self.model_input(X_train), y_train)
+        self.train_seconds = time() - start
+        self.n_train_rows, self.n_features = X_train.shape
+        self.n_jobs = model_n_jobs(self.model)
+
+    def score(self, X: pd.DataFrame, validation_date, output=None):
+        # Get scores for label = 1, of the given output of a multi-output model
         self.validation_date = validation_date
-        self.scores = pd.DataFrame(self.model.predict_proba(X)[:, 1], index=X.index, columns=['score'])
+        probabilities = self.model.predict_proba(self.model_input(X))
+        if output is not None:
+            probabilities = probabilities[output]
+        self.scores = pd.DataFrame(probabilities[:, 1], index=X.index, columns=['score'])
     
-    def save_feature_importance(self, db_conn, feature_names):
+    def save_feature_importance(self, db_conn, feature_names, sink=None):
+        """Saves the feature importances to results.feature_importance, or
+        buffers them in sink (a ResultSink) if given.
+        """
         if self.scores is None:
             raise Exception("Score the model first!")
         
@@ -138,7 +176,16 @@ class PredictionModel():
                 feature_importance = list(self.model.feature_importances_)
             except:
                 return
-        
+
+        if sink is not None:
+            sink.add(FEATURE_IMPORTANCE_TABLE, pd.DataFrame({
+                'model_id': self.model_id,
+                'train_end_date': self.train_date,
+                'feature_name': list(feature_names),
+                'feature_importance': feature_importance
+            }))
+            return
+
         feature_names = ', '.join(f"'{name}'"  for name in feature_names) 
 
         query = f"""
@@ -168,7 +215,7 @@ class PredictionModel():
         # Return model id (which is a serial integer) as an attribute
         self.model_id = result.fetchone()[0]
     
-    def save_pickled_model(self, path):
+    def get_pickled_model_path(self, path):
         # Saving the model creates the model_id
         # which is needed for the the filename
         if self.model_id is None:
@@ -178,10 +225,19 @@ class PredictionModel():
             [self.model_type, str(self.model_set_id), str(self.model_id)]
         ) + '.joblib'
 
-        dump(self.model, os.path.join(path, filename))
+        return os.path.join(path, filename)
 
-    def save_predictions(self, db_conn, label_tablename):
-        """Saves the predictions to results.test_predictions
+    def save_pickled_model(self, path):
+        """Dumps the model to path and returns the path of the file."""
+        model_path = self.get_pickled_model_path(path)
+        dump(self.model, model_path)
+        return model_path
+
+    def save_predictions(self, db_conn, label_tablename, sink=None, save_to_db=False):
+        """Saves the predictions to the prediction store (see
+        prediction_store.py). If sink (a ResultSink) is given they are buffered
+        in it and written in bulk, and also copied to results.test_predictions
+        if save_to_db.
         """
         county = "'doco', 'joco'" if self.county == 'both' else "'" + self.county + "'"
 
@@ -197,7 +253,7 @@ class PredictionModel():
         """
 
         # Ensures these are joined with scores on joid and date
-        df = pd.read_sql(query_label, db_conn, index_col=['joid', 'as_of_date'])
+        df = read_sql(query_label, db_conn, index_col=['joid', 'as_of_date'])
 
         # Add score and model_id and rearrange
         # Join the scores with the df ON THE (joid, as_of_date) INDEX
@@ -214,22 +270,17 @@ class PredictionModel():
         # reset_index to get joid and as_of_dates cols
         df = df[final_df_cols].reset_index()
 
-        # Try to save to csv
-        try:
-            filename = '_'.join([
-                'predictions', 'exp', str(self.experiment_id), str(self.model_set_id), str(self.model_id)
-            ]) + '.csv'
-            filepath = os.path.join(CSV_PATH, filename)
-            df.to_csv(filepath, index=False)
-        except Exception as e:
-            print(e)
-
-        # NOTE: This was removed for the big model run to not clog the database.
-        # Going forward we probably want to save to the database again.
-        #df.pg_copy_to(
-        #   name='test_predictions', con=db_conn, schema='results',
-        #   index=False, if_exists='append'
-        #)
+        # The prediction store is partitioned by experiment and model set
+        df_store = df.assign(experiment_id=self.experiment_id, model_set_id=self.model_set_id)
+        if sink is not None:
+            sink.add(PREDICTION_STORE, df_store)
+        else:
+            PredictionStore().write(df_store)
+
+        # NOTE: Writing each model's predictions with pg_copy_to clogged the
+        # database in the big model run; the sink batches many models per COPY
+        if sink is not None and save_to_db:
+            sink.add(PREDICTIONS_TABLE, df)
 
         return df
 
@@ -282,7 +333,7 @@ class PredictionModel():
             recall = correct_predictions / all_true_labels
             return recall
 
-    def save_evaluations(self, db_conn, df_pred, k=115, joco_k=75, doco_k=40):
+    def save_evaluations(self, db_conn, df_pred, k=115, joco_k=75, doco_k=40, sink=None):
         """Saves precision and recall at specific ks to the database for easy retrieval
 
         Args:
@@ -291,6 +342,8 @@ class PredictionModel():
             - k (int, 115): total k
             - joco_k (int, 75): Johnson county k
             - doco_k (int, 40): Douglas county k
+            - sink (ResultSink, None): if given, the evaluations are buffered in
+              the sink instead of inserted right away
         """
 
         if self.county != 'both':
@@ -302,15 +355,12 @@ class PredictionModel():
             last_k = df_pred[df_pred['county'] == self.county].k.max()
             last_precision = self.precision_at_k(df_pred, k=last_k, county=self.county)
 
-            county = "'" + self.county + "'"
-
-            query = f"""
-            insert into results.test_evaluations (model_id, county, as_of_date, metric, k, county_k, value)
-            values
-                ({self.model_id}::int, {county}, '{self.validation_date}'::date, 'precision', null, {k}, {precision}),
-                ({self.model_id}::int, {county}, '{self.validation_date}'::date, 'recall', null, {k}, {recall}),
-                ({self.model_id}::int, {county}, '{self.validation_date}'::date, 'precision', null, {last_k}, {last_precision})
-            """
+            # (county, metric, k, county_k, value)
+            rows = [
+                (self.county, 'precision', None, k, precision),
+                (self.county, 'recall', None, k, recall),
+                (self.county, 'precision', None, last_k, last_precision)
+            ]
 
         # Save both results + total precision / recall and last precision
         else:
@@ -326,17 +376,39 @@ class PredictionModel():
             last_k = df_pred.k.max()
             last_precision = self.precision_at_k(df_pred, k=last_k, county=None)
 
-            query = f"""
-            insert into results.test_evaluations (model_id, county, as_of_date, metric, k, county_k, value)
-            values
-                ({self.model_id}::int, 'joco', '{self.validation_date}'::date, 'precision', null, {joco_k}, {joco_precision}),
-                ({self.model_id}::int, 'joco', '{self.validation_date}'::date, 'recall', null, {joco_k}, {joco_recall}),
-                ({self.model_id}::int, 'doco', '{self.validation_date}'::date, 'precision', null, {doco_k}, {doco_precision}),
-                ({self.model_id}::int, 'doco', '{self.validation_date}'::date, 'recall', null, {doco_k}, {doco_recall}),
-                ({self.model_id}::int, null,   '{self.validation_date}'::date, 'precision', {k}, null, {total_precision}),
-                ({self.model_id}::int, null,   '{self.validation_date}'::date, 'recall', {k}, null, {total_recall}),
-                ({self.model_id}::int, null,   '{self.validation_date}'::date, 'precision', {last_k}, null, {last_precision})
-            """
+            # (county, metric, k, county_k, value)
+            rows = [
+                ('joco', 'precision', None, joco_k, joco_precision),
+                ('joco', 'recall', None, joco_k, joco_recall),
+                ('doco', 'precision', None, doco_k, doco_precision),
+                ('doco', 'recall', None, doco_k, doco_recall),
+                (None, 'precision', k, None, total_precision),
+                (None, 'recall', k, None, total_recall),
+                (None, 'precision', last_k, None, last_precision)
+            ]
+
+        if sink is not None:
+            df = pd.DataFrame(rows, columns=['county', 'metric', 'k', 'county_k', 'value'])
+            df.insert(0, 'model_id', self.model_id)
+            df.insert(2, 'as_of_date', self.validation_date)
+            # Nullable integers, so that k's are not written as floats
+            sink.add(EVALUATIONS_TABLE, df.astype({'k': 'Int64', 'county_k': 'Int64'}))
+            return
+
+        values = []
+        for county, metric, k, county_k, value in rows:
+            county = 'null' if county is None else "'" + county + "'"
+            k = 'null' if k is None else k
+            county_k = 'null' if county_k is None else county_k
+            values.append(
+                f"({self.model_id}::int, {county}, '{self.validation_date}'::date, '{metric}', {k}, {county_k}, {value})"
+            )
+        values = ',\n            '.join(values)
+        query = f"""
+        insert into results.test_evaluations (model_id, county, as_of_date, metric, k, county_k, value)
+        values
+            {values}
+        """
 
         db_conn.execute(query)
         db_conn.execute("COMMIT")
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.constants import PREDICTION_STORE_DIR
+
+
+INDEX_FILENAME = 'index.sqlite'
+PARTITION_COLUMNS = ['experiment_id', 'model_set_id']
+
+
+class PredictionStore():
+    """
+    A class used to store model predictions as Parquet files partitioned by
+    experiment and model set, i.e.
+    experiment_id={e}/model_set_id={ms}/part-{uuid}.parquet, where every
+    model's predictions are a single row group. A sqlite index maps each
+    model_id to its file and row group, so reading one model's predictions
+    reads only that slice of one file.
+
+    The stored columns are those of the predictions dataframe of
+    PredictionModel.save_predictions(); as_of_date is stored as an ISO string,
+    as it was in the csv files this store replaces.
+
+    Attributes
+    ----------
+    path (str): root directory of the store
+
+    Methods
+    -------
+    write(df): store the predictions of one or more models
+    model_id in store: whether a model's predictions are stored
+    model_ids(experiment_id, model_set_id): stored model ids, optionally filtered
+    read(model_id): predictions of a single model
+    read_models(model_ids): predictions of several models, concatenated
+    delete(model_ids): remove models from the index, and the files left without models
+    """
+
+    def __init__(self, path=PREDICTION_STORE_DIR):
+        self.path = path
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.path, INDEX_FILENAME), timeout=60)
+
+    def _index_exists(self) -> bool:
+        """Whether anything was written to the store. The directory and index
+        are only created by write(), so that readers, e.g. on a read-only
+        mount, see a store that was never written as empty."""
+        return os.path.exists(os.path.join(self.path, INDEX_FILENAME))
+
+    def _create_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                create table if not exists predictions_index (
+                    model_id integer primary key,
+                    experiment_id integer,
+                    model_set_id integer,
+                    path text,
+                    row_group integer,
+                    n_rows integer
+                )
+                """)
+
+    def write(self, df: pd.DataFrame):
+        """Store predictions, given as a dataframe with one or more models and
+        experiment_id and model_set_id columns. Writes one file per experiment
+        and model set, with one row group per model, then indexes them.
+        """
+        self._create_index()
+        df = df.copy()
+        df['as_of_date'] = df['as_of_date'].astype(str)
+
+        index_rows = []
+        for (experiment_id, model_set_id), partition in df.groupby(PARTITION_COLUMNS, sort=False):
+            partition_dir = f'experiment_id={experiment_id}/model_set_id={model_set_id}'
+            os.makedirs(os.path.join(self.path, partition_dir), exist_ok=True)
+            relative_path = os.path.join(partition_dir, f'part-{uuid.uuid4().hex}.parquet')
+            file_path = os.path.join(self.path, relative_path)
+
+            # Write to a temporary file and rename, so no reader sees a partial file
+            writer = None
+            models = partition.drop(columns=PARTITION_COLUMNS).groupby('model_id', sort=True)
+            for row_group, (model_id, model_df) in enumerate(models):
+                table = pa.Table.from_pandas(model_df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_path + '.tmp', table.schema)
+                writer.write_table(table, row_group_size=max(len(table), 1))
+                index_rows.append((int(model_id), int(experiment_id), int(model_set_id), relative_path, row_group, len(table)))
+            writer.close()
+            os.replace(file_path + '.tmp', file_path)
+
+        with self._connect() as conn:
+            conn.executemany('insert or replace into predictions_index values (?, ?, ?, ?, ?, ?)', index_rows)
+
+    def __contains__(self, model_id) -> bool:
+        if not self._index_exists():
+            return False
+        with self._connect() as conn:
+            row = conn.execute('select 1 from predictions_index where model_id = ?', (int(model_id),)).fetchone()
+        return row is not None
+
+    def model_ids(self, experiment_id=None, model_set_id=None) -> list[int]:
+        query = 'select model_id from predictions_index where 1 = 1'
+        params = []
+        if experiment_id is not None:
+            query += ' and experiment_id = ?'
+            params.append(int(experiment_id))
+        if model_set_id is not None:
+            query += ' and model_set_id = ?'
+            params.append(int(model_set_id))
+        if not self._index_exists():
+            return []
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(query + ' order by model_id', params)]
+
+    def read(self, model_id: int) -> pd.DataFrame:
+        row = None
+        if self._index_exists():
+            with self._connect() as conn:
+                row = conn.execute(
+                    'select path, row_group from predictions_index where model_id = ?', (int(model_id),)
+                ).fetchone()
+        if row is None:
+            raise Exception(f'Predictions do not exist for model {model_id}!')
+        relative_path, row_group = row
+        return pq.ParquetFile(os.path.join(self.path, relative_path)).read_row_group(row_group).to_pandas()
+
+    def read_models(self, model_ids) -> pd.DataFrame:
+        return pd.concat([self.read(model_id) for model_id in model_ids], ignore_index=True)
+
+    def delete(self, model_ids) -> int:
+        """Remove the predictions of models from the index. Files that no
+        longer hold any indexed model are deleted; the row groups of deleted
+        models in other files are left in place but are never read.
+
+        Returns the number of models removed from the index.
+        """
+        model_ids = [int(model_id) for model_id in model_ids]
+        if not model_ids or not self._index_exists():
+            return 0
+        placeholders = ', '.join('?' * len(model_ids))
+        with self._connect() as conn:
+            paths = [row[0] for row in conn.execute(
+                f'select distinct path from predictions_index where model_id in ({placeholders})', model_ids
+            )]
+            n_deleted = conn.execute(f'delete from predictions_index where model_id in ({placeholders})', model_ids).rowcount
+            unused = [path for path in paths if conn.execute(
+                'select 1 from predictions_index where path = ?', (path,)
+            ).fetchone() is None]
+        for path in unused:
+            os.remove(os.path.join(self.path, path))
+        return n_deleted
+
+
+def import_prediction_csvs(predictions_dir: str, store: PredictionStore = None):
+    """Copy legacy predictions_exp_{e}_{ms}_{m}.csv files into the prediction
+    store, skipping models that are stored already.
+    """
+    store = store or PredictionStore()
+    stored = set(store.model_ids())
+    for filename in sorted(os.listdir(predictions_dir)):
+        if not (filename.startswith('predictions_exp_') and filename.endswith('.csv')):
+            continue
+        _, _, experiment_id, model_set_id, model_id = filename[:-len('.csv')].split('_')
+        if int(model_id) in stored:
+            continue
+        df = pd.read_csv(os.path.join(predictions_dir, filename))
+        df['experiment_id'] = int(experiment_id)
+        df['model_set_id'] = int(model_set_id)
+        store.write(df)
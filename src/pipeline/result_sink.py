@@ -0,0 +1,110 @@
+import io
+from time import time
+import pandas as pd
+from utils.helpers import get_database_engine
+from pipeline.prediction_store import PredictionStore
+
+
+PREDICTIONS_TABLE = 'results.test_predictions'
+EVALUATIONS_TABLE = 'results.test_evaluations'
+FEATURE_IMPORTANCE_TABLE = 'results.feature_importance'
+# Buffered rows under this key go to the prediction store instead of a table
+PREDICTION_STORE = 'prediction_store'
+
+
+class ResultSink():
+    """
+    A class used to buffer the rows that models write to the results schema
+    (predictions, evaluations and feature importances) and write them in bulk:
+    every flush sends all buffered rows with COPY, in a single transaction,
+    instead of one INSERT and COMMIT per model. Predictions buffered under
+    PREDICTION_STORE are written to the prediction store in the same flush,
+    once the transaction is committed, so that each file holds many models
+    and a failed COPY leaves no predictions behind.
+
+    The buffer is flushed when it holds flush_rows rows or when flush_seconds
+    have passed since the last flush, whichever comes first. A sink created
+    with flush_rows=None never flushes on its own; this is used in worker
+    processes, which hand their rows to the parent with take().
+
+    Attributes
+    ----------
+    flush_rows (int): number of buffered rows that triggers a flush
+    flush_seconds (float): seconds since the last flush that trigger a flush
+    buffers (dict): table name -> list of buffered dataframes
+    n_rows (int): number of buffered rows
+    last_flush (float): time of the last flush
+    prediction_store (PredictionStore): store for rows buffered under PREDICTION_STORE
+
+    Methods
+    -------
+    add(table, df): buffer the rows of df for table, flushing if necessary
+    take(): remove and return the buffered rows
+    extend(buffers): buffer the rows returned by another sink's take()
+    flush(): write all buffered rows to the database
+    """
+
+    def __init__(self, flush_rows=500000, flush_seconds=300, prediction_store=None):
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.prediction_store = prediction_store
+        self.buffers = {}
+        self.n_rows = 0
+        self.last_flush = time()
+
+    def add(self, table: str, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+        self.buffers.setdefault(table, []).append(df)
+        self.n_rows += len(df)
+        self._flush_if_necessary()
+
+    def take(self) -> dict:
+        buffers = self.buffers
+        self.buffers = {}
+        self.n_rows = 0
+        return buffers
+
+    def extend(self, buffers: dict):
+        for table, dfs in buffers.items():
+            for df in dfs:
+                self.buffers.setdefault(table, []).append(df)
+                self.n_rows += len(df)
+        self._flush_if_necessary()
+
+    def _flush_if_necessary(self):
+        if self.flush_rows is None:
+            return
+        if self.n_rows >= self.flush_rows or time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """COPY all buffered rows into their tables in a single transaction,
+        then write buffered predictions to the prediction store."""
+        if self.n_rows > 0:
+            conn = get_database_engine().raw_connection()
+            try:
+                cursor = conn.cursor()
+                for table, dfs in self.buffers.items():
+                    if table == PREDICTION_STORE:
+                        continue
+                    df = pd.concat(dfs, ignore_index=True)
+                    columns = ', '.join(df.columns)
+                    csv = io.StringIO()
+                    df.to_csv(csv, index=False, header=False)
+                    csv.seek(0)
+                    cursor.copy_expert(f'copy {table} ({columns}) from stdin with csv', csv)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+            if PREDICTION_STORE in self.buffers:
+                self.prediction_store = self.prediction_store or PredictionStore()
+                self.prediction_store.write(pd.concat(self.buffers[PREDICTION_STORE], ignore_index=True))
+
+        self.buffers = {}
+        self.n_rows = 0
+        self.last_flush = time()
@@ -1,13 +1,16 @@
 import os
 import sys
+import shutil
+import json
 import yaml
 import sklearn
 import itertools
+import pandas as pd
 import sklearn.ensemble
 import sklearn.neural_network
 from datetime import datetime
 from joblib import Parallel, delayed
-from utils.constants import CONFIG_PATH, MODELS_PATH, PROJ_DIR, PIPELINE_DIR
+from utils.constants import CONFIG_PATH, MODELS_PATH, PROJ_DIR, PIPELINE_DIR, FOLD_ARRAYS_DIR
 from utils.helpers import (
     get_label_tablename,
     get_database_connection,
@@ -22,10 +25,39 @@ from pipeline import (
 from pipeline.matrix import (
     load_labels,
     load_matrices,
-    write_matrix_driver,
-    delete_matrices_from_disk
+    write_matrix_driver
 )
+from pipeline.matrix_cache import hash_object, matrices_config_key
 from pipeline.baselines import FeatureRanker, LinearRanker
+from pipeline.fold_arrays import write_fold_arrays, load_fold_arrays
+from pipeline.result_sink import ResultSink
+from pipeline.model_cache import (
+    cache_model,
+    get_cached_model_path,
+    labels_fingerprint,
+    link_cached_model,
+    link_file,
+    load_cached_model,
+    model_cache_key
+)
+from pipeline.scheduler import (
+    PARALLEL_MODEL_TYPES,
+    estimate_cost,
+    fit_cost_rates,
+    get_task_timings,
+    schedule_tasks,
+    set_model_n_jobs
+)
+from pipeline.task_ledger import (
+    TASK_LEDGER_TABLE,
+    create_task_ledger,
+    delete_unfinished_models,
+    get_completed_tasks,
+    get_experiment_config,
+    get_model_set_ids,
+    get_model_set_key,
+    get_task_row
+)
 
 logger_now = datetime.now()  # log creation time
 logger = start_logger_if_necessary(logger_now)
@@ -43,21 +75,43 @@ models_dict = {
 
 
 def run_model_set(
-    county, label_tablename, grid_el,
-    fold, matrices_dict, labels_dict
+    county, label_tablenames, grid_els,
+    fold, matrices_dict, labels_dict, fold_path=None,
+    sink=None, save_predictions_to_db=True, cache_keys=None, multi_output=False
 ):
     """
-    Runs a model set, which includes models for each validation split
+    Runs a model set, which includes models for each validation split. With several
+    labels, runs the model set of every label, all on the same fold matrix
 
     Args:
         county (str): which county to run the model for (joco, doco, both)
-        label_tablename (str): which labels table we are using to save the predictions
-        grid_el (tuple): element of the model class, params grid, and model set object
+        label_tablenames (list of str): which labels tables we are using to train the
+            models and save the predictions, one model per labels table
+        grid_els (list of tuple): for every labels table, element of the model class,
+            params grid, and model set object
         fold (list): list of training dates and one validation date
         matrices_dict (dict): cached matrices
-        labels_dict (dict): cached labels
+        labels_dict (dict): cached labels, dataframes with a column per labels table
+        fold_path (str): if given, the fold's matrices and labels are memory-mapped
+            from this directory (see fold_arrays.py) instead of read from
+            matrices_dict and labels_dict, which can then be None
+        sink (ResultSink): sink to buffer the predictions, evaluations and feature
+            importances in. If None (e.g. in a worker process), they are buffered
+            in a new sink and returned, see ResultSink.take()
+        save_predictions_to_db (bool): if true the predictions are also copied to
+            results.test_predictions, besides being saved to the prediction store
+        cache_keys (list of str): if given, the model of every labels table is loaded
+            from the model cache under its key instead of trained if it is there, and
+            cached otherwise (see model_cache.py)
+        multi_output (bool): if true, a single model is trained on all labels at once
+            and shared by the models of every labels table, see
+            modeling.MULTI_OUTPUT_MODEL_TYPES
     """
-    model_class, param_dict, ms = grid_el
+    return_results = sink is None
+    if return_results:
+        sink = ResultSink(flush_rows=None)
+
+    model_class, param_dict, _ = grid_els[0]
     db_conn = get_database_connection()
     logger = start_logger_if_necessary(logger_now)
 
@@ -66,6 +120,7 @@ def run_model_set(
 
     logger.info('Currently running :')
     logger.info((model_class, param_dict))
+    logger.info('For labels: ' + ', '.join(label_tablenames))
     logger.info(
         'On training / validation dates: ' +
         str(latest_train_as_of_date) + ' / ' +
@@ -74,42 +129,105 @@ def run_model_set(
 
     # Get the training and validation matrices and labels from the
     # cached matrices and cached labels
-    X_train, X_test = matrices_dict[(fold, county)]
-    y_train, y_test = labels_dict[(fold, county)]
+    if fold_path is not None:
+        (X_train, X_test), (y_train, y_test) = load_fold_arrays(fold_path)
+    else:
+        X_train, X_test = matrices_dict[(fold, county)]
+        y_train, y_test = labels_dict[(fold, county)]
     feature_names = list(X_train.columns)
 
-    # Create a model for this particular fold
-    m = modeling.PredictionModel(ms, str(latest_train_as_of_date))
-    m.save_model(db_conn)
-    logger.info('Saved model id to database')
-
-    # Train the model
-    m.train(X_train, y_train)
-    logger.info('Trained model')
-
-    # Score the model
-    m.score(X_test, str(validate_as_of_date))
-    logger.info('Scored model')
-
-    # Compute and save the predictions for the validation set
-    df_pred = m.save_predictions(db_conn, label_tablename)
-    logger.info('Saved model predictions to database')
-
-    # Save the evaluation for this model
-    m.save_evaluations(db_conn, df_pred, k=115, joco_k=75, doco_k=40)
-    logger.info('Saved model evaluations to database')
-    del df_pred
+    # Create a model of every labels table for this particular fold
+    models = []
+    for _, _, ms in grid_els:
+        m = modeling.PredictionModel(ms, str(latest_train_as_of_date))
+        m.save_model(db_conn)
+        models.append(m)
+    logger.info('Saved model ids to database')
+
+    # Train the models, unless an identical model was trained on the same
+    # matrices and labels before
+    cache_keys = cache_keys or [None] * len(models)
+    cached_models = [None] * len(models)
+    if multi_output:
+        models[0].train(X_train, y_train[label_tablenames])
+        # The fit time of a multi-output model is not that of a single label
+        models[0].train_seconds = None
+        for m in models[1:]:
+            m.model = models[0].model
+        logger.info('Trained multi-output model')
+    else:
+        for i, (m, label_tablename) in enumerate(zip(models, label_tablenames)):
+            if cache_keys[i] is not None:
+                cached_models[i] = load_cached_model(cache_keys[i])
+            if cached_models[i] is not None:
+                m.model = cached_models[i]
+                logger.info('Loaded trained model from the model cache')
+            else:
+                m.train(X_train, y_train[label_tablename])
+                logger.info('Trained model')
+
+    for i, (m, label_tablename) in enumerate(zip(models, label_tablenames)):
+        # Score the model
+        m.score(X_test, str(validate_as_of_date), output=i if multi_output else None)
+        logger.info('Scored model')
+
+        # Compute and save the predictions for the validation set
+        df_pred = m.save_predictions(db_conn, label_tablename, sink, save_predictions_to_db)
+        logger.info('Saved model predictions')
+
+        # Save the evaluation for this model
+        m.save_evaluations(db_conn, df_pred, k=115, joco_k=75, doco_k=40, sink=sink)
+        logger.info('Buffered model evaluations')
+        del df_pred
+
+        # Save the feature importances
+        m.save_feature_importance(db_conn, feature_names, sink=sink)
+        logger.info('Buffered feature importance')
+
+        # Save the pickled model to disk
+        if cached_models[i] is not None:
+            link_cached_model(cache_keys[i], m.get_pickled_model_path(MODELS_PATH))
+        elif multi_output and i > 0:
+            link_file(models[0].get_pickled_model_path(MODELS_PATH), m.get_pickled_model_path(MODELS_PATH))
+        else:
+            model_path = m.save_pickled_model(MODELS_PATH)
+            if cache_keys[i] is not None:
+                cache_model(cache_keys[i], model_path)
+        logger.info('Saved pickled model to disk')
+
+        # Record the task as finished; the row is written with its results
+        sink.add(TASK_LEDGER_TABLE, get_task_row(m))
+
+    # Return the connection to the pool
+    db_conn.close()
+
+    if return_results:
+        return sink.take()
+
+
+def load_shared_matrices(db_conn, config, county, folds_spec):
+    """Writes (if necessary) and loads the matrices of all folds, see
+    matrix.write_matrix_driver() and matrix.load_matrices().
+
+    Returns (matrix_names, matrices_dict).
+    """
+    matrix_names = write_matrix_driver(db_conn, config)
+    return matrix_names, load_matrices(county, folds_spec, matrix_names)
 
-    # Save the feature importances
-    m.save_feature_importance(db_conn, feature_names)
-    logger.info('Saved feature importance to database')
 
-    # Save the pickled model to disk
-    m.save_pickled_model(MODELS_PATH)
-    logger.info('Saved pickled model to disk')
+def get_shared(shared, key, load):
+    """Returns load(), cached in the dictionary shared under key if shared is given."""
+    if shared is None:
+        return load()
+    if key not in shared:
+        shared[key] = load()
+    return shared[key]
 
 
-def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, create_features=True):
+def run_pipeline(
+    config, psql_role, create_cohort=True, create_labels=True, create_features=True, resume_experiment_id=None,
+    shared=None, label_configs=None
+):
     """Runs the pipeline, from creating the cohort to running the models and saving their output
 
     Args:
@@ -117,6 +235,17 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
         create_cohort (bool): If true creates the cohort table. Defaults to True.
         create_labels (bool): If true creates the labels table. Defaults to True.
         create_features (bool): If true creates the features tables. Defaults to True.
+        resume_experiment_id (int): If given, resumes this experiment instead of starting
+            a new one: its model sets are reused and only the tasks (model set and fold)
+            missing from the task ledger are run. Defaults to None.
+        shared (dict): If given, the database connection and the loaded labels and
+            matrices are cached in it and reused by the runs of other configs that
+            use the same ones, see run_pipelines(). Defaults to None.
+        label_configs (list of dict): If given, configs that differ from config only in
+            their labels, run in the same pass: every config is its own experiment, but
+            each fold's matrix is prepared once and the models of every label are
+            trained on it by the same task. With multi_output set in the config, models
+            that support it are trained once on all labels. Defaults to None.
     """
 
     # ------------------------------------------------------------------------
@@ -126,7 +255,7 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
     logger = start_logger_if_necessary(logger_now)
     logger.info("Pipeline started, running for " + county)
 
-    db_conn = get_database_connection()
+    db_conn = get_shared(shared, 'db_conn', get_database_connection)
     folds_spec = time_splitter.get_time_split(config)
 
     # NOTE: Cherry pick folds for testing
@@ -135,13 +264,31 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
 
     print('num folds ', len(folds_spec))
 
-    # Get all as of dates and the label tablename,
-    # depends on the county and the selected labels in the config
+    # Get all as of dates and the label tablenames,
+    # depends on the county and the selected labels in the configs
     as_of_dates = time_splitter.get_all_dates(folds_spec)
-    label_tablename = get_label_tablename(config)
-
-    # Create experiment table (if it does not exist already) and return the experiment id
-    experiment_id = insert_experiment_table_start(db_conn, config)
+    label_runs = [config] + list(label_configs or [])
+    label_tablenames = [get_label_tablename(label_config) for label_config in label_runs]
+    if resume_experiment_id is not None and len(label_runs) > 1:
+        raise Exception('Experiments are resumed one at a time, without label_configs.')
+
+    # Create experiment table (if it does not exist already) and return the experiment ids
+    create_task_ledger(db_conn)
+    if resume_experiment_id is None:
+        experiment_ids = [insert_experiment_table_start(db_conn, label_config) for label_config in label_runs]
+        model_set_ids, completed_tasks = {}, set()
+    else:
+        # Reuse the model sets of the experiment, and drop the models of the
+        # tasks that did not finish, which are rerun
+        experiment_id = int(resume_experiment_id)
+        experiment_ids = [experiment_id]
+        model_set_ids = get_model_set_ids(db_conn, experiment_id)
+        n_deleted = delete_unfinished_models(db_conn, experiment_id)
+        completed_tasks = get_completed_tasks(db_conn, experiment_id)
+        logger.info(
+            f'Resuming experiment {experiment_id}: {len(completed_tasks)} finished tasks, '
+            f'deleted {n_deleted} unfinished models'
+        )
 
     if create_cohort:
         # Create and populate the cohort
@@ -151,15 +298,17 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
 
     if create_labels:
         # Create and populate the labels
-        labels.create_empty_labels(db_conn, config, psql_role)
-        labels.insert_labels(db_conn, as_of_dates, config)
+        for label_config in label_runs:
+            labels.create_empty_labels(db_conn, label_config, psql_role)
+            labels.insert_labels(db_conn, as_of_dates, label_config)
         logger.info('Inserted labels')
 
     if create_features:
         # Create and populate the features
         features.create_features(db_conn, config, as_of_dates, psql_role)
-        # Delete old master_df and train / validation matrices
-        delete_matrices_from_disk()
+        # Matrices (and the models cached on them) are keyed on the contents
+        # of the feature tables they are built from, so only those affected by
+        # the rebuilt features are recomputed
         logger.info('Inserted features')
 
     # ---------------------------
@@ -168,11 +317,20 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
     # Create and cache the matrices for each time fold
     logger.info("Searching for labels ...")
     label_name = ', '.join(config['labels']['selected_labels'])
-    labels_dict = load_labels(db_conn, county, folds_spec, label_tablename)
+    labels_dicts = [
+        get_shared(
+            shared, ('labels', label_tablename, county, folds_spec),
+            lambda label_tablename=label_tablename: load_labels(db_conn, county, folds_spec, label_tablename)
+        ) for label_tablename in label_tablenames
+    ]
+    labels_dict = {}
 
     logger.info("Searching for matrices...")
-    write_matrix_driver(db_conn, config)
-    matrices_dict = load_matrices(county, folds_spec)
+    matrix_names, matrices_dict = get_shared(
+        shared, ('matrices', matrices_config_key(config, folds_spec)),
+        lambda: load_shared_matrices(db_conn, config, county, folds_spec)
+    )
+    matrices_dict = dict(matrices_dict)
 
     # For each (fold, county) entry in the cached matrices
     # Convert them to pandas dataframes, which makes things easier downstream
@@ -186,17 +344,25 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
         assert X_train.isna().sum().sum() == 0
         assert X_val.isna().sum().sum() == 0
 
-        # Load the train and validation labels
-        y_train, y_val = labels_dict[key]
+        # Load the train and validation labels of every labels table, one column each
+        y_train, y_val = [
+            pd.concat([
+                label_dict[key][split]['label'].rename(label_tablename)
+                for label_tablename, label_dict in zip(label_tablenames, labels_dicts)
+            ], axis=1, join='inner')
+            for split in [0, 1]
+        ]
 
         # Join the test / validation matrices with the test / validation labels
         joined_df_train = X_train.join(y_train, how='inner')
         joined_df_val = X_val.join(y_val, how='inner')
 
         # Save as pandas dataframes
-        matrices_dict[key] = joined_df_train.drop(columns=['label']), joined_df_val.drop(columns=['label'])
-        labels_dict[key] = joined_df_train['label'], joined_df_val['label']
+        matrices_dict[key] = joined_df_train.drop(columns=label_tablenames), joined_df_val.drop(columns=label_tablenames)
+        labels_dict[key] = joined_df_train[label_tablenames], joined_df_val[label_tablenames]
 
+    # Training rows and features of every fold, which the scheduler estimates costs from
+    fold_shapes = {key: matrices_dict[key][0].shape for key in matrices_dict.keys()}
 
     # --------------------
     # Start the model runs
@@ -218,63 +384,250 @@ def run_pipeline(config, psql_role, create_cohort=True, create_labels=True, crea
         param_values = model_config.values()
         param_combinations = itertools.product(*param_values)
 
-        # For each particular parameter combination, create a ModelSet object
+        # For each particular parameter combination, create a ModelSet object per experiment
         for params in param_combinations:
             param_dict = dict(zip(param_names, params))
 
-            # The combination of type of model and parameters creates a model set
-            # Save this model set configuration to the database
-            ms = modeling.ModelSet(models_dict[model_class], param_dict, temporal_params, experiment_id, county)
-            ms.save_model_sets(db_conn)
+            grid_els = []
+            for experiment_id in experiment_ids:
+                # The combination of type of model and parameters creates a model set
+                # Save this model set configuration to the database, unless the
+                # resumed experiment saved it already
+                ms = modeling.ModelSet(models_dict[model_class], param_dict, temporal_params, experiment_id, county)
+                model_set_key = get_model_set_key(ms.model_type, json.loads(json.dumps(param_dict)))
+                if model_set_key in model_set_ids:
+                    ms.model_set_id = model_set_ids[model_set_key]
+                else:
+                    ms.save_model_sets(db_conn)
+                grid_els.append((model_class, param_dict, ms))
 
             # Append on the relevant objects for use below
-            model_class_params_grid.append((model_class, param_dict, ms))
+            model_class_params_grid.append(grid_els)
             logger.info('Saved model set to database: ' + str(models_dict[model_class]))
 
 
-    # Run all model sets and validation folds in parallel if desired
-    if config['parallel']:
-        Parallel(n_jobs=int(config['nr_cores']))(
-         delayed(run_model_set)(
-             county, label_tablename, grid_el, fold, matrices_dict, labels_dict
-         ) for grid_el in model_class_params_grid for fold in folds_spec
-        )
-
-    # Otherwise run model sets and validation folds sequentially;
-    # preferred for e.g. random forests which can parallelize building trees over the cores
-    else:
-        for grid_el in model_class_params_grid:
-            for fold in folds_spec:
-                run_model_set(county, label_tablename, grid_el, fold, matrices_dict, labels_dict)
+    # Predictions, evaluations and feature importances of all models are
+    # buffered and copied to the results schema in bulk
+    sink = ResultSink(
+        flush_rows=int(config.get('result_flush_rows', 500000)),
+        flush_seconds=float(config.get('result_flush_seconds', 300))
+    )
+    save_predictions_to_db = bool(config.get('save_predictions_to_db', 1))
+    tasks = [
+        (grid_els, fold) for grid_els in model_class_params_grid for fold in folds_spec
+        if not all((ms.model_set_id, fold[1]) in completed_tasks for _, _, ms in grid_els)
+    ]
+    logger.info(f'Running {len(tasks)} tasks')
+    fold_arrays_dir = None
+
+    # With several labels, models that support it can be trained once on all of them
+    multi_output = len(label_runs) > 1 and bool(config.get('multi_output', 0))
+    multi_outputs = [multi_output and grid_els[0][2].model_type in modeling.MULTI_OUTPUT_MODEL_TYPES for grid_els, _ in tasks]
+
+    # Models are cached on their class and parameters and the fingerprints of
+    # their fold's matrices and labels, so that models trained by previous
+    # experiments are reused instead of retrained
+    cache_keys = {}
+    if config.get('model_cache', 1):
+        label_keys = [
+            {key: labels_fingerprint(y_train[label_tablename], y_val[label_tablename]) for key, (y_train, y_val) in labels_dict.items()}
+            for label_tablename in label_tablenames
+        ]
+        for i, (grid_els, fold) in enumerate(tasks):
+            if multi_outputs[i]:
+                continue
+            cache_keys[i] = [
+                model_cache_key(model_class, param_dict, matrix_names[(fold, county)], label_key[(fold, county)])
+                for (model_class, param_dict, _), label_key in zip(grid_els, label_keys)
+            ]
+
+    try:
+        # Run all model sets and validation folds in parallel if desired
+        if config['parallel']:
+            n_jobs = int(config['nr_cores'])
+            fold_paths = {key: None for key in matrices_dict.keys()}
+            if config.get('share_matrices', 1):
+                # Write every fold once to memory-mappable files, so that each task
+                # only receives the path of its fold and the workers share one copy
+                # of the data instead of unpickling all folds for every task
+                fold_arrays_dir = os.path.join(FOLD_ARRAYS_DIR, f'experiment_{experiment_ids[0]}')
+                for i, key in enumerate(matrices_dict.keys()):
+                    fold_paths[key] = os.path.join(fold_arrays_dir, str(i))
+                    write_fold_arrays(*matrices_dict[key], *labels_dict[key], fold_paths[key])
+                matrices_dict, labels_dict = None, None
+                logger.info('Wrote fold arrays to ' + fold_arrays_dir)
+
+            # Estimate the cost of every task from the recorded fit times of
+            # previous runs, and run the long tasks of models that fit in parallel
+            # one at a time on all cores, and the others on the workers, longest first
+            intra_model, inter_task = [], list(range(len(tasks)))
+            if config.get('cost_scheduler', 1):
+                rates = fit_cost_rates(get_task_timings(db_conn))
+                costs = []
+                for i, (grid_els, fold) in enumerate(tasks):
+                    _, param_dict, ms = grid_els[0]
+                    # Number of models the task fits; cached models cost nothing
+                    n_fits = len(grid_els)
+                    if multi_outputs[i]:
+                        n_fits = 1
+                    elif i in cache_keys:
+                        n_fits = sum(not os.path.exists(get_cached_model_path(cache_key)) for cache_key in cache_keys[i])
+                    costs.append(n_fits * estimate_cost(ms.model_type, param_dict, *fold_shapes[(fold, county)], rates))
+                parallel_models = [grid_els[0][2].model_type in PARALLEL_MODEL_TYPES for grid_els, _ in tasks]
+                intra_model, inter_task = schedule_tasks(costs, parallel_models, n_jobs)
+                logger.info(
+                    f'Scheduled {len(intra_model)} tasks on all cores and {len(inter_task)} tasks on '
+                    f'{n_jobs} workers, an estimated {sum(costs) / 3600:.1f} core hours'
+                )
+
+            for i in intra_model:
+                grid_els, fold = tasks[i]
+                for _, _, ms in grid_els:
+                    set_model_n_jobs(ms.model, n_jobs)
+                run_model_set(
+                    county, label_tablenames, grid_els, fold, matrices_dict, labels_dict,
+                    fold_paths[(fold, county)], sink, save_predictions_to_db, cache_keys.get(i), multi_outputs[i]
+                )
+            if config.get('cost_scheduler', 1):
+                # Every worker has a core of its own
+                for grid_els, _ in tasks:
+                    for _, _, ms in grid_els:
+                        set_model_n_jobs(ms.model, 1)
+
+            # Workers return their results to this process, which copies them to
+            # the database; tasks run in chunks so results do not pile up in memory
+            chunk_size = n_jobs * int(config.get('result_chunk_tasks', 4))
+            with Parallel(n_jobs=n_jobs) as parallel:
+                for start in range(0, len(inter_task), chunk_size):
+                    results = parallel(
+                        delayed(run_model_set)(
+                            county, label_tablenames, tasks[i][0], tasks[i][1], matrices_dict, labels_dict,
+                            fold_paths[(tasks[i][1], county)], None, save_predictions_to_db, cache_keys.get(i),
+                            multi_outputs[i]
+                        ) for i in inter_task[start:start + chunk_size]
+                    )
+                    for buffers in results:
+                        sink.extend(buffers)
+
+        # Otherwise run model sets and validation folds sequentially;
+        # preferred for e.g. random forests which can parallelize building trees over the cores
+        else:
+            for i, (grid_els, fold) in enumerate(tasks):
+                run_model_set(
+                    county, label_tablenames, grid_els, fold, matrices_dict, labels_dict,
+                    sink=sink, save_predictions_to_db=save_predictions_to_db, cache_keys=cache_keys.get(i),
+                    multi_output=multi_outputs[i]
+                )
+
+    finally:
+        # Copy whatever results are left, also if a model failed
+        sink.flush()
+        if fold_arrays_dir is not None and os.path.exists(fold_arrays_dir):
+            shutil.rmtree(fold_arrays_dir)
 
     # Insert the end date to the results.experiments table
-    insert_experiment_table_end(db_conn, experiment_id)
+    for experiment_id in experiment_ids:
+        insert_experiment_table_end(db_conn, experiment_id)
     logger.info('Pipeline was run successfully!')
 
 
+def get_label_run_key(config) -> str:
+    """Key of a config without its selected labels; configs with the same key
+    differ only in their labels."""
+    return hash_object(dict(config, labels=dict(config['labels'], selected_labels=None)))
+
+
+def run_pipelines(configs, psql_role, recreate_sources=False):
+    """Runs the pipeline for several configs in one process, one experiment per
+    config. The configs share one database connection, the matrices of the configs
+    with the same county, features and folds, and the labels of those with the same
+    label table, which are loaded once instead of once per config. Configs run
+    grouped by county, so that the matrices of only one county are held in memory.
+    Configs with multi_label set that differ only in their labels run in a single
+    pass, see the label_configs of run_pipeline(). As with one process per config,
+    a failed run does not stop the others.
+
+    Args:
+        configs (list of dict): config dictionaries
+        psql_role (str): role to create the cohort, labels, and features tables with
+        recreate_sources (bool): If true the first run recreates the cohort, labels,
+            and features tables. Defaults to False.
+    """
+    configs = sorted(configs, key=lambda config: config['county'])
+    runs = {}
+    for i, config in enumerate(configs):
+        key = get_label_run_key(config) if config.get('multi_label', 0) else i
+        runs.setdefault(key, []).append(config)
+    runs = list(runs.values())
+
+    shared = {}
+    failed = []
+    for i, run in enumerate(runs):
+        if i > 0 and run[0]['county'] != runs[i - 1][0]['county']:
+            shared = {key: shared[key] for key in ['db_conn'] if key in shared}
+        try:
+            run_pipeline(
+                run[0],
+                psql_role,
+                create_cohort=recreate_sources and i == 0,
+                create_labels=recreate_sources and i == 0,
+                create_features=recreate_sources and i == 0,
+                shared=shared,
+                label_configs=run[1:]
+            )
+        except Exception:
+            label_tablenames = ', '.join(get_label_tablename(config) for config in run)
+            logger.exception(f'Run {i} ({run[0]["county"]}, {label_tablenames}) failed')
+            failed.append(i)
+            # The connection may be left in a failed transaction
+            shared.pop('db_conn', None)
+
+    if failed:
+        raise Exception(f'{len(failed)} of {len(runs)} runs failed, see the log.')
+
+
 if __name__ == '__main__':
 
-    filename = sys.argv[1]
-    assert '.yaml' in filename
+    # python run.py (CONFIG_FILE [CONFIG_FILE ...] | --resume EXPERIMENT_ID) [PSQL_ROLE] [-recreate_sources]
+    args = sys.argv[1:]
+    resume_experiment_id = None
+    if '--resume' in args:
+        i = args.index('--resume')
+        resume_experiment_id = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
 
-    CONFIG_PATH = os.path.join(PROJ_DIR, PIPELINE_DIR, filename)
-    psql_role = ''
+    recreate_sources = '-recreate_sources' in args
+    args = [arg for arg in args if arg != '-recreate_sources']
+
+    filenames = [arg for arg in args if '.yaml' in arg]
+    args = [arg for arg in args if '.yaml' not in arg]
 
-    if len(sys.argv) > 2:
-        psql_role = sys.argv[2]
+    configs = []
+    for filename in filenames:
+        CONFIG_PATH = os.path.join(PROJ_DIR, PIPELINE_DIR, filename)
+        with open(CONFIG_PATH) as f:
+            configs.append(yaml.safe_load(f))
 
-    recreate_sources = '-recreate_sources' in sys.argv
+    if resume_experiment_id is not None:
+        # A resumed experiment runs with the config it was started with
+        configs = [get_experiment_config(get_database_connection(), resume_experiment_id)]
+    assert len(configs) > 0
 
-    with open(CONFIG_PATH) as f:
-        config = yaml.safe_load(f)
+    psql_role = ''
+    if len(args) > 0:
+        psql_role = args[0]
 
     start = datetime.now()
-    run_pipeline(
-        config,
-        psql_role,
-        create_cohort=recreate_sources,
-        create_labels=recreate_sources,
-        create_features=recreate_sources
-    )
+    if len(configs) > 1:
+        run_pipelines(configs, psql_role, recreate_sources=recreate_sources)
+    else:
+        run_pipeline(
+            configs[0],
+            psql_role,
+            create_cohort=recreate_sources,
+            create_labels=recreate_sources,
+            create_features=recreate_sources,
+            resume_experiment_id=resume_experiment_id
+        )
     end = datetime.now()
     logger.info('Overall pipeline run took: ' + str(end - start))
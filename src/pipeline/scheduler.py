@@ -0,0 +1,174 @@
+import json
+import numpy as np
+import pandas as pd
+from joblib import effective_n_jobs
+from utils.helpers import read_sql
+from pipeline.task_ledger import TASK_LEDGER_TABLE
+
+
+# Models that fit in parallel on their n_jobs cores
+PARALLEL_MODEL_TYPES = ['RandomForestClassifier', 'ExtraTreesClassifier']
+
+# sklearn defaults of the parameters the cost of a model depends on
+N_ESTIMATORS_DEFAULTS = {
+    'RandomForestClassifier': 100,
+    'ExtraTreesClassifier': 100,
+    'GradientBoostingClassifier': 100,
+    'AdaBoostClassifier': 50,
+}
+MAX_DEPTH_DEFAULTS = {
+    'DecisionTreeClassifier': None,
+    'RandomForestClassifier': None,
+    'ExtraTreesClassifier': None,
+    'GradientBoostingClassifier': 3,
+    'AdaBoostClassifier': 1,
+}
+MAX_FEATURES_DEFAULTS = {
+    'DecisionTreeClassifier': None,
+    'RandomForestClassifier': 'sqrt',
+    'ExtraTreesClassifier': 'sqrt',
+    'GradientBoostingClassifier': None,
+    'AdaBoostClassifier': None,
+}
+
+# Seconds per unit of task_work() of a single core, until timings of the model
+# type are recorded in the task ledger
+DEFAULT_COST_RATES = {
+    'DecisionTreeClassifier': 2e-8,
+    'RandomForestClassifier': 2e-8,
+    'ExtraTreesClassifier': 1e-8,
+    'GradientBoostingClassifier': 2e-8,
+    'AdaBoostClassifier': 2e-8,
+    'LogisticRegression': 1e-7,
+    'MLPClassifier': 1e-9,
+}
+DEFAULT_COST_RATE = 1e-8
+
+
+def model_n_jobs(model) -> int:
+    """Number of cores a model fits on."""
+    if type(model).__name__ not in PARALLEL_MODEL_TYPES:
+        return 1
+    return effective_n_jobs(model.get_params().get('n_jobs'))
+
+
+def set_model_n_jobs(model, n_jobs: int):
+    """Set the number of cores of a model that fits in parallel."""
+    if type(model).__name__ in PARALLEL_MODEL_TYPES:
+        model.set_params(n_jobs=n_jobs)
+
+
+def features_per_split(max_features, n_features: int) -> float:
+    """Number of features a tree considers at each split."""
+    if max_features in ['sqrt', 'auto']:
+        return np.sqrt(n_features)
+    if max_features == 'log2':
+        return np.log2(max(n_features, 2))
+    if isinstance(max_features, float):
+        return max_features * n_features
+    if isinstance(max_features, int):
+        return min(max_features, n_features)
+    return n_features
+
+
+def task_work(model_type: str, params: dict, n_rows: int, n_features: int) -> float:
+    """Amount of work of fitting a model, proportional to its fit time on one
+    core: rows * features, times the number of trees and the depth of the
+    trees for tree models, and the iterations and hidden units for MLPs.
+
+    Args:
+        model_type (str): model class name, e.g. RandomForestClassifier
+        params (dict): model parameters, defaults for those not given
+        n_rows (int): number of training rows
+        n_features (int): number of features
+    """
+    n_rows, n_features = max(int(n_rows), 2), max(int(n_features), 1)
+    features = n_features
+    depth = 1.0
+    trees = 1.0
+    if model_type in MAX_DEPTH_DEFAULTS:
+        features = features_per_split(params.get('max_features', MAX_FEATURES_DEFAULTS[model_type]), n_features)
+        # Trees of rows with few features do not get deeper than about log2(rows)
+        depth = np.log2(n_rows)
+        max_depth = params.get('max_depth', MAX_DEPTH_DEFAULTS[model_type])
+        if max_depth is not None:
+            depth = min(max_depth, depth)
+    if model_type in N_ESTIMATORS_DEFAULTS:
+        trees = params.get('n_estimators', N_ESTIMATORS_DEFAULTS[model_type])
+    work = n_rows * max(features, 1.0) * max(depth, 1.0) * trees
+    if model_type == 'MLPClassifier':
+        work *= params.get('max_iter', 200) * sum(params.get('hidden_layer_sizes', [100]))
+    return float(work)
+
+
+def get_task_timings(db_conn) -> pd.DataFrame:
+    """Recorded fit times of trained models, from the task ledger, with the
+    type and parameters of their model sets."""
+    timings = read_sql(f"""
+        select ms.type as model_type, ms.params, t.n_train_rows, t.n_features, t.n_jobs, t.train_seconds
+        from {TASK_LEDGER_TABLE} t
+        join results.model_sets ms using (model_set_id)
+        where t.train_seconds is not null
+        """, db_conn)
+    timings['params'] = [json.loads(params) if isinstance(params, str) else params for params in timings['params']]
+    return timings
+
+
+def fit_cost_rates(timings: pd.DataFrame) -> dict:
+    """Seconds per unit of task_work() of every model type: the median over
+    its recorded fit times, times their cores, over their work.
+
+    Args:
+        timings (pd.DataFrame): output of get_task_timings()
+
+    Returns a dictionary mapping model types to rates, with DEFAULT_COST_RATES
+    for the model types without timings.
+    """
+    rates = dict(DEFAULT_COST_RATES)
+    if len(timings) == 0:
+        return rates
+    timings = timings.assign(rate=[
+        row.train_seconds * max(row.n_jobs or 1, 1) / task_work(row.model_type, row.params, row.n_train_rows, row.n_features)
+        for row in timings.itertuples(index=False)
+    ])
+    rates.update(timings.groupby('model_type')['rate'].median().to_dict())
+    return rates
+
+
+def estimate_cost(model_type: str, params: dict, n_rows: int, n_features: int, rates: dict) -> float:
+    """Estimated seconds to fit a model on one core."""
+    return rates.get(model_type, DEFAULT_COST_RATE) * task_work(model_type, params, n_rows, n_features)
+
+
+def schedule_tasks(costs, parallel, n_cores: int) -> tuple[list, list]:
+    """Split tasks between intra-model and inter-task parallelism, longest
+    first.
+
+    Running tasks on n_cores worker processes takes at least the total cost
+    divided by n_cores, and at least the cost of the longest task. Tasks of
+    models that fit in parallel and cost more than both the share of the
+    other tasks and the longest task that cannot fit in parallel would set
+    that time, so they run one at a time on all cores instead; the rest run
+    on the workers, longest first, so that the last tasks to finish are short.
+
+    Args:
+        costs (list of float): estimated cost of every task
+        parallel (list of bool): whether the model of every task fits in parallel
+        n_cores (int): number of cores
+
+    Returns (intra_model, inter_task): the indices of the tasks to run one at a
+    time on all cores and of the tasks to run on the workers, longest first.
+    """
+    costs = np.asarray(costs, dtype=float)
+    order = [int(i) for i in np.argsort(-costs, kind='stable')]
+    intra_model = []
+    remaining = list(order)
+    # Moving a task to the intra-model phase lowers the share of the others
+    while n_cores > 1:
+        bound = max([costs[remaining].sum() / n_cores] + [costs[i] for i in remaining if not parallel[i]])
+        longer = [i for i in remaining if parallel[i] and costs[i] > bound]
+        if not longer:
+            break
+        intra_model.append(longer[0])
+        remaining.remove(longer[0])
+    return intra_model, remaining
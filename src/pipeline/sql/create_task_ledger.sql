@@ -0,0 +1,31 @@
+/*
+Create the task ledger if it does not exist.
+Comments:
+	- One row per finished (experiment, model set, fold) task, keyed by the
+	  fold's validation date
+	- Rows are written in the same transaction as the task's results, so a
+	  task is in the ledger if and only if its results are stored
+	- train_seconds is the time the model took to fit on n_jobs cores (null
+	  if it was loaded from the model cache), from which the scheduler
+	  learns the cost of tasks
+*/
+
+create schema if not exists results;
+
+create table if not exists results.completed_tasks (
+	experiment_id int,
+	model_set_id int,
+	validation_date date,
+	train_end_date date,
+	model_id int,
+	train_seconds float,
+	n_train_rows int,
+	n_features int,
+	n_jobs int,
+	primary key (experiment_id, model_set_id, validation_date)
+);
+
+alter table results.completed_tasks add column if not exists train_seconds float;
+alter table results.completed_tasks add column if not exists n_train_rows int;
+alter table results.completed_tasks add column if not exists n_features int;
+alter table results.completed_tasks add column if not exists n_jobs int;
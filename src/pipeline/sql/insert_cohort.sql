@@ -1,41 +1,49 @@
 /*
-Insert cohort rows.
-Comments: 
+Insert cohort rows for a set of as_of_dates in one statement.
+Comments:
 	- Currently assigning county based on last interaction with system
 	- We remove any person who died before the as_of_date
+	- The dates are joined against client_events once, instead of running
+	  one query per as_of_date
 */
 
 insert into modeling.cohort
-with ce_partitioned as (
-	select 
-		joid as joid,
-    	'{as_of_date}'::date as as_of_date,
-    	table_name,
-		row_number() OVER (PARTITION BY joid ORDER BY event_date DESC) as date_ranked
-	from semantic.client_events
-	where joid is not null
-	    and event_date >= date '{as_of_date}' - interval '{interval_back}'
-	    and event_date <=  date '{as_of_date}'
-		and table_name not in {tables_excluded} 
+with as_of_dates as (
+	select unnest(array[{as_of_dates}]::date[]) as as_of_date
+), last_events as (
+	-- Last event of each person before each as_of_date
+	select distinct on (ce.joid, d.as_of_date)
+		ce.joid as joid,
+		d.as_of_date as as_of_date,
+		ce.table_name
+	from as_of_dates d
+	join semantic.client_events ce
+		on ce.event_date >= d.as_of_date - interval '{interval_back}'
+		and ce.event_date <= d.as_of_date
+	where ce.joid is not null
+		and ce.table_name not in {tables_excluded}
+	order by ce.joid, d.as_of_date, ce.event_date desc
+), deaths as (
+	select joid, dateofdeath
+		from clean.jocodcmexoverdosessuicides
+		where joid is not null
+	union all
+	select joid, dateofdeath
+		from clean.jocojcmexoverdosessuicides
+		where joid is not null
 )
-select distinct
-	joid,
-	as_of_date,
+select
+	le.joid,
+	le.as_of_date,
 	case
-		when table_name in ({doco_tables}) then 'doco'
-		when table_name in ({joco_tables}) then 'joco'
+		when le.table_name in ({doco_tables}) then 'doco'
+		when le.table_name in ({joco_tables}) then 'joco'
 		else null
 	end as county
-from ce_partitioned
-where date_ranked = 1
-	and joid not in (
-		select joid
-			from clean.jocodcmexoverdosessuicides
-			where dateofdeath <= '{as_of_date}'::date 
-				and joid is not null
-	) and joid not in (
-		select joid
-		from clean.jocojcmexoverdosessuicides
-		where dateofdeath <= '{as_of_date}'::date	
-			and joid is not null
-);
\ No newline at end of file
+from last_events le
+where not exists (
+	select 1
+	from deaths de
+	where de.joid = le.joid
+		and de.dateofdeath <= le.as_of_date
+);
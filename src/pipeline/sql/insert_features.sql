@@ -0,0 +1,4 @@
+set role {psql_role};
+
+insert into features.{feature_table_name}
+{feature_query};
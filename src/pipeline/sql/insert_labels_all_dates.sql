@@ -0,0 +1,35 @@
+/*
+Query to build the labels module for a set of as_of_dates in one statement.
+Comments:
+	- The label CTEs are the date-vectorized versions of the config's
+	  cte_expressions (see labels.vectorize_cte_expression): each one joins
+	  the as_of_dates to its events once, and returns (joid, as_of_date, label)
+	- Every label name in {label_names} is inserted for every cohort row
+*/
+
+insert into modeling.{label_tablename} (joid, as_of_date, county, label_name, label)
+with as_of_dates as (
+	select unnest(array[{as_of_dates}]::date[]) as as_of_date
+), {cte_query},
+all_labels as (
+	{labels_query}
+)
+select distinct
+	co.joid as joid,
+	co.as_of_date as as_of_date,
+	co.county as county,
+	n.label_name as label_name,
+	case
+		when l.label is null then false else l.label
+	end as label
+from modeling.cohort co
+join as_of_dates d
+	on co.as_of_date = d.as_of_date
+cross join (
+	select unnest(array[{label_names}]::varchar[]) as label_name
+	) n
+left join all_labels l
+	on co.joid = l.joid
+	and co.as_of_date = l.as_of_date
+	and n.label_name = l.label_name
+where co.county in ({county});
@@ -0,0 +1 @@
+coalesce({agg_func}({agg_column}) over {window_name}, {impute_agg}) as {feature_name}
\ No newline at end of file
@@ -0,0 +1,40 @@
+/*
+Feature query computing the windowed aggregates (see
+features.get_window_feature_query) from each person's event history, instead
+of joining every cohort row to it.
+Comments:
+	- Every cohort row is added to the events of its person as a row without
+	  values; the windows of those rows, which end the day before the as of
+	  date, hold the aggregates
+	- Features that are not windowed aggregates are computed in `joined`,
+	  by joining the cohort to the events as in feature_query.sql; without
+	  such features the join condition is false and nothing is joined
+*/
+
+with cohort as (
+    select joid, as_of_date
+    from modeling.cohort
+    where as_of_date in ({as_of_dates})
+), joined as (
+    select c.joid, c.as_of_date{joined_feature_cols}
+    from cohort c
+    left join {from_arg} t
+    on {joined_condition}
+    group by 1, 2
+), events as (
+    select t.joid, t.{knowledge_date}::date as event_date, null::date as as_of_date, {event_columns}
+    from {from_arg} t
+    where t.joid in (select joid from cohort)
+        and t.{knowledge_date} < (select max(as_of_date) from cohort)
+    union all
+    select c.joid, c.as_of_date as event_date, c.as_of_date, {cohort_columns}
+    from cohort c
+), windowed as (
+    select joid, as_of_date, {window_feature_cols}
+    from events
+    window {windows}
+)
+select j.joid, j.as_of_date, {feature_cols}
+from joined j
+join windowed w
+on j.joid = w.joid and j.as_of_date = w.as_of_date
\ No newline at end of file
@@ -0,0 +1,117 @@
+import json
+import pandas as pd
+from utils.constants import SQL_CREATE_TASK_LEDGER_PATH
+from pipeline.prediction_store import PredictionStore
+
+
+TASK_LEDGER_TABLE = 'results.completed_tasks'
+RESULT_TABLES = ['results.test_predictions', 'results.test_evaluations', 'results.feature_importance']
+
+
+def create_task_ledger(db_conn):
+    """Create the task ledger (results.completed_tasks) if it does not exist.
+
+    Args:
+        db_conn (sqlalchemy.engine.base.Connection): database connection
+    """
+    with open(SQL_CREATE_TASK_LEDGER_PATH, 'r') as f:
+        query = f.read()
+
+    db_conn.execute(query)
+    db_conn.execute("COMMIT")
+
+
+def get_task_row(model) -> pd.DataFrame:
+    """Ledger row of the task of a trained and scored PredictionModel. It is
+    buffered in the model's ResultSink with its results, so that it is
+    written in the same transaction as them. The fit time and shape are null
+    for models loaded from the model cache.
+    """
+    return pd.DataFrame([{
+        'experiment_id': model.experiment_id,
+        'model_set_id': model.model_set_id,
+        'validation_date': model.validation_date,
+        'train_end_date': model.train_date,
+        'model_id': model.model_id,
+        'train_seconds': model.train_seconds,
+        'n_train_rows': model.n_train_rows,
+        'n_features': model.n_features,
+        'n_jobs': model.n_jobs,
+    }]).astype({'n_train_rows': 'Int64', 'n_features': 'Int64', 'n_jobs': 'Int64'})
+
+
+def get_model_set_key(model_type: str, params: dict) -> tuple:
+    """(model type, params) key of a model set, with the params as sorted json."""
+    return model_type, json.dumps(params, sort_keys=True)
+
+
+def get_experiment_config(db_conn, experiment_id: int) -> dict:
+    """Config of an experiment, as stored in results.experiments."""
+    row = db_conn.execute(
+        f'select config from results.experiments where experiment_id = {int(experiment_id)}'
+    ).fetchone()
+    if row is None:
+        raise Exception(f'Experiment {experiment_id} does not exist!')
+    config = row[0]
+    return json.loads(config) if isinstance(config, str) else config
+
+
+def get_model_set_ids(db_conn, experiment_id: int) -> dict:
+    """Model sets of an experiment.
+
+    Returns a dictionary mapping get_model_set_key() to the model_set_id, the
+    first one if a model set was saved more than once.
+    """
+    rows = db_conn.execute(f"""
+        select model_set_id, type, params
+        from results.model_sets
+        where experiment_id = {int(experiment_id)}
+        order by model_set_id desc
+        """).fetchall()
+    return {
+        get_model_set_key(model_type, json.loads(params) if isinstance(params, str) else params): model_set_id
+        for model_set_id, model_type, params in rows
+    }
+
+
+def get_completed_tasks(db_conn, experiment_id: int) -> set:
+    """(model_set_id, validation_date) of the finished tasks of an experiment."""
+    rows = db_conn.execute(
+        f'select model_set_id, validation_date from {TASK_LEDGER_TABLE} where experiment_id = {int(experiment_id)}'
+    ).fetchall()
+    return {(model_set_id, validation_date) for model_set_id, validation_date in rows}
+
+
+def delete_unfinished_models(db_conn, experiment_id: int, store: PredictionStore = None) -> int:
+    """Delete the models of an experiment whose tasks are not in the ledger,
+    e.g. because the run died while they were training, along with any of
+    their results, including their predictions in the prediction store. Their
+    tasks are rerun with new models when the experiment is resumed.
+
+    Returns the number of deleted models.
+    """
+    unfinished = f"""
+        select m.model_id
+        from results.models m
+        join results.model_sets ms using (model_set_id)
+        where ms.experiment_id = {int(experiment_id)}
+            and not exists (
+                select 1 from {TASK_LEDGER_TABLE} t
+                where t.experiment_id = ms.experiment_id and t.model_id = m.model_id
+            )
+        """
+    model_ids = [row[0] for row in db_conn.execute(unfinished).fetchall()]
+    if model_ids:
+        model_ids_str = ', '.join(str(model_id) for model_id in model_ids)
+        for table in RESULT_TABLES + ['results.models']:
+            db_conn.execute(f'delete from {table} where model_id in ({model_ids_str})')
+    db_conn.execute("COMMIT")
+
+    # The prediction store is outside of the results' transactions, so it can
+    # also hold predictions of models whose results were never committed
+    finished = {row[0] for row in db_conn.execute(
+        f'select model_id from {TASK_LEDGER_TABLE} where experiment_id = {int(experiment_id)}'
+    ).fetchall()}
+    store = store or PredictionStore()
+    store.delete([model_id for model_id in store.model_ids(experiment_id=experiment_id) if model_id not in finished])
+    return len(model_ids)
@@ -3,6 +3,7 @@ import math
 import pandas as pd
 import numpy as np
 from utils.constants import PREDICTIONS_DIR
+from pipeline.prediction_store import PredictionStore
 from dateutil.relativedelta import relativedelta
 from datetime import date
 from postmodeling.analyze_labels import get_all_flagged_events
@@ -124,20 +125,23 @@ def get_referral_lists(model_set_id: int, low_k: int, high_k: int, county: str,
     min_val_date:
     max_val_date:
     """
-    # Get the target prediction csv files
-    pred_files = []
-    for path in os.listdir(PREDICTIONS_DIR):
-        if os.path.isfile(os.path.join(PREDICTIONS_DIR, path)):
-            _, _, path_exp_id, path_model_set_id, path_model_id = path.split('_')
-            path_exp_id, path_model_set_id = int(path_exp_id), int(path_model_set_id)
-            # path_model_id = path_model_id.split('.')[0]  # remove csv extension
-            if path_model_set_id == model_set_id:
-                pred_files.append(path)
-
-    # Get the corresponding predictions dataframes
-    pred_dfs = []
-    for pred_file in pred_files:
-        pred_dfs.append(pd.read_csv(os.path.join(PREDICTIONS_DIR, pred_file)))
+    # Get the predictions dataframes of the model set's models from the prediction store
+    store = PredictionStore()
+    pred_dfs = [store.read(model_id) for model_id in store.model_ids(model_set_id=model_set_id)]
+
+    # Models run before the prediction store existed have csv files instead
+    if not pred_dfs:
+        pred_files = []
+        for path in os.listdir(PREDICTIONS_DIR):
+            if os.path.isfile(os.path.join(PREDICTIONS_DIR, path)):
+                _, _, path_exp_id, path_model_set_id, path_model_id = path.split('_')
+                path_exp_id, path_model_set_id = int(path_exp_id), int(path_model_set_id)
+                # path_model_id = path_model_id.split('.')[0]  # remove csv extension
+                if path_model_set_id == model_set_id:
+                    pred_files.append(path)
+
+        for pred_file in pred_files:
+            pred_dfs.append(pd.read_csv(os.path.join(PREDICTIONS_DIR, pred_file)))
 
     # Sort the dataframes by validation date (i.e., as_of_date column)
     pred_dfs = sorted(pred_dfs, key=lambda my_df: df_val_date(my_df))
@@ -5,8 +5,9 @@ import os
 import numpy as np
 import pandas as pd
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
-from utils.helpers import get_database_connection
+from utils.helpers import get_database_connection, read_sql
 from utils.constants import PREDICTIONS_DIR, LABEL_MAPPING
+from pipeline.prediction_store import PredictionStore
 
 
 def get_best_modelsets(
@@ -121,7 +122,7 @@ def rank_models(
         and as_of_date >= '{earliest_date}'::date;
     '''
 
-    df = pd.read_sql(query, db_conn)
+    df = read_sql(query, db_conn)
 
     # Select only the experiments with labels 'months_future' in the future
     if months_future: 
@@ -208,15 +209,21 @@ def get_test_pred_labels(db_conn, model_id):
 
 def get_test_pred_labels_from_csv(model_id, predictions_dir=PREDICTIONS_DIR):
     """
-    Returns model results from csv file in predictions directory given model_id. 
+    Returns model results given model_id from the prediction store (see
+    pipeline/prediction_store.py), which reads only that model's row group.
+    Models run before the store existed are read from their csv file in the
+    predictions directory.
 
     Args:
         - model_id (int)
-        - predictions_dir (str): path to predictions directory
+        - predictions_dir (str): path to predictions directory of legacy csv files
 
     Returns:
         - pandas dataframe
     """
+    store = PredictionStore()
+    if model_id in store:
+        return store.read(model_id)
 
     filedir = os.listdir(predictions_dir)
     file = [x for x in filedir if '_' + str(model_id) + '.csv' in x]
@@ -279,16 +286,9 @@ def get_evaluation(db_conn, model_id, read_from_db=False):
         '''
         df = pd.read_sql(formatted_query, db_conn)
 
-    # Get test predictions from /mnt/data
+    # Get test predictions from the prediction store in /mnt/data
     else:
-        filedir = os.listdir(PREDICTIONS_DIR)
-        file = [x for x in filedir if '_' + str(model_id) + '.csv' in x]
-        if file != []:
-            file = file[0]
-        else:
-            raise Exception('Predictions do not exist for this model!')
-        filepath = os.path.join(PREDICTIONS_DIR, file)
-        df = pd.read_csv(filepath)
+        df = get_test_pred_labels_from_csv(model_id)
 
     # We have both counties in the predictions
     counties = df['county'].unique()
@@ -483,7 +483,7 @@ def get_features_test_pred(
         where model_id = {model_id};
         '''
         formatted_query = query.format(model_id=model_id, features_table=features_table)
-        features_preds = pd.read_sql(formatted_query, db_conn)
+        features_preds = read_sql(formatted_query, db_conn)
     
     else:
         preds = get_test_pred_labels_from_csv(model_id)
@@ -495,7 +495,7 @@ def get_features_test_pred(
         where as_of_date in({str_dates});
         '''
 
-        features_df = pd.read_sql(query, db_conn)
+        features_df = read_sql(query, db_conn)
         preds['as_of_date'] = pd.to_datetime(preds['as_of_date'], format='%Y-%m-%d')
         features_df['as_of_date'] = pd.to_datetime(features_df['as_of_date'], format='%Y-%m-%d')
 
@@ -590,7 +590,7 @@ def get_split_label_df(db_conn, model_ids, joco_k=75, doco_k=40):
     where sl.label and tp.label and tp.model_id in({str_model_ids});
     '''
 
-    df = pd.read_sql(query, db_conn)
+    df = read_sql(query, db_conn)
     df = get_predictions(df, joco_k=joco_k, doco_k=doco_k)
     return df
 
@@ -656,45 +656,6 @@ def get_models_info(db_conn, model_ids):
     return pd.read_sql(sql_q, db_conn)
 
 
-def get_test_pred_labels_from_csv(model_id, predictions_dir=PREDICTIONS_DIR):
-    """
-    Returns model results from csv file in predictions directory given model_id. 
-    Args:
-        - model_id (int)
-        - predictions_dir (str): path to predictions directory
-    Returns:
-        - pandas dataframe
-    """
-
-    filedir = os.listdir(predictions_dir)
-    file = [x for x in filedir if '_' + str(model_id) + '.csv' in x]
-    if file != []:
-        file = file[0]
-    else:
-        raise Exception('Predictions do not exist for this model!')
-    filepath = os.path.join(predictions_dir, file)
-
-    return pd.read_csv(filepath)
-
-
-def get_test_pred_labels_from_csv(model_id, predictions_dir=PREDICTIONS_DIR):
-    """
-    Returns model results from csv file in predictions directory given model_id.
-    Args:
-        - model_id (int)
-        - predictions_dir (str): path to predictions directory
-    Returns:
-        - pandas dataframe
-    """
-    filedir = os.listdir(predictions_dir)
-    file = [x for x in filedir if '_' + str(model_id) + '.csv' in x]
-    if file != []:
-        file = file[0]
-    else:
-        raise Exception('Predictions do not exist for this model!')
-    filepath = os.path.join(predictions_dir, file)
-    return pd.read_csv(filepath)
-
 def create_split_label_counts(db_conn) :
     '''
     Create a table to see counts of split labels by as_of_date and label_name
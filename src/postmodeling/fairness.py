@@ -3,6 +3,7 @@ import pandas as pd
 from aequitas.bias import Bias
 from aequitas.group import Group
 from utils.constants import DEMOGRAPHICS_DIR
+from utils.helpers import read_sql
 from postmodeling.evaluation import get_test_pred_labels_from_csv, get_predictions
 
 
@@ -46,7 +47,7 @@ def get_demographics_data(db_conn, attributes=['sex', 'race', 'ethnicity']):
     '''
 
     # Demographics table from semantic.demographics
-    df = pd.read_sql(query, db_conn)
+    df = read_sql(query, db_conn)
     df.to_csv(filedir, index=False)
 
     return df
@@ -23,6 +23,18 @@ def test_flipped_feature_ranker():
     correct_sort = np.argsort(probas[:, 1])[::-1].tolist() 
     assert correct_sort == [0, 1, 2]
 
+def test_feature_ranker_ties_match_tuple_ranking():
+    """Scores and ties should match ranking the rows' (sign-flipped) feature tuples."""
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.integers(0, 3, size=(500, 3)), columns=['days_since', 'ambuls', 'diags'])
+    fr = FeatureRanker(['__flip__days_since', 'ambuls', 'diags'])
+    fr.fit(X, [])
+    scores = fr.predict_proba(X)[:, 1]
+
+    tuples = pd.Series([(-a, b, c) for a, b, c in X.values])
+    expected = tuples.rank(pct=True, method='average')
+    np.testing.assert_allclose(scores, expected.values)
+
 def test_basic_linear_ranker():
     """Ensure linear combination sorting and associated scores are computed correctly."""
 
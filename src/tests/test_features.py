@@ -0,0 +1,233 @@
+import re
+import zlib
+import yaml
+import pytest
+import numpy as np
+import pandas as pd
+from os.path import join
+from datetime import date, timedelta
+from utils.constants import CONFIGS_PATH
+from pipeline import features
+from pipeline.features import get_source_signatures, get_date_signatures, get_stale_dates
+
+
+with open(join(CONFIGS_PATH, 'config_joco_model_sets_rfs_label_death_only_joco.yaml')) as f:
+    CONFIG = yaml.safe_load(f)
+DATES = [date(2019, 1, 1), date(2019, 4, 1), date(2019, 7, 1)]
+
+
+def row_hash(row):
+    """Stands in for Postgres' hashtext(t::text)."""
+    return zlib.crc32(repr(row).encode('utf-8')) - 2 ** 31
+
+
+class FakeConnection():
+    """Database with a cohort, the events of every source table and the
+    comments of the feature tables. Records the statements executed on it,
+    answers the read_sql() queries of create_features() through cursor(), and
+    stores the comments of the executed queries.
+    """
+
+    def __init__(self, failing_query=None):
+        self.failing_query = failing_query
+        self.statements = []
+        self.closed = False
+        self.cohort = [(joid, d) for d in DATES for joid in range(5)]
+        # (joid, knowledge date, value) of the events of every source table
+        self.events = [(1, date(2018, 12, 1), 2.0), (2, date(2019, 2, 1), 3.0), (3, date(2019, 5, 1), 1.0)]
+        self.comments = {}
+
+    def execute(self, query):
+        self.statements.append(query)
+        if query == self.failing_query:
+            raise Exception('query failed')
+        for table_name, comment in re.findall(r"comment on table features\.(\w+) is '(.*)';", query):
+            self.comments[table_name] = comment
+
+    def close(self):
+        self.closed = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def select(self, query):
+        if 'obj_description' in query:
+            return ['table_name', 'comment'], list(self.comments.items())
+        if 'modeling.cohort' in query:
+            days = sorted(set(d for _, d in self.cohort))
+            return ['as_of_date', 'n', 'content_hash'], [
+                (d, sum(1 for _, cd in self.cohort if cd == d), str(sum(row_hash(r) for r in self.cohort if r[1] == d)))
+                for d in days
+            ]
+        if 'knowledge_day' in query:
+            days = sorted(set(kd for _, kd, _ in self.events))
+            return ['knowledge_day', 'n', 'content_hash'], [
+                (d, sum(1 for e in self.events if e[1] == d), str(sum(row_hash(e) for e in self.events if e[1] == d)))
+                for d in days
+            ]
+        raise Exception(f'Unexpected query {query}')
+
+
+class FakeCursor():
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+
+    def execute(self, query, *args):
+        columns, self.rows = self.db_conn.select(query)
+        self.description = [(column,) for column in columns]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def test_execute_timed_resets_the_role(monkeypatch):
+    """Connections go back to the pool without the role of the query."""
+    for failing_query in [None, 'create index idx on features.t (joid);']:
+        db_conn = FakeConnection(failing_query)
+        monkeypatch.setattr(features, 'get_database_connection', lambda: db_conn)
+        try:
+            features.execute_timed('index', 'create index idx on features.t (joid);', 'mh_role')
+        except Exception:
+            assert failing_query is not None
+        assert db_conn.statements[0] == 'set role mh_role;'
+        assert db_conn.statements[-2:] == ['reset role;', 'COMMIT'] and db_conn.closed
+
+
+def signatures(db_conn, table_name='ambulance_runs'):
+    cohort_content = features.get_content_per_date(db_conn, 'modeling.cohort')
+    source_signatures = get_source_signatures(db_conn, CONFIG['features'][table_name], DATES)
+    return get_date_signatures(cohort_content, source_signatures, DATES)
+
+
+@pytest.mark.filterwarnings('ignore:pandas only supports SQLAlchemy')
+def test_backfilled_event_marks_later_dates_stale():
+    db_conn = FakeConnection()
+    stored = signatures(db_conn)
+    assert get_stale_dates(stored, signatures(db_conn), DATES) == []
+
+    # An event known on 2019-03-01 arrives late; the features of 2019-01-01 never include it
+    db_conn.events.append((4, date(2019, 3, 1), 5.0))
+    assert get_stale_dates(stored, signatures(db_conn), DATES) == DATES[1:]
+
+    # A correction with the same number of events and the same knowledge date
+    db_conn = FakeConnection()
+    db_conn.events[2] = (3, date(2019, 5, 1), 9.0)
+    assert get_stale_dates(stored, signatures(db_conn), DATES) == DATES[2:]
+    # Dates without signatures are stale
+    assert get_stale_dates({}, stored, DATES) == DATES
+
+
+@pytest.mark.filterwarnings('ignore:pandas only supports SQLAlchemy')
+def test_changed_cohort_marks_its_date_stale():
+    db_conn = FakeConnection()
+    stored = signatures(db_conn)
+    # Same size, different people
+    db_conn.cohort = [(joid + 10 if d == DATES[1] else joid, d) for joid, d in db_conn.cohort]
+    assert get_stale_dates(stored, signatures(db_conn), DATES) == [DATES[1]]
+
+
+def run_create_features(monkeypatch, db_conn, psql_role):
+    """Run create_features() incrementally on db_conn; returns the names of
+    the feature queries it executed."""
+    executed = {}
+    def execute_concurrently(queries, psql_role, n_jobs):
+        executed.update(queries)
+        for query in queries.values():
+            db_conn.execute(query)
+    monkeypatch.setattr(features, 'execute_concurrently', execute_concurrently)
+    features.create_features(db_conn, dict(CONFIG, incremental_features=1), DATES, psql_role)
+    return sorted(name for name in executed if not name.startswith('index'))
+
+
+@pytest.mark.filterwarnings('ignore:pandas only supports SQLAlchemy')
+def test_incremental_refresh(monkeypatch):
+    db_conn = FakeConnection()
+    table_names = run_create_features(monkeypatch, db_conn, 'mh_role')
+    assert table_names == sorted(f'create features.{name}' for name in db_conn.comments)
+
+    # The spec hash does not depend on the role, so nothing is recomputed
+    assert run_create_features(monkeypatch, db_conn, 'other_role') == []
+    assert features.get_feature_spec_hash(CONFIG, 'ambulance_runs', 'ambulance_runs_num') in \
+        db_conn.comments['ambulance_runs_num']
+
+    # A late event is inserted into the later dates of every table
+    db_conn.events.append((4, date(2019, 5, 1), 5.0))
+    updates = run_create_features(monkeypatch, db_conn, 'mh_role')
+    assert updates == sorted(f'insert 1 dates into features.{name}' for name in db_conn.comments)
+    update = [s for s in db_conn.statements if s.startswith('delete from features.ambulance_runs_num')][-1]
+    assert "where as_of_date in ('2019-07-01')" in update
+    assert run_create_features(monkeypatch, db_conn, 'mh_role') == []
+
+    # A table with a comment of the old form is rebuilt
+    db_conn.comments['ambulance_runs_num'] = 'deadbeef'
+    assert run_create_features(monkeypatch, db_conn, 'mh_role') == ['create features.ambulance_runs_num']
+
+
+def render_num_queries(feature_aggregation):
+    config = dict(CONFIG, feature_aggregation=feature_aggregation)
+    return {
+        table_name: features.get_feature_table_queries(config, DATES, table_name, '{feature_query}').get(table_name + '_num')
+        for table_name in CONFIG['features']
+    }
+
+
+def test_window_and_join_queries_select_the_same_features():
+    window_queries, join_queries = render_num_queries('window'), render_num_queries('join')
+    assert 'range between' in window_queries['ambulance_runs']
+    for table_name, join_query in join_queries.items():
+        assert 'range between' not in (join_query or '')
+        agg_features = []
+        if 'agg' in CONFIG['features'][table_name]['features']:
+            agg_features = features.get_agg_features(CONFIG, table_name)
+        if not any(features.is_window_feature(f) for f in agg_features):
+            assert window_queries[table_name] == join_query
+            continue
+        # Every feature is computed once, windowed or joined, and the columns keep their order
+        feature_names = [f['feature_name'] for f in agg_features]
+        for feature_name in feature_names:
+            assert window_queries[table_name].count(f' as {feature_name}') == 1
+        select = window_queries[table_name].rsplit('select j.joid, j.as_of_date, ', 1)[1]
+        positions = [select.index('.' + feature_name) for feature_name in feature_names]
+        assert positions == sorted(positions)
+
+
+def test_cohort_expressions_are_not_windowed():
+    feature = {'feature_name': 'x', 'agg_func': 'SUM', 'agg_arg': '1', 'interval': '7 days', 'add_filter': ''}
+    assert features.is_window_feature(feature)
+    assert not features.is_window_feature(dict(feature, interval='1 hour'))
+    assert not features.is_window_feature(dict(feature, agg_func='MAX'))
+    assert not features.is_window_feature(dict(feature, agg_arg='t.event_date - c.as_of_date'))
+    assert not features.is_window_feature(dict(feature, add_filter='and t.event_date > as_of_date - 30'))
+
+
+def test_window_query_matches_join_query():
+    """Both queries give the same features on synthetic events."""
+    duckdb = pytest.importorskip('duckdb')
+    rng = np.random.default_rng(0)
+    n = 400
+    events = pd.DataFrame({
+        'joid': rng.integers(0, 30, n),
+        'event_date': [date(2017, 1, 1) + timedelta(days=int(d)) for d in rng.integers(0, 900, n)],
+        'primary_impression': np.where(rng.random(n) < .3, None, 'x'),
+    })
+    for flag in ['alcohol_flag', 'drug_flag', 'drug_poisoning_flag', 'other_mental_crisis_flag', 'suicide_attempt_flag', 'suicidal_flag']:
+        events[flag] = rng.random(n) < .3
+    cohort = pd.DataFrame([(joid, d, 'joco') for d in DATES for joid in range(35)], columns=['joid', 'as_of_date', 'county'])
+
+    db_conn = duckdb.connect()
+    db_conn.execute('create schema semantic; create schema modeling;')
+    db_conn.register('events_df', events)
+    db_conn.register('cohort_df', cohort)
+    db_conn.execute('create table semantic.ambulance_runs as select * from events_df')
+    db_conn.execute('create table modeling.cohort as select * from cohort_df')
+
+    window_query, join_query = render_num_queries('window')['ambulance_runs'], render_num_queries('join')['ambulance_runs']
+    window_df, join_df = [
+        db_conn.execute(query).df().sort_values(['joid', 'as_of_date']).reset_index(drop=True)
+        for query in [window_query, join_query]
+    ]
+    assert len(join_df) == len(cohort) and join_df.iloc[:, 2:].to_numpy().sum() > 0
+    pd.testing.assert_frame_equal(window_df, join_df, check_dtype=False)
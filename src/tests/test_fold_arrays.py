@@ -0,0 +1,129 @@
+import os
+import pickle
+import logging
+import pytest
+import numpy as np
+import pandas as pd
+from datetime import date
+from scipy import sparse
+from pipeline.fold_arrays import (
+    write_fold_arrays, load_fold_arrays, is_sparse_frame, sparse_frame, write_sparse_matrices, load_sparse_matrices
+)
+
+
+def make_split(dates, seed):
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_tuples(
+        [(joid, d) for d in dates for joid in range(5)], names=['joid', 'as_of_date']
+    )
+    X = pd.DataFrame(rng.normal(size=(len(index), 3)).astype(np.float32), index=index, columns=['a_1', 'a_2', 'b'])
+    y = pd.Series(rng.integers(0, 2, len(index)), index=index, name='label')
+    return X, y
+
+
+def test_fold_arrays_round_trip(tmp_path):
+    X_train, y_train = make_split([date(2019, 1, 1), date(2019, 4, 1)], 0)
+    X_val, y_val = make_split([date(2019, 7, 1)], 1)
+    path = str(tmp_path / 'fold')
+    write_fold_arrays(X_train, X_val, y_train, y_val, path)
+
+    (X_train_2, X_val_2), (y_train_2, y_val_2) = load_fold_arrays(path)
+    pd.testing.assert_frame_equal(X_train_2, X_train)
+    pd.testing.assert_frame_equal(X_val_2, X_val)
+    pd.testing.assert_series_equal(y_train_2, y_train)
+    pd.testing.assert_series_equal(y_val_2, y_val)
+    # as_of_dates come back as dates, so predictions can be joined with the labels tables
+    assert X_val_2.index.get_level_values('as_of_date')[0] == date(2019, 7, 1)
+
+
+def test_fold_arrays_round_trip_with_several_labels(tmp_path):
+    X_train, y_train = make_split([date(2019, 1, 1), date(2019, 4, 1)], 0)
+    X_val, y_val = make_split([date(2019, 7, 1)], 1)
+    Y_train = pd.DataFrame({'label_death_only_joco': y_train > 0, 'label_suicide_related_only_joco': y_train == 0})
+    Y_val = pd.DataFrame({'label_death_only_joco': y_val > 0, 'label_suicide_related_only_joco': y_val == 0})
+    path = str(tmp_path / 'fold')
+    write_fold_arrays(X_train, X_val, Y_train, Y_val, path)
+
+    (X_train_2, _), (Y_train_2, Y_val_2) = load_fold_arrays(path)
+    pd.testing.assert_frame_equal(X_train_2, X_train)
+    pd.testing.assert_frame_equal(Y_train_2, Y_train)
+    pd.testing.assert_frame_equal(Y_val_2, Y_val)
+
+
+class FakeConnection():
+    def close(self):
+        pass
+
+
+def test_workers_load_the_fold_from_its_path(tmp_path, monkeypatch):
+    """The arguments of a parallel task hold the fold's path instead of its
+    matrices, and run_model_set() memory-maps the fold from that path."""
+    pytest.importorskip('ohio.ext.pandas')
+    # Log to nowhere instead of the pipeline's log directory
+    logging.getLogger('mylogger').addHandler(logging.NullHandler())
+    from sklearn.tree import DecisionTreeClassifier
+    from pipeline import run, modeling
+
+    dates = [date(2019, 1, 1), date(2019, 4, 1)]
+    X_train, y_train = make_split(dates * 40, 0)
+    X_val, y_val = make_split([date(2019, 7, 1)], 1)
+    label = 'label_death_only_joco'
+    path = str(tmp_path / 'fold')
+    write_fold_arrays(X_train, X_val, (y_train > 0).to_frame(label), (y_val > 0).to_frame(label), path)
+
+    fold = (tuple(dates), date(2019, 7, 1))
+    params = {'max_depth': 2}
+    grid_els = [('DecisionTreeClassifier', params, modeling.ModelSet(DecisionTreeClassifier, params, {}, 1, 'joco'))]
+    # As in run_pipeline() with share_matrices: the dictionaries are dropped
+    args = ('joco', [label], grid_els, fold, None, None, path, None, True, None, False)
+    assert len(pickle.dumps(args)) < len(pickle.dumps((X_train, X_val))) / 10
+
+    loaded = []
+    def load(fold_path):
+        loaded.append(fold_path)
+        return load_fold_arrays(fold_path)
+
+    model_ids = iter(range(1, 100))
+    monkeypatch.setattr(run, 'load_fold_arrays', load)
+    monkeypatch.setattr(run, 'get_database_connection', lambda: FakeConnection())
+    monkeypatch.setattr(run, 'MODELS_PATH', str(tmp_path))
+    monkeypatch.setattr(modeling.PredictionModel, 'save_model', lambda self, db_conn: setattr(self, 'model_id', next(model_ids)))
+    monkeypatch.setattr(modeling.PredictionModel, 'save_predictions', lambda self, *args, **kwargs: self.scores)
+    monkeypatch.setattr(modeling.PredictionModel, 'save_evaluations', lambda self, *args, **kwargs: None)
+
+    results = run.run_model_set(*pickle.loads(pickle.dumps(args)))
+    assert loaded == [path]
+    assert len(results['results.completed_tasks']) == 1
+
+
+def make_sparse_split(dates, seed):
+    X, y = make_split(dates, seed)
+    X = X.where(X > 0.5, 0)
+    return sparse_frame(sparse.csr_matrix(X.to_numpy()), X.index, list(X.columns)), y
+
+
+def test_sparse_fold_arrays_round_trip(tmp_path):
+    X_train, y_train = make_sparse_split([date(2019, 1, 1), date(2019, 4, 1)], 0)
+    X_val, y_val = make_sparse_split([date(2019, 7, 1)], 1)
+    path = str(tmp_path / 'fold')
+    write_fold_arrays(X_train, X_val, y_train, y_val, path)
+    assert not os.path.exists(os.path.join(path, 'train_X.npy'))
+
+    (X_train_2, X_val_2), (y_train_2, y_val_2) = load_fold_arrays(path)
+    assert is_sparse_frame(X_train_2) and is_sparse_frame(X_val_2)
+    pd.testing.assert_frame_equal(X_train_2.sparse.to_dense(), X_train.sparse.to_dense())
+    pd.testing.assert_frame_equal(X_val_2.sparse.to_dense(), X_val.sparse.to_dense())
+    pd.testing.assert_series_equal(y_val_2, y_val)
+
+
+def test_sparse_matrices_file_round_trip(tmp_path):
+    X_train, _ = make_sparse_split([date(2019, 1, 1)], 0)
+    X_val, _ = make_sparse_split([date(2019, 7, 1)], 1)
+    path = str(tmp_path / 'matrices.npz')
+    with open(path, 'wb') as f:
+        write_sparse_matrices(X_train, X_val, f)
+
+    X_train_2, X_val_2 = load_sparse_matrices(path)
+    pd.testing.assert_frame_equal(X_train_2, X_train)
+    pd.testing.assert_frame_equal(X_val_2, X_val)
+    assert X_val_2.index.get_level_values('as_of_date')[0] == date(2019, 7, 1)
@@ -0,0 +1,95 @@
+import pandas as pd
+import numpy as np
+import pytest
+from datetime import date
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from pipeline.matrix_store import write_master_store, MasterMatrix, MasterStoreWriter
+from pipeline.fold_encoding import DateStatistics, FoldEncoder
+
+DATES = [date(2019, 1, 1), date(2019, 4, 1), date(2019, 7, 1), date(2019, 10, 1)]
+CAT_COLUMNS = ['dem_race']
+NUM_COLUMNS = ['dem_age', 'runs_sum_7d', 'days_since_last']
+
+
+@pytest.fixture(params=['native', 'downcast'])
+def master(tmp_path, request):
+    """Master store with the dtypes of the dataframe, or downcast to compact ones."""
+    rng = np.random.default_rng(0)
+    rows = [(joid, d) for d in DATES for joid in rng.choice(500, 100, replace=False)]
+    n = len(rows)
+    df = pd.DataFrame(rows, columns=['joid', 'as_of_date'])
+    races = ['A', 'B', None]
+    df['dem_race'] = pd.Series([races[i % 3] for i in range(n)], dtype=object)
+    # 'C' only shows up in the last date
+    df.loc[df['as_of_date'] == DATES[-1], 'dem_race'] = 'C'
+    df['dem_age'] = np.where(rng.random(n) < .2, np.nan, rng.integers(10, 80, n))
+    df['runs_sum_7d'] = rng.integers(0, 5, n)
+    df['days_since_last'] = np.where(rng.random(n) < .3, 999999, rng.integers(0, 300, n)).astype(float)
+
+    path = str(tmp_path / 'master-store')
+    if request.param == 'native':
+        write_master_store(df.set_index(['joid', 'as_of_date']), NUM_COLUMNS, CAT_COLUMNS, path)
+    else:
+        writer = MasterStoreWriter(NUM_COLUMNS, CAT_COLUMNS, path, num_dtype=np.float64, downcast=True)
+        writer.append(df.sort_values(['as_of_date', 'joid']).set_index(['joid', 'as_of_date']))
+        writer.close()
+    return MasterMatrix(path)
+
+
+def fit_on_rows(master, train_dates, validate_dates):
+    """Reference implementation: fit sklearn's encoder and scaler on the training rows."""
+    train_df = master.read(train_dates, CAT_COLUMNS + NUM_COLUMNS)
+    validate_df = master.read(validate_dates, CAT_COLUMNS + NUM_COLUMNS)
+    mean_age = train_df['dem_age'].mean()
+    train_df['dem_age'] = train_df['dem_age'].fillna(mean_age)
+    validate_df['dem_age'] = validate_df['dem_age'].fillna(mean_age)
+
+    encoder = OneHotEncoder(handle_unknown='ignore').fit(train_df[CAT_COLUMNS])
+    X_train = np.hstack([encoder.transform(train_df[CAT_COLUMNS]).toarray(), train_df[NUM_COLUMNS].values])
+    X_validate = np.hstack([encoder.transform(validate_df[CAT_COLUMNS]).toarray(), validate_df[NUM_COLUMNS].values])
+    scaler = StandardScaler().fit(X_train)
+    names = list(encoder.get_feature_names_out(CAT_COLUMNS)) + NUM_COLUMNS
+    return scaler.transform(X_train), scaler.transform(X_validate), names
+
+
+def test_fold_encoder_matches_fit_on_rows(master):
+    """Composing the encoder from per-date statistics gives the same matrices
+    as fitting it on the fold's training rows."""
+    stats = DateStatistics(master)
+    for train_dates, validate_date in [(DATES[:3], DATES[3]), (DATES[1:3], DATES[3]), (DATES[:1], DATES[1])]:
+        encoder = FoldEncoder(stats, train_dates, CAT_COLUMNS, NUM_COLUMNS)
+        X_train = encoder.transform(master, train_dates)
+        X_validate = encoder.transform(master, [validate_date])
+
+        X_train_ref, X_validate_ref, names = fit_on_rows(master, train_dates, [validate_date])
+        assert encoder.get_feature_names_out() == names
+        np.testing.assert_allclose(X_train, X_train_ref, rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(X_validate, X_validate_ref, rtol=1e-5, atol=1e-5)
+
+
+def test_unseen_categories_encode_to_zeros(master):
+    stats = DateStatistics(master)
+    encoder = FoldEncoder(stats, DATES[:3], CAT_COLUMNS, NUM_COLUMNS)
+    assert encoder.categories['dem_race'] == ['A', 'B', None]
+
+    # The validation date only has category 'C', unseen in training
+    X_validate = encoder.transform(master, [DATES[3]])
+    onehot = X_validate[:, :3] * encoder.scale_[:3] + encoder.mean_[:3]
+    np.testing.assert_allclose(onehot, 0, atol=1e-6)
+
+
+def test_sparse_transform_leaves_one_hot_uncentered(master):
+    """The sparse matrices only differ from the dense ones in that one-hot
+    columns are not centered: they are the indicators divided by their scale."""
+    stats = DateStatistics(master)
+    encoder = FoldEncoder(stats, DATES[:3], CAT_COLUMNS, NUM_COLUMNS)
+    for dates in [DATES[:3], [DATES[3]]]:
+        X = encoder.transform(master, dates)
+        X_sparse = encoder.transform_sparse(master, dates)
+        assert X_sparse.format == 'csr' and X_sparse.shape == X.shape
+
+        n_onehot = len(encoder.categories['dem_race'])
+        X_sparse = X_sparse.toarray()
+        np.testing.assert_allclose(X_sparse[:, n_onehot:], X[:, n_onehot:], rtol=1e-5, atol=1e-5)
+        indicators = X[:, :n_onehot] * encoder.scale_[:n_onehot] + encoder.mean_[:n_onehot]
+        np.testing.assert_allclose(X_sparse[:, :n_onehot], indicators / encoder.scale_[:n_onehot], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,75 @@
+import datetime
+import numpy as np
+from utils import helpers
+from utils.helpers import parse_copy_csv, get_database_engine, get_database_pool_size
+
+
+def test_parse_copy_csv_matches_read_sql_types():
+    """COPY's csv output parses to the values and types pd.read_sql() gives."""
+    data = (
+        b'joid,as_of_date,label,county,score,n,config\n'
+        b'1,2019-01-01,t,"",0.5,3,"{""labels"": {""months_future"": 6}}"\n'
+        b'2,2019-07-01,\\N,\\N,\\N,\\N,\\N\n'
+        b'3,2019-07-01,f,"a,b",1e-3,7,"[1]"\n'
+    )
+    columns = [('joid', 20), ('as_of_date', 1082), ('label', 16), ('county', 25), ('score', 701), ('n', 23), ('config', 3802)]
+    df = parse_copy_csv(data, columns)
+
+    assert list(df.columns) == [name for name, _ in columns]
+    assert df['joid'].dtype == np.int64
+    assert df['as_of_date'].tolist() == [datetime.date(2019, 1, 1), datetime.date(2019, 7, 1), datetime.date(2019, 7, 1)]
+    assert df['label'].tolist() == [True, None, False]
+    # Quoted empty strings are empty strings, only \N is null
+    assert df.loc[0, 'county'] == '' and df['county'].isna().tolist() == [False, True, False]
+    assert df.loc[2, 'county'] == 'a,b'
+    # Integer columns with nulls become float, as in pd.read_sql()
+    assert df['n'].dtype == np.float64 and np.isnan(df.loc[1, 'n'])
+    assert df.loc[0, 'config'] == {'labels': {'months_future': 6}}
+
+
+def test_parse_copy_csv_without_rows():
+    df = parse_copy_csv(b'joid,as_of_date\n', [('joid', 20), ('as_of_date', 1082)])
+    assert len(df) == 0 and list(df.columns) == ['joid', 'as_of_date']
+
+
+class FakeEngine():
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self.kwargs = kwargs
+        self.disposed = []
+
+    def dispose(self, close=True):
+        self.disposed.append(close)
+
+
+def test_database_engine_is_per_process(monkeypatch):
+    """The engine is reused within a process; a forked process gets its own,
+    dropping the inherited pool without closing the parent's connections."""
+    for name, value in [('PGUSER', 'u'), ('PGPASSWORD', 'p'), ('PGHOST', 'h'), ('PGPORT', '5432'), ('PGDATABASE', 'd'),
+                        ('PGPOOLSIZE', '3'), ('PGMAXOVERFLOW', '2'), ('PGPOOLPREPING', '0')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(helpers, 'create_engine', FakeEngine)
+    monkeypatch.setattr(helpers, '_engine', None)
+    monkeypatch.setattr(helpers, '_engine_pid', None)
+    pid = [100]
+    monkeypatch.setattr(helpers.os, 'getpid', lambda: pid[0])
+
+    engine = get_database_engine()
+    assert engine.url == 'postgresql://u:p@h:5432/d'
+    assert engine.kwargs == {'pool_size': 3, 'max_overflow': 2, 'pool_pre_ping': False}
+    assert get_database_engine() is engine and engine.disposed == []
+
+    pid[0] = 101
+    child_engine = get_database_engine()
+    assert child_engine is not engine
+    assert engine.disposed == [False]
+    assert get_database_engine() is child_engine
+
+
+def test_database_pool_size(monkeypatch):
+    monkeypatch.delenv('PGPOOLSIZE', raising=False)
+    monkeypatch.delenv('PGMAXOVERFLOW', raising=False)
+    assert get_database_pool_size() == (5, 10)
+    monkeypatch.setenv('PGPOOLSIZE', '8')
+    monkeypatch.setenv('PGMAXOVERFLOW', '0')
+    assert get_database_pool_size() == (8, 0)
@@ -0,0 +1,51 @@
+import yaml
+from os.path import join
+from utils.constants import CONFIGS_PATH
+from pipeline.labels import vectorize_cte_expression, set_label_period
+
+
+with open(join(CONFIGS_PATH, 'config_joco_model_sets_rfs_label_death_only_joco.yaml')) as f:
+    DEFINITIONS = yaml.safe_load(f)['labels']['definitions']
+
+
+def normalize(query):
+    return ' '.join(query.split())
+
+
+def test_vectorize_shipped_cte_expression():
+    """Both CTEs of a shipped definition are joined to the as of dates, keep
+    their table alias, and compare their window to each date."""
+    query = normalize(vectorize_cte_expression(DEFINITIONS['label1']['cte_expression']))
+    assert query.count('select joid, d.as_of_date as as_of_date, true as label') == 2
+    assert query.count('from clean.jocodcmexoverdosessuicides mex cross join as_of_dates d where') == 1
+    assert query.count('from clean.jocojcmexoverdosessuicides mex cross join as_of_dates d where') == 1
+    assert query.count("(mex.dateofdeath < (d.as_of_date + interval '{months_future} months') "
+                       "and mex.dateofdeath > d.as_of_date)") == 2
+    assert '{as_of_date}' not in query
+
+
+def test_vectorize_every_shipped_definition():
+    for spec in DEFINITIONS.values():
+        assert vectorize_cte_expression(spec['cte_expression']) is not None
+
+
+def test_label_period_any():
+    cte_expression = DEFINITIONS['label11']['cte_expression']
+    assert set_label_period(cte_expression, 'validation_period') == cte_expression
+
+    query = normalize(vectorize_cte_expression(set_label_period(cte_expression, 'any')))
+    assert ('where (hscc_diag.admission_date < current_date '
+            'and hscc_diag.admission_date > d.as_of_date) and suicide_attempt_flag') in query
+    assert 'months_future' not in query
+
+
+def test_cte_with_join_is_not_vectorized():
+    cte_expression = """
+        dc_suic as (
+            select joid, true as label
+            from clean.jocodcmexoverdosessuicides mex
+            join clean.jocojcmexoverdosessuicides jc using (joid)
+            where mex.dateofdeath > '{as_of_date}'::date
+        )
+        """
+    assert vectorize_cte_expression(cte_expression) is None
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+from datetime import date
+from dateutil.relativedelta import relativedelta
+from pipeline.local_features import compute_features, compute_feature_table, iter_event_chunks, to_days
+
+
+SPECS = [
+    {'feature_name': f'x_{agg_func.lower()}_{interval}', 'agg_func': agg_func, 'interval': interval, 'days_since': False, 'impute': 0.0}
+    for agg_func in ['SUM', 'COUNT', 'AVG', 'MAX', 'MIN'] for interval in ['7 days', '1 month', None]
+] + [{'feature_name': 'days_since_last', 'agg_func': 'MAX', 'interval': None, 'days_since': True, 'impute': 999.0}]
+
+
+def make_events(seed):
+    rng = np.random.default_rng(seed)
+    n = 500
+    events = pd.DataFrame({
+        'joid': rng.integers(0, 20, n),
+        'event_date': [date(2019, 1, 1) + relativedelta(days=int(d)) for d in rng.integers(0, 200, n)],
+        'x': np.where(rng.random(n) < .1, np.nan, rng.integers(0, 10, n).astype(float)),
+    })
+    cohort = pd.DataFrame([(joid, d) for d in [date(2019, 3, 31), date(2019, 5, 1), date(2019, 7, 1)] for joid in range(0, 25, 2)],
+                          columns=['joid', 'as_of_date'])
+    return events, cohort
+
+
+def naive_features(events, cohort):
+    """The features of every cohort row, one row at a time."""
+    rows = []
+    for joid, as_of_date in cohort.itertuples(index=False):
+        row = []
+        for spec in SPECS:
+            start = date.min
+            if spec['interval'] == '7 days':
+                start = as_of_date - relativedelta(days=7)
+            elif spec['interval'] == '1 month':
+                start = as_of_date - relativedelta(months=1)
+            window = events[(events['joid'] == joid) & (events['event_date'] >= start) & (events['event_date'] < as_of_date)]
+            values = window['days'] if spec['days_since'] else window['x']
+            value = {'SUM': values.sum(min_count=1), 'COUNT': values.count(), 'AVG': values.mean(),
+                     'MAX': values.max(), 'MIN': values.min()}[spec['agg_func']]
+            if spec['days_since']:
+                value = (as_of_date - date(1970, 1, 1)).days - value
+            row.append(spec['impute'] if pd.isna(value) else value)
+        rows.append(row)
+    return np.array(rows, dtype=float)
+
+
+def event_values(events):
+    return np.column_stack([events['days'] if spec['days_since'] else events['x'] for spec in SPECS]).astype(float)
+
+
+def test_compute_features_matches_naive_aggregation():
+    events, cohort = make_events(0)
+    events['days'] = to_days(events['event_date'])
+    features = compute_features(
+        events['joid'].to_numpy(), events['days'].to_numpy(), event_values(events),
+        cohort['joid'].to_numpy(), to_days(cohort['as_of_date']), SPECS
+    )
+    np.testing.assert_allclose(features, naive_features(events, cohort))
+
+
+class FakeCursor():
+    """Cursor of an executed events query, returning rows in joid order."""
+
+    def __init__(self, events):
+        self.description = [(column,) for column in events.columns]
+        self.rows = list(events.sort_values('joid', kind='stable').itertuples(index=False, name=None))
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def test_chunks_do_not_split_people():
+    events, _ = make_events(1)
+    chunks = list(iter_event_chunks(FakeCursor(events), 7))
+    assert sum(len(chunk) for chunk, _ in chunks) == len(events)
+    for chunk, stop_joid in chunks[:-1]:
+        assert (chunk['joid'] < stop_joid).all()
+    assert chunks[-1][1] is None
+
+
+def test_compute_feature_table_is_independent_of_chunk_size():
+    events, cohort = make_events(2)
+    events['days'] = to_days(events['event_date'])
+    stream = pd.DataFrame({'joid': events['joid'], 'event_day': events['days']})
+    for i, column in enumerate(event_values(events).T):
+        stream[f'value_{i}'] = column
+
+    expected = naive_features(events, cohort)
+    for chunk_rows in [1, 10, 10000]:
+        df = compute_feature_table(FakeCursor(stream), cohort, SPECS, chunk_rows)
+        assert list(df.index) == list(zip(cohort['joid'], cohort['as_of_date']))
+        np.testing.assert_allclose(df.to_numpy(), expected)
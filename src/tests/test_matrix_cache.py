@@ -0,0 +1,111 @@
+import copy
+import zlib
+import pandas as pd
+import pytest
+from datetime import date
+import pipeline.features
+from pipeline.features import get_source_signatures
+from pipeline.matrix_cache import fold_fingerprint, master_fingerprint, matrices_config_key, get_local_source_fingerprints
+
+CONFIG = {
+    'features': {
+        'ambulance_runs': {'county': 'joco', 'impute_agg': 0},
+        'jail_bookings': {'county': 'doco', 'impute_agg': 0},
+    }
+}
+FOLD = ((date(2019, 1, 1), date(2019, 4, 1)), date(2019, 7, 1))
+
+
+@pytest.fixture
+def sources():
+    rows = {'2019-01-01': 10, '2019-04-01': 11, '2019-07-01': 12, '2019-10-01': 13}
+    hashes = {d: str(-1000 * n) for d, n in rows.items()}
+    return {
+        'ambulance_runs_num': {
+            'spec': CONFIG['features']['ambulance_runs'],
+            'columns': [['joid', 'integer'], ['as_of_date', 'date'], ['runs_sum_7d', 'bigint']],
+            'rows_per_date': dict(rows),
+            'hash_per_date': dict(hashes),
+        },
+        'jail_bookings_cat': {
+            'spec': CONFIG['features']['jail_bookings'],
+            'columns': [['joid', 'integer'], ['as_of_date', 'date'], ['booking_type', 'text']],
+            'rows_per_date': dict(rows),
+            'hash_per_date': dict(hashes),
+        },
+        'cohort': {'spec': {'interval_back': '1 year'}, 'rows_per_date': dict(rows), 'hash_per_date': dict(hashes)},
+    }
+
+
+def test_fold_key_is_stable(sources):
+    assert fold_fingerprint(sources, CONFIG, FOLD, 'joco') == fold_fingerprint(copy.deepcopy(sources), CONFIG, FOLD, 'joco')
+    assert fold_fingerprint(sources, CONFIG, FOLD, 'joco') != fold_fingerprint(sources, CONFIG, FOLD, 'doco')
+
+
+def test_fold_key_ignores_unrelated_changes(sources):
+    """Changing a table the county does not use, or dates outside of the fold,
+    keeps the key (and the cached matrices)."""
+    key = fold_fingerprint(sources, CONFIG, FOLD, 'joco')
+    changed = copy.deepcopy(sources)
+    changed['jail_bookings_cat']['columns'].append(['booking_reason', 'text'])
+    changed['ambulance_runs_num']['rows_per_date']['2019-10-01'] = 20
+    changed['ambulance_runs_num']['hash_per_date']['2019-10-01'] = '42'
+    assert fold_fingerprint(changed, CONFIG, FOLD, 'joco') == key
+    # but the master matrix, which holds every table and date, is invalidated
+    all_dates = ['2019-01-01', '2019-04-01', '2019-07-01', '2019-10-01']
+    assert master_fingerprint(changed, all_dates) != master_fingerprint(sources, all_dates)
+
+
+@pytest.mark.parametrize('change', [
+    lambda s: s['ambulance_runs_num']['spec'].update(impute_agg=-1),
+    lambda s: s['ambulance_runs_num']['columns'].append(['runs_sum_14d', 'bigint']),
+    lambda s: s['ambulance_runs_num']['rows_per_date'].update({'2019-04-01': 5}),
+    lambda s: s['cohort']['rows_per_date'].update({'2019-07-01': 5}),
+    # same rows, different values, e.g. rebuilt from corrected source data
+    lambda s: s['ambulance_runs_num']['hash_per_date'].update({'2019-04-01': '42'}),
+    lambda s: s['cohort']['hash_per_date'].update({'2019-07-01': '42'}),
+])
+def test_fold_key_changes_with_its_sources(sources, change):
+    key = fold_fingerprint(sources, CONFIG, FOLD, 'joco')
+    changed = copy.deepcopy(sources)
+    change(changed)
+    assert fold_fingerprint(changed, CONFIG, FOLD, 'joco') != key
+
+
+def test_matrices_config_key_ignores_labels_and_models():
+    config = dict(CONFIG, county='joco', labels={'selected_labels': ['suicide']}, models={'LogisticRegression': {'C': [1]}})
+    other = dict(config, labels={'selected_labels': ['overdose']}, models={'DecisionTreeClassifier': {}}, parallel=1)
+    assert matrices_config_key(config, [FOLD]) == matrices_config_key(other, [FOLD])
+    assert matrices_config_key(config, [FOLD]) != matrices_config_key(dict(config, county='doco'), [FOLD])
+    assert matrices_config_key(config, [FOLD]) != matrices_config_key(dict(config, sparse_matrices=1), [FOLD])
+    assert matrices_config_key(config, [FOLD]) != matrices_config_key(config, [(FOLD[0], date(2019, 10, 1))])
+
+
+def test_local_fold_key_changes_with_corrected_events(sources, monkeypatch):
+    """A local feature table is not stored, so its key comes from the events
+    of its source: correcting one (same number of rows, different content)
+    before a date of the fold changes it, after the fold it does not."""
+    config = {'features': dict(CONFIG['features'], ambulance_runs=dict(
+        CONFIG['features']['ambulance_runs'], from_arg='clean.ambulance_runs', knowledge_date='call_time'
+    ))}
+    local_tables = {'ambulance_runs_num': [{'feature_name': 'runs_sum_7d'}]}
+    dates = ['2019-01-01', '2019-04-01', '2019-07-01', '2019-10-01']
+
+    def fold_key(events):
+        def read_sql(query, db_conn):
+            df = pd.DataFrame(events, columns=['knowledge_day', 'row'])
+            df['hash'] = [zlib.crc32(row.encode()) for row in df['row']]
+            df = df.groupby('knowledge_day').agg(n=('row', 'size'), content_hash=('hash', 'sum')).reset_index()
+            df['content_hash'] = df['content_hash'].astype(str)
+            return df
+        monkeypatch.setattr(pipeline.features.pd, 'read_sql', read_sql)
+        signatures = {'ambulance_runs': get_source_signatures(None, config['features']['ambulance_runs'], dates)}
+        fingerprints = dict(sources)
+        fingerprints.update(get_local_source_fingerprints(config, local_tables, sources['cohort'], signatures))
+        return fold_fingerprint(fingerprints, config, FOLD, 'joco')
+
+    events = [(date(2019, 2, 1), '(1,fall)'), (date(2019, 5, 1), '(2,fall)'), (date(2019, 8, 1), '(3,fall)')]
+    key = fold_key(events)
+    assert fold_key(list(events)) == key
+    assert fold_key([events[0], (date(2019, 5, 1), '(2,overdose)'), events[2]]) != key
+    assert fold_key([events[0], events[1], (date(2019, 8, 1), '(3,overdose)')]) == key
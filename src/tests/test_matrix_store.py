@@ -0,0 +1,118 @@
+import pickle
+import pandas as pd
+import numpy as np
+import pytest
+from datetime import date
+from pipeline.matrix_store import write_master_store, MasterMatrix, MasterStoreWriter, downcast_dtype, code_dtype
+
+
+@pytest.fixture
+def master_df():
+    """Small features dataframe with index (joid, as_of_date), in no particular order."""
+    rows = [
+        (3, date(2019, 7, 1), 'A', 10.0, 1),
+        (1, date(2019, 1, 1), None, np.nan, 0),
+        (2, date(2019, 7, 1), 'B', 30.0, 5),
+        (1, date(2019, 7, 1), 'A', 11.0, 2),
+        (2, date(2020, 1, 1), 'B', 31.0, 0),
+        (2, date(2019, 1, 1), 'B', 29.0, 3),
+    ]
+    df = pd.DataFrame(rows, columns=['joid', 'as_of_date', 'dem_race', 'dem_age', 'runs_sum_7d'])
+    df['dem_race'] = pd.Series([row[2] for row in rows], dtype=object)
+    return df.set_index(['joid', 'as_of_date'])
+
+
+@pytest.fixture
+def master(master_df, tmp_path):
+    path = str(tmp_path / 'master-store')
+    write_master_store(master_df, ['dem_age', 'runs_sum_7d'], ['dem_race'], path)
+    return MasterMatrix(path)
+
+
+def test_date_ranges_are_contiguous(master):
+    """Every as_of_date should map to one contiguous block of rows."""
+    assert master.date_ranges == {
+        date(2019, 1, 1): (0, 2),
+        date(2019, 7, 1): (2, 5),
+        date(2020, 1, 1): (5, 6),
+    }
+    assert list(master.row_positions([date(2020, 1, 1), date(2019, 1, 1)])) == [0, 1, 5]
+
+
+def test_read_matches_dataframe(master, master_df):
+    """Reading a subset of dates and columns should give back the original values."""
+    dates = [date(2019, 1, 1), date(2020, 1, 1)]
+    columns = ['dem_race', 'dem_age']
+    df = master.read(dates, columns)
+    expected = master_df.loc[(slice(None), dates), columns]
+    pd.testing.assert_frame_equal(df.sort_index(), expected.sort_index(), check_dtype=False)
+    # Nulls in categorical columns come back as None, as from the database
+    assert df.loc[(1, date(2019, 1, 1)), 'dem_race'] is None
+
+
+def test_read_block_and_missing_dates(master):
+    block = master.read_block([date(2019, 7, 1)], ['runs_sum_7d'])
+    assert block.shape == (3, 1)
+    assert sorted(block[:, 0]) == [1, 2, 5]
+    assert len(master.read_index([date(2018, 1, 1)])) == 0
+
+
+def test_pickle_reopens_store(master):
+    """Pickling a master matrix (e.g. to send it to a worker process) only
+    sends its path; the unpickled copy memory-maps the same files."""
+    payload = pickle.dumps(master)
+    assert len(payload) < 1000
+    copy = pickle.loads(payload)
+    assert copy.date_ranges == master.date_ranges
+    np.testing.assert_array_equal(copy.column('dem_age'), master.column('dem_age'))
+
+
+def test_chunked_writer_matches_dataframe(master, master_df, tmp_path):
+    """Appending sorted chunks gives the same store as writing the whole
+    dataframe, with categories sorted even though they arrive out of order."""
+    sorted_df = master_df.sort_index(level=['as_of_date', 'joid'])
+    writer = MasterStoreWriter(['dem_age', 'runs_sum_7d'], ['dem_race'], str(tmp_path / 'chunked'), 'abc', num_dtype=np.float32)
+    for start in range(0, len(sorted_df), 4):
+        writer.append(sorted_df.iloc[start:start + 4])
+    writer.close()
+
+    chunked = MasterMatrix(str(tmp_path / 'chunked'))
+    assert chunked.fingerprint == 'abc'
+    assert chunked.categories == master.categories == {'dem_race': ['A', 'B']}
+    assert chunked.column('dem_age').dtype == np.float32
+    dates = master.as_of_dates
+    columns = ['dem_race', 'dem_age', 'runs_sum_7d']
+    pd.testing.assert_frame_equal(chunked.read(dates, columns), master.read(dates, columns), check_dtype=False)
+
+
+def test_chunks_must_be_in_store_order(master_df, tmp_path):
+    sorted_df = master_df.sort_index(level=['as_of_date', 'joid'])
+    writer = MasterStoreWriter(['dem_age'], [], str(tmp_path / 'chunked'))
+    writer.append(sorted_df.iloc[3:])
+    with pytest.raises(Exception):
+        writer.append(sorted_df.iloc[:3])
+
+
+def test_downcast_to_compact_dtypes(master, master_df, tmp_path):
+    """Whole numbers without nulls become small integers, other numbers
+    float32 and categorical codes int8; the dtypes are kept in the schema."""
+    sorted_df = master_df.sort_index(level=['as_of_date', 'joid'])
+    writer = MasterStoreWriter(['dem_age', 'runs_sum_7d'], ['dem_race'], str(tmp_path / 'compact'), num_dtype=np.float64, downcast=True)
+    writer.append(sorted_df)
+    writer.close()
+
+    compact = MasterMatrix(str(tmp_path / 'compact'))
+    assert compact.dtypes == {'dem_race': 'int8', 'dem_age': 'float32', 'runs_sum_7d': 'int16'}
+    assert compact.column('runs_sum_7d').dtype == np.int16
+    dates = master.as_of_dates
+    columns = ['dem_race', 'dem_age', 'runs_sum_7d']
+    pd.testing.assert_frame_equal(compact.read(dates, columns), master.read(dates, columns), check_dtype=False)
+
+
+def test_downcast_dtype():
+    assert downcast_dtype(np.array([0.0, 3.0, 40000.0])) == np.int32
+    assert downcast_dtype(np.array([0.0, 3.0, np.nan])) == np.float32
+    assert downcast_dtype(np.array([0.5, 3.0])) == np.float32
+    # float32 would round these whole numbers, so they stay float64
+    assert downcast_dtype(np.array([2.0 ** 25 + 1, np.nan])) == np.float64
+    assert code_dtype(127) == np.int8 and code_dtype(128) == np.int16
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+from datetime import date
+from joblib import dump
+from sklearn.linear_model import LogisticRegression
+from pipeline.fold_arrays import make_index
+from pipeline.model_cache import (
+    cache_model, get_cached_model_path, labels_fingerprint, link_cached_model, load_cached_model, model_cache_key
+)
+
+
+def make_labels(seed, n=30):
+    rng = np.random.default_rng(seed)
+    as_of_dates = np.array([date(2019, 1, 1)] * n, dtype='datetime64[D]')
+    y_train = pd.Series(rng.random(n) < .3, index=make_index(np.arange(n), as_of_dates), name='label')
+    y_val = pd.Series(rng.random(n) < .3, index=make_index(np.arange(n), as_of_dates + 180), name='label')
+    return y_train, y_val
+
+
+def test_model_cache_key_ignores_param_order():
+    key = model_cache_key('sklearn.linear_model.LogisticRegression', {'C': 1.0, 'penalty': 'l2'}, 'm', 'l')
+    assert key == model_cache_key('sklearn.linear_model.LogisticRegression', {'penalty': 'l2', 'C': 1.0}, 'm', 'l')
+    assert key != model_cache_key('sklearn.linear_model.LogisticRegression', {'C': 0.1, 'penalty': 'l2'}, 'm', 'l')
+    assert key != model_cache_key('sklearn.linear_model.LogisticRegression', {'C': 1.0, 'penalty': 'l2'}, 'n', 'l')
+    assert key != model_cache_key('sklearn.linear_model.LogisticRegression', {'C': 1.0, 'penalty': 'l2'}, 'm', 'k')
+    assert key != model_cache_key('sklearn.tree.DecisionTreeClassifier', {'C': 1.0, 'penalty': 'l2'}, 'm', 'l')
+
+
+def test_labels_fingerprint():
+    y_train, y_val = make_labels(0)
+    key = labels_fingerprint(y_train, y_val)
+    assert key == labels_fingerprint(y_train.astype(float), y_val.copy())
+
+    flipped = y_val.copy()
+    flipped.iloc[0] = not flipped.iloc[0]
+    assert key != labels_fingerprint(y_train, flipped)
+    assert key != labels_fingerprint(y_train.iloc[1:], y_val)
+    assert key != labels_fingerprint(y_val, y_train)
+
+
+def test_cache_round_trip(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert load_cached_model('key', cache_dir) is None
+
+    y_train, _ = make_labels(1)
+    X = np.random.default_rng(1).random((len(y_train), 3))
+    model = LogisticRegression().fit(X, y_train)
+    artifact_path = str(tmp_path / 'model_1_1.joblib')
+    dump(model, artifact_path)
+
+    cache_model('key', artifact_path, cache_dir)
+    cached = load_cached_model('key', cache_dir)
+    np.testing.assert_array_equal(cached.predict_proba(X), model.predict_proba(X))
+
+    other_path = str(tmp_path / 'model_2_2.joblib')
+    link_cached_model('key', other_path, cache_dir)
+    assert os.path.samefile(other_path, get_cached_model_path('key', cache_dir))
+    assert os.listdir(cache_dir) == ['key.joblib']
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from datetime import date
+from pipeline.prediction_store import PredictionStore, import_prediction_csvs
+
+
+def make_predictions(model_id, experiment_id, model_set_id, n=20):
+    rng = np.random.default_rng(model_id)
+    df = pd.DataFrame({
+        'joid': np.arange(n),
+        'as_of_date': date(2019, 7, 1),
+        'model_id': model_id,
+        'county': rng.choice(['joco', 'doco'], n),
+        'score': rng.random(n),
+        'label_name': 'all_behavioral_crises',
+        'label': rng.random(n) < .1,
+    })
+    df['k'] = df['score'].rank(ascending=False, method='first').astype(int)
+    df['county_k'] = df.groupby('county')['score'].rank(ascending=False, method='first').astype(int)
+    return df.assign(experiment_id=experiment_id, model_set_id=model_set_id)
+
+
+def test_each_model_is_one_row_group(tmp_path):
+    store = PredictionStore(str(tmp_path))
+    batch = pd.concat([make_predictions(m, 1, 10 + m % 2) for m in range(1, 7)], ignore_index=True)
+    store.write(batch)
+    store.write(make_predictions(7, 2, 10))
+
+    assert store.model_ids() == list(range(1, 8))
+    assert store.model_ids(experiment_id=1, model_set_id=11) == [1, 3, 5]
+    assert 7 in store and 8 not in store
+
+    expected = make_predictions(3, 1, 11).drop(columns=['experiment_id', 'model_set_id'])
+    expected['as_of_date'] = expected['as_of_date'].astype(str)
+    pd.testing.assert_frame_equal(store.read(3), expected, check_dtype=False)
+
+    # The first batch wrote one file per model set, with one row group per model
+    files = list(tmp_path.glob('experiment_id=1/model_set_id=11/*.parquet'))
+    assert len(files) == 1
+    assert pq.ParquetFile(files[0]).num_row_groups == 3
+
+
+def test_import_prediction_csvs(tmp_path):
+    csv_dir = tmp_path / 'predictions'
+    csv_dir.mkdir()
+    for model_id in [4, 5]:
+        df = make_predictions(model_id, 3, 30).drop(columns=['experiment_id', 'model_set_id'])
+        df.to_csv(csv_dir / f'predictions_exp_3_30_{model_id}.csv', index=False)
+
+    store = PredictionStore(str(tmp_path / 'store'))
+    import_prediction_csvs(str(csv_dir), store)
+    import_prediction_csvs(str(csv_dir), store)
+    assert store.model_ids(model_set_id=30) == [4, 5]
+    pd.testing.assert_frame_equal(store.read(5), pd.read_csv(csv_dir / 'predictions_exp_3_30_5.csv'))
+
+
+def test_delete(tmp_path):
+    store = PredictionStore(str(tmp_path))
+    store.write(pd.concat([make_predictions(m, 1, 10) for m in [1, 2]], ignore_index=True))
+    store.write(make_predictions(3, 1, 11))
+
+    assert store.delete([2, 3, 4]) == 2
+    assert store.model_ids() == [1]
+    pd.testing.assert_frame_equal(store.read(1), store.read_models([1]))
+    # the file of model set 11 held only model 3
+    assert list(tmp_path.glob('experiment_id=1/model_set_id=11/*.parquet')) == []
+    assert len(list(tmp_path.glob('experiment_id=1/model_set_id=10/*.parquet'))) == 1
+    assert store.delete([]) == 0
+
+
+def test_unwritten_store_is_empty_and_not_created(tmp_path):
+    """Readers fall back to csv files without writing to the store's directory."""
+    path = tmp_path / 'store'
+    store = PredictionStore(str(path))
+    assert store.model_ids() == [] and 1 not in store and store.delete([1]) == 0
+    assert not path.exists()
+    store.write(make_predictions(1, 1, 10))
+    assert store.model_ids() == [1]
@@ -0,0 +1,73 @@
+import pytest
+import pandas as pd
+from pipeline import result_sink
+from pipeline.prediction_store import PredictionStore
+from pipeline.result_sink import ResultSink, PREDICTIONS_TABLE, EVALUATIONS_TABLE, PREDICTION_STORE
+
+
+def test_worker_sink_returns_its_rows():
+    """A sink without a flush size never flushes; its rows are handed to the
+    parent's sink with take() and extend()."""
+    worker_sink = ResultSink(flush_rows=None)
+    worker_sink.add(PREDICTIONS_TABLE, pd.DataFrame({'model_id': [1, 1], 'score': [.2, .9]}))
+    worker_sink.add(EVALUATIONS_TABLE, pd.DataFrame({'model_id': [1], 'value': [.5]}))
+    worker_sink.add(EVALUATIONS_TABLE, pd.DataFrame({'model_id': [], 'value': []}))
+    assert worker_sink.n_rows == 3
+
+    buffers = worker_sink.take()
+    assert worker_sink.n_rows == 0 and worker_sink.buffers == {}
+    assert len(buffers[EVALUATIONS_TABLE]) == 1
+
+    parent_sink = ResultSink(flush_rows=10, flush_seconds=3600)
+    parent_sink.extend(buffers)
+    parent_sink.extend(ResultSink(flush_rows=None).take())
+    assert parent_sink.n_rows == 3
+    assert list(parent_sink.buffers) == [PREDICTIONS_TABLE, EVALUATIONS_TABLE]
+
+
+class FakeEngine():
+    """Database engine whose COPY fails for the given table."""
+
+    def __init__(self, failing_table):
+        self.failing_table = failing_table
+        self.committed = []
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, query, csv):
+        if self.failing_table in query:
+            raise Exception('COPY failed')
+        self.pending = query
+
+    def commit(self):
+        self.committed.append(self.pending)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_predictions_are_stored_after_commit(tmp_path, monkeypatch):
+    predictions = pd.DataFrame({
+        'joid': [1], 'as_of_date': ['2019-07-01'], 'model_id': [1], 'score': [.5], 'experiment_id': [1], 'model_set_id': [10],
+    })
+    store = PredictionStore(str(tmp_path))
+    for failing_table, stored in [(EVALUATIONS_TABLE, []), ('no_table', [1])]:
+        engine = FakeEngine(failing_table)
+        monkeypatch.setattr(result_sink, 'get_database_engine', lambda: engine)
+        sink = ResultSink(flush_rows=None, prediction_store=store)
+        sink.add(PREDICTION_STORE, predictions)
+        sink.add(EVALUATIONS_TABLE, pd.DataFrame({'model_id': [1], 'value': [.5]}))
+        if stored:
+            sink.flush()
+            assert len(engine.committed) == 1
+        else:
+            with pytest.raises(Exception):
+                sink.flush()
+        assert store.model_ids() == stored
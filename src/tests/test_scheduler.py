@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from pipeline.scheduler import (
+    DEFAULT_COST_RATES, estimate_cost, fit_cost_rates, model_n_jobs, schedule_tasks, set_model_n_jobs, task_work
+)
+
+
+def test_task_work_grows_with_trees_depth_and_rows():
+    work = task_work('RandomForestClassifier', {'n_estimators': 100, 'max_depth': 10}, 100000, 400)
+    assert task_work('RandomForestClassifier', {'n_estimators': 1000, 'max_depth': 10}, 100000, 400) == 10 * work
+    assert task_work('RandomForestClassifier', {'n_estimators': 100, 'max_depth': 5}, 100000, 400) == work / 2
+    assert task_work('RandomForestClassifier', {'n_estimators': 100, 'max_depth': 10}, 200000, 400) == 2 * work
+    # Trees do not get deeper than about log2(rows)
+    assert task_work('DecisionTreeClassifier', {'max_depth': 250}, 1024, 10) == task_work('DecisionTreeClassifier', {}, 1024, 10)
+    # Random forests consider sqrt(features) at each split by default
+    assert task_work('RandomForestClassifier', {'max_features': 1.0}, 1024, 400) == 20 * task_work('RandomForestClassifier', {}, 1024, 400)
+
+
+def test_fit_cost_rates_learns_the_median_rate():
+    params = [{'n_estimators': n} for n in [10, 100, 1000]]
+    timings = pd.DataFrame({
+        'model_type': 'RandomForestClassifier',
+        'params': params,
+        'n_train_rows': 5000,
+        'n_features': 100,
+        'n_jobs': [1, 4, 8],
+    })
+    rate = 3e-8
+    timings['train_seconds'] = [
+        rate * task_work('RandomForestClassifier', p, 5000, 100) / n_jobs for p, n_jobs in zip(params, timings['n_jobs'])
+    ]
+    rates = fit_cost_rates(timings)
+    assert np.isclose(rates['RandomForestClassifier'], rate)
+    assert rates['LogisticRegression'] == DEFAULT_COST_RATES['LogisticRegression']
+    assert np.isclose(estimate_cost('RandomForestClassifier', params[1], 5000, 100, rates), timings['train_seconds'][1] * 4)
+
+
+def test_schedule_tasks_runs_long_parallel_models_on_all_cores():
+    costs = [1, 500, 3, 200, 2, 400]
+    parallel = [False, True, False, True, False, False]
+    intra_model, inter_task = schedule_tasks(costs, parallel, 4)
+    # The 400 task cannot fit in parallel, so it runs on a worker
+    assert intra_model == [1]
+    assert inter_task == [5, 3, 2, 4, 0]
+    assert schedule_tasks(costs, parallel, 1) == ([], [1, 5, 3, 2, 4, 0])
+
+
+def test_model_n_jobs():
+    model = RandomForestClassifier(n_jobs=2)
+    assert model_n_jobs(model) == 2
+    set_model_n_jobs(model, 1)
+    assert model_n_jobs(model) == 1
+    set_model_n_jobs(LogisticRegression(), 4)
+    assert model_n_jobs(LogisticRegression(n_jobs=4)) == 1
@@ -0,0 +1,73 @@
+import sqlite3
+import pandas as pd
+from types import SimpleNamespace
+from pipeline.prediction_store import PredictionStore
+from pipeline.task_ledger import delete_unfinished_models, get_model_set_key, get_task_row
+
+
+def test_model_set_key_ignores_param_order():
+    assert get_model_set_key('LogisticRegression', {'C': 1.0, 'penalty': 'l2'}) == \
+        get_model_set_key('LogisticRegression', {'penalty': 'l2', 'C': 1.0})
+    assert get_model_set_key('LogisticRegression', {'C': 1.0}) != get_model_set_key('LogisticRegression', {'C': 0.1})
+
+
+def test_task_row():
+    model = SimpleNamespace(
+        experiment_id=3, model_set_id=5, model_id=8, train_date='2019-01-01', validation_date='2019-07-01',
+        train_seconds=2.5, n_train_rows=1000, n_features=30, n_jobs=4
+    )
+    row = get_task_row(model)
+    assert row.to_dict('records') == [{
+        'experiment_id': 3, 'model_set_id': 5, 'validation_date': '2019-07-01', 'train_end_date': '2019-01-01',
+        'model_id': 8, 'train_seconds': 2.5, 'n_train_rows': 1000, 'n_features': 30, 'n_jobs': 4,
+    }]
+
+    # Models loaded from the model cache have no fit time or shape; the
+    # integer columns stay integers next to them
+    cached = SimpleNamespace(**{**vars(model), 'train_seconds': None, 'n_train_rows': None, 'n_features': None, 'n_jobs': None})
+    rows = pd.concat([get_task_row(model), get_task_row(cached)]).to_csv(index=False, header=False).splitlines()
+    assert rows == ['3,5,2019-07-01,2019-01-01,8,2.5,1000,30,4', '3,5,2019-07-01,2019-01-01,8,,,,']
+
+
+class FakeConnection():
+    """sqlite database with a results schema, executing statements like a
+    sqlalchemy connection."""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:', isolation_level=None)
+        self.conn.execute("attach database ':memory:' as results")
+        for table, columns in [
+            ('model_sets', 'model_set_id, experiment_id'),
+            ('models', 'model_id, model_set_id'),
+            ('completed_tasks', 'experiment_id, model_set_id, model_id'),
+            ('test_predictions', 'model_id'),
+            ('test_evaluations', 'model_id'),
+            ('feature_importance', 'model_id'),
+        ]:
+            self.conn.execute(f'create table results.{table} ({columns})')
+
+    def execute(self, query):
+        if query == 'COMMIT':
+            return None
+        return self.conn.execute(query)
+
+
+def test_delete_unfinished_models(tmp_path):
+    db_conn = FakeConnection()
+    db_conn.execute('insert into results.model_sets values (10, 1), (20, 2)')
+    db_conn.execute('insert into results.models values (1, 10), (2, 10), (3, 20)')
+    db_conn.execute('insert into results.completed_tasks values (1, 10, 1)')
+    db_conn.execute('insert into results.test_evaluations values (1), (2), (3)')
+
+    # Model 4's predictions were stored, but its results were never committed
+    store = PredictionStore(str(tmp_path))
+    store.write(pd.DataFrame({
+        'joid': [7] * 4, 'as_of_date': ['2019-07-01'] * 4, 'model_id': [1, 2, 3, 4], 'score': [.5] * 4,
+        'experiment_id': [1, 1, 2, 1], 'model_set_id': [10, 10, 20, 10],
+    }))
+
+    assert delete_unfinished_models(db_conn, 1, store) == 1
+    assert db_conn.execute('select model_id from results.models order by model_id').fetchall() == [(1,), (3,)]
+    assert db_conn.execute('select model_id from results.test_evaluations order by model_id').fetchall() == [(1,), (3,)]
+    # model 3 belongs to another experiment
+    assert store.model_ids() == [1, 3]
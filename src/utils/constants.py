@@ -31,11 +31,13 @@ DATA_DIR = '/mnt/data/projects/dojo-mh/'  # Edit to a disk path to save files
 PREDICTIONS_DIR = join(DATA_DIR, 'predictions')
 FIGURES_DIR = join(DATA_DIR, 'figures')
 MODELS_PATH = join(DATA_DIR, 'models')
+MODEL_CACHE_DIR = join(MODELS_PATH, 'cache')
 CSV_PATH = join(DATA_DIR, 'predictions')
+PREDICTION_STORE_DIR = join(DATA_DIR, 'prediction-store')
 MASTER_MATRIX_DIR = join(DATA_DIR, 'matrices')
-MASTER_MATRIX_NAME = 'master_features.p'
-MASTER_MATRIX_PATH = join(MASTER_MATRIX_DIR, MASTER_MATRIX_NAME)
+MASTER_STORE_DIR = join(MASTER_MATRIX_DIR, 'master-store')
 SMALL_MATRICES_DIR = join(MASTER_MATRIX_DIR, 'small-mats')
+FOLD_ARRAYS_DIR = join(MASTER_MATRIX_DIR, 'fold-arrays')
 DEMOGRAPHICS_DIR = join(DATA_DIR, 'demographics')
 PREDICTIONS_DIR = join(DATA_DIR, 'predictions')
 
@@ -48,12 +50,17 @@ SQL_INSERT_COHORT_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'insert_cohort.sql')
 
 # Features
 SQL_AGGREGATE_FEATURES = join(PROJ_DIR, SQL_PIPELINE_DIR, 'aggregation_feature.sql')
+SQL_WINDOW_AGGREGATE_FEATURES = join(PROJ_DIR, SQL_PIPELINE_DIR, 'window_aggregation_feature.sql')
 SQL_NUMERICAL_CATEGORICAL_FEATURES = join(PROJ_DIR, SQL_PIPELINE_DIR, 'numcat_feature.sql')
 SQL_CREATE_FEATURES = join(PROJ_DIR, SQL_PIPELINE_DIR, 'create_features.sql')
+SQL_INSERT_FEATURES = join(PROJ_DIR, SQL_PIPELINE_DIR, 'insert_features.sql')
+SQL_FEATURE_QUERY = join(PROJ_DIR, SQL_PIPELINE_DIR, 'feature_query.sql')
+SQL_WINDOW_FEATURE_QUERY = join(PROJ_DIR, SQL_PIPELINE_DIR, 'window_feature_query.sql')
 
 # Labels
 SQL_CREATE_LABELS_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'create_empty_labels.sql')
 SQL_LABELS_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'insert_labels.sql')
+SQL_LABELS_ALL_DATES_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'insert_labels_all_dates.sql')
 
 # Semantic
 SQL_CREATE_EMPTY_CLIENT_EVENTS_PATH = join(PROJ_DIR, SQL_SEMANTICS_DIR, 'create_empty_client_events.sql')
@@ -67,6 +74,7 @@ SQL_INSERT_DEMOGRAPHICS_PATH = join(PROJ_DIR, SQL_SEMANTICS_DIR, 'insert_demogra
 
 # Experiments
 SQL_CREATE_EXPERIMENTS_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'create_experiments.sql')
+SQL_CREATE_TASK_LEDGER_PATH = join(PROJ_DIR, SQL_PIPELINE_DIR, 'create_task_ledger.sql')
 
 
 # ----------------------------- JSON FILES ----------------------------- #
@@ -84,6 +92,8 @@ TABLE_COUNTY_PATH = join(PROJ_DIR, UTILS_DIR, 'table_county_mapping.json')
 
 # Config file
 CONFIGS_PATH = join(PROJ_DIR, PIPELINE_DIR, 'configs')
+# Config read when the pipeline modules are run as scripts
+CONFIG_PATH = join(CONFIGS_PATH, 'config.yaml')
 
 # ----------------------------- LABEL MAPPING ----------------------------- #
 
@@ -1,8 +1,11 @@
+import io
 import os
 import json
 import logging
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from joblib import load
 from pathlib import Path
 from datetime import datetime
@@ -28,24 +31,177 @@ def to_date(string: str) -> datetime.date:
     return datetime.strptime(string, '%Y-%m-%d').date()
 
 
-def get_database_connection():
-    """Connects to the database.
+# Postgres type oids fast_read_sql() can parse from COPY's csv output, and how
+PG_COPY_TYPES = {
+    16: 'bool',
+    20: 'int', 21: 'int', 23: 'int',
+    700: 'float', 701: 'float', 1700: 'float',
+    18: 'text', 19: 'text', 25: 'text', 1042: 'text', 1043: 'text',
+    1082: 'date',
+    1114: 'timestamp',
+    1184: 'timestamptz',
+    114: 'json', 3802: 'json',
+}
+ARROW_COPY_TYPES = {
+    'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64(), 'text': pa.string(),
+    'date': pa.date32(), 'timestamp': pa.timestamp('us'), 'timestamptz': pa.string(), 'json': pa.string(),
+}
+COPY_NULL = '\\N'
+
+# Process-wide engine, created lazily by get_database_engine()
+_engine = None
+_engine_pid = None
+
+
+def get_database_pool_size():
+    """Returns the (pool_size, max_overflow) of the engine's connection pool,
+    from the environment variables PGPOOLSIZE and PGMAXOVERFLOW. At most
+    pool_size + max_overflow connections can be checked out at once.
+    """
+    return int(os.getenv('PGPOOLSIZE', 5)), int(os.getenv('PGMAXOVERFLOW', 10))
+
+
+def get_database_engine():
+    """Returns the process-wide database engine, creating it if necessary. The
+    engine keeps a pool of open connections, so getting a connection does not
+    redo the TCP and authentication handshake with the server.
+
+    The pool can be configured with the environment variables PGPOOLSIZE
+    (default 5), PGMAXOVERFLOW (default 10) and PGPOOLPREPING (default 1,
+    test connections before using them).
+
+    A process forked from the one that created the engine (e.g. a joblib
+    worker) gets its own engine; the connections inherited from the parent
+    are dropped without being closed, so the parent's stay usable.
 
     Returns:
-        sqlalchemy.engine.base.Connection: Connection to the database
+        sqlalchemy.engine.Engine: database engine
     """
+    global _engine, _engine_pid
+    if _engine is not None and _engine_pid == os.getpid():
+        return _engine
+
+    if _engine is not None:
+        _engine.dispose(close=False)
+
     # Get details from ~/.bashrc
     user=os.getenv('PGUSER')
     password=os.getenv('PGPASSWORD')
     host=os.getenv('PGHOST')
     port=int(os.getenv('PGPORT'))
     database=os.getenv('PGDATABASE')
-    
-    engine = create_engine(
-        'postgresql://{}:{}@{}:{}/{}'.format(user, password, host, port, database)
+
+    pool_size, max_overflow = get_database_pool_size()
+    _engine = create_engine(
+        'postgresql://{}:{}@{}:{}/{}'.format(user, password, host, port, database),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=bool(int(os.getenv('PGPOOLPREPING', 1)))
     )
-    
-    return engine.connect()
+    _engine_pid = os.getpid()
+    return _engine
+
+
+def get_database_connection():
+    """Connects to the database, checking out a connection from the pool of
+    the process-wide engine (see get_database_engine()). Closing the connection
+    returns it to the pool.
+
+    Returns:
+        sqlalchemy.engine.base.Connection: Connection to the database
+    """
+    return get_database_engine().connect()
+
+
+def parse_copy_csv(data: bytes, columns: list[tuple[str, int]]) -> pd.DataFrame:
+    """Parse the output of COPY ... TO STDOUT WITH (FORMAT csv, HEADER,
+    NULL '\\N') into a dataframe with the types pd.read_sql() would give:
+    dates as datetime.date, nullable integers as float, json as dicts.
+
+    Args:
+        data (bytes): csv output of COPY
+        columns (list): (name, type oid) of every column, in order; every
+            oid must be in PG_COPY_TYPES
+
+    Returns Pandas DataFrame
+    """
+    names = [name for name, _ in columns]
+    kinds = {name: PG_COPY_TYPES[type_code] for name, type_code in columns}
+    table = pa_csv.read_csv(
+        pa.py_buffer(data),
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: ARROW_COPY_TYPES[kind] for name, kind in kinds.items()},
+            null_values=[COPY_NULL],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,  # "" is an empty string, not a null
+            true_values=['t'],
+            false_values=['f'],
+        )
+    )
+    df = table.to_pandas(date_as_object=True)
+    for name, kind in kinds.items():
+        if kind == 'timestamptz':
+            df[name] = pd.to_datetime(df[name], utc=True)
+        elif kind == 'json':
+            df[name] = df[name].map(json.loads, na_action='ignore')
+    return df
+
+
+def fast_read_sql(query: str, db_conn, index_col=None, dtype=None) -> pd.DataFrame:
+    """Read the result of a query with COPY (query) TO STDOUT, parsed by
+    pyarrow's multithreaded csv reader, instead of fetching it row by row.
+    Falls back to pd.read_sql() for columns of types COPY's output is not
+    parsed for (see PG_COPY_TYPES), and for repeated column names.
+
+    Args:
+        query (str): select query
+        db_conn: sqlalchemy database connection; get using get_database_connection()
+        index_col (str or list): column(s) to set as the index
+        dtype (dict): optional column -> dtype to cast the result to
+
+    Returns Pandas DataFrame
+    """
+    query = query.strip().rstrip(';')
+    cursor = db_conn.connection.cursor()
+    try:
+        # Get the names and types of the columns without running the query
+        cursor.execute(f'select * from ({query}) q limit 0')
+        columns = [(d[0], d[1]) for d in cursor.description]
+        names = [name for name, _ in columns]
+        if len(set(names)) == len(names) and all(type_code in PG_COPY_TYPES for _, type_code in columns):
+            buffer = io.BytesIO()
+            cursor.copy_expert(f"copy ({query}) to stdout with (format csv, header true, null '{COPY_NULL}')", buffer)
+            df = parse_copy_csv(buffer.getvalue(), columns)
+        else:
+            df = pd.read_sql(query, db_conn)
+    finally:
+        cursor.close()
+
+    if index_col is not None:
+        df = df.set_index(index_col)
+    if dtype is not None:
+        df = df.astype(dtype)
+    return df
+
+
+def read_sql(query: str, db_conn, index_col=None, dtype=None) -> pd.DataFrame:
+    """Read the result of a query into a dataframe with fast_read_sql(), or
+    with pd.read_sql() if the environment variable PGFASTREAD is 0 (it
+    defaults to 1). Used by the readers of large results.
+
+    Args:
+        query (str): select query
+        db_conn: sqlalchemy database connection; get using get_database_connection()
+        index_col (str or list): column(s) to set as the index
+        dtype (dict): optional column -> dtype to cast the result to
+
+    Returns Pandas DataFrame
+    """
+    if int(os.getenv('PGFASTREAD', 1)):
+        return fast_read_sql(query, db_conn, index_col, dtype)
+    df = pd.read_sql(query, db_conn, index_col=index_col)
+    return df if dtype is None else df.astype(dtype)
 
 
 def resolve_proj_dir():
@@ -84,6 +240,7 @@ def get_column_names(db_conn, table: str, schema: str ='raw') -> list[str]:
     query = f'''
     select * from information_schema.columns
     where table_schema = '{schema}' and table_name = '{table}'
+    order by ordinal_position
     '''
     return pd.read_sql(query, db_conn)['column_name']
     
@@ -1,5 +1,6 @@
 '''
-Takes all the configs from a configs dir and puts them into a bash file to be run sequentially.
+Takes all the configs from a configs dir and puts them into a bash file that runs them
+in one process, which shares the cohort, labels, features and matrices between them.
 '''
 import os
 import sys
@@ -11,24 +12,16 @@ filepath = os.path.join(PIPELINE_PATH, 'config_runner.sh')
 if __name__ == '__main__':
     s = "#!/bin/bash\n\n"
     type = sys.argv[1]
-    psqrole = ''
+    psql_role = ''
 
     if len(sys.argv) > 2:
         psql_role = sys.argv[2]
 
-    i = 0
-    for f in os.listdir(CONFIGS_PATH):
-        # Filter configs based on argument
-        if type in f:
-            path = os.path.join(CONFIGS_PATH, f)
-            s += 'python run.py ' + path + ' ' + psql_role
+    # Filter configs based on argument
+    paths = [os.path.join(CONFIGS_PATH, f) for f in sorted(os.listdir(CONFIGS_PATH)) if type in f]
 
-            # The first config should recreate cohort, labels, and features
-            if i == 0:
-                s += ' -recreate_sources'
-                i += 1
-
-            s += '\n'
+    # The first config recreates cohort, labels, and features
+    s += 'python run.py ' + ' '.join(paths) + ' ' + psql_role + ' -recreate_sources\n'
 
     with open(filepath, 'w') as f:
         f.write(s)